@@ -15,5 +15,27 @@
 # You should have received a copy of the GNU General Public License
 # along with xmppregister.  If not, see <http://www.gnu.org/licenses/>.
 
-warnings.warn('This module is deprecated, please use "xmpp_backends.ejabberd_xmlrpc" instead.')
-from xmpp_backends.ejabberd_xmlrpc import EjabberdXMLRPCBackend
+from __future__ import absolute_import
+
+from xmpp_backends.ejabberd_xmlrpc import EjabberdXMLRPCBackend  # NOQA: kept for compatibility
+
+from .transport import PooledTransport
+
+
+class PooledEjabberdXMLRPCBackend(EjabberdXMLRPCBackend):
+    """ejabberd XML-RPC backend that reuses HTTP connections.
+
+    The backend uses a :py:class:`~backends.transport.PooledTransport`, so connections to ejabberd
+    are kept alive and shared by all threads. ``pool_size`` is the maximum number of idle
+    connections kept open and ``timeout`` the timeout in seconds for every single call. The
+    transport is available as ``transport`` to inspect its connection metrics.
+
+    Use ``'BACKEND': 'backends.ejabberd_xmlrpc.PooledEjabberdXMLRPCBackend'`` in the
+    ``XMPP_BACKENDS`` setting to use this backend.
+    """
+
+    def __init__(self, uri='http://127.0.0.1:4560', pool_size=10, timeout=10, **kwargs):
+        self.transport = PooledTransport(https=uri.startswith('https://'), pool_size=pool_size,
+                                         timeout=timeout)
+        kwargs['transport'] = self.transport
+        super(PooledEjabberdXMLRPCBackend, self).__init__(uri=uri, **kwargs)
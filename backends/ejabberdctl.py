@@ -15,5 +15,162 @@
 # You should have received a copy of the GNU General Public License
 # along with xmppregister.  If not, see <http://www.gnu.org/licenses/>.
 
-warnings.warn('This module is deprecated, please use "xmpp_backends.ejabberdctl" instead.')
-from xmpp_backends.ejabberdctl import EjabberdctlBackend
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import select
+import subprocess
+import threading
+
+from django.utils.six.moves import queue
+
+from xmpp_backends.base import BackendError
+from xmpp_backends.ejabberdctl import EjabberdctlBackend as BaseEjabberdctlBackend
+
+from .timeouts import TimeoutExpired
+from .timeouts import get_timeout
+
+log = logging.getLogger(__name__)
+
+
+class EjabberdctlBackend(BaseEjabberdctlBackend):
+    """:py:class:`~xmpp_backends.ejabberdctl.EjabberdctlBackend` with a timeout for every command.
+
+    ``ejabberdctl`` is killed and :py:class:`~backends.timeouts.TimeoutExpired` is raised if it
+    does not exit within ``timeout`` seconds (or the timeout set with
+    :py:func:`~backends.timeouts.deadline`). A timeout of ``None`` means no timeout.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout  # before calling the base class, it may already run commands
+        super(EjabberdctlBackend, self).__init__(**kwargs)
+
+    def ex(self, *cmd):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timeout = get_timeout(self.timeout)
+        if timeout is None:
+            stdout, stderr = proc.communicate()
+            return proc.returncode, stdout, stderr
+
+        # Popen.communicate() has no timeout on Python 2, so kill the process from a timer
+        expired = threading.Event()
+
+        def kill():
+            expired.set()
+            try:
+                proc.kill()
+            except OSError:  # already exited
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            timer.cancel()
+
+        if expired.is_set():
+            raise TimeoutExpired('%s timed out.' % cmd[0])
+        return proc.returncode, stdout, stderr
+
+
+class CommandWorker(object):
+    """A long-lived worker process that executes ejabberdctl commands.
+
+    The worker reads one command per line from stdin, encoded as a JSON list of arguments (e.g.
+    ``["check_account", "user", "example.com"]``), and writes one line with a JSON list of the
+    exit code, stdout and stderr of the command (e.g. ``[0, "", ""]``) to stdout.
+
+    The process is started on first use and restarted if it dies. If the worker does not answer
+    within ``timeout`` seconds (or the timeout set with :py:func:`~backends.timeouts.deadline`),
+    it is killed and :py:class:`~backends.timeouts.TimeoutExpired` is raised.
+    """
+
+    def __init__(self, command, timeout=10):
+        self.command = command
+        self.timeout = timeout
+        self.proc = None
+
+    def start(self):
+        log.debug('Starting ejabberdctl worker: %s', ' '.join(self.command))
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     close_fds=True)
+
+    def stop(self):
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+                self.proc.wait()
+            except OSError:
+                pass
+            self.proc = None
+
+    def _readline(self):
+        if not select.select([self.proc.stdout], [], [], get_timeout(self.timeout))[0]:
+            raise TimeoutExpired('ejabberdctl worker timed out.')
+        line = self.proc.stdout.readline()
+        if not line.endswith(b'\n'):
+            raise BackendError('ejabberdctl worker died.')
+        return line
+
+    def call(self, *args):
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+
+        try:
+            self.proc.stdin.write(json.dumps(args).encode('utf-8') + b'\n')
+            self.proc.stdin.flush()
+            code, out, err = json.loads(self._readline().decode('utf-8'))
+        except (BackendError, EnvironmentError, ValueError):
+            # Never reuse a worker in an unknown state
+            self.stop()
+            raise
+
+        return code, out.encode('utf-8'), err.encode('utf-8')
+
+
+class PersistentEjabberdctlBackend(EjabberdctlBackend):
+    """ejabberdctl backend that sends commands to long-lived worker processes.
+
+    Unlike :py:class:`~xmpp_backends.ejabberdctl.EjabberdctlBackend`, this backend does not start
+    a new ``ejabberdctl`` process (and with it a new Erlang VM) for every operation. Instead,
+    commands are sent over a pipe to up to ``workers`` :py:class:`CommandWorker` processes started
+    with ``worker``, a list of the command and its arguments. ``timeout`` is the timeout in
+    seconds for every command, see :py:class:`CommandWorker`.
+
+    ``files/ejabberdctl/ejabberdctl-worker`` implements the protocol described in
+    :py:class:`CommandWorker` for a running ejabberd node, e.g. use
+    ``['files/ejabberdctl/ejabberdctl-worker', 'ejabberd@localhost']`` as ``worker``.
+
+    Use ``'BACKEND': 'backends.ejabberdctl.PersistentEjabberdctlBackend'`` in the
+    ``XMPP_BACKENDS`` setting to use this backend.
+    """
+
+    def __init__(self, worker, workers=1, timeout=10, **kwargs):
+        # Set up the workers first, newer versions of xmpp-backends already run commands (e.g.
+        # "status") in the constructor of the base class.
+        self.workers = queue.Queue()
+        for i in range(workers):
+            self.workers.put(CommandWorker(worker, timeout=timeout))
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        super(PersistentEjabberdctlBackend, self).__init__(**kwargs)
+
+    def ctl(self, *cmd):
+        worker = self.workers.get()
+        try:
+            with self.lock:
+                self.calls += 1
+            return worker.call(*cmd)
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        """Stop all worker processes. They are restarted when the backend is used again."""
+
+        for i in range(self.workers.qsize()):
+            worker = self.workers.get()
+            worker.stop()
+            self.workers.put(worker)
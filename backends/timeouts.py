@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Per-call timeouts for the backends in this package.
+
+:py:class:`core.backend.GuardedBackend` sets the timeout for the current operation with
+:py:func:`deadline`. The backends apply it to the socket or process they wait for, so a call that
+takes too long is really aborted instead of being left running in the background.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import threading
+
+from contextlib import contextmanager
+
+from xmpp_backends.base import BackendError
+
+_local = threading.local()
+_unset = object()
+
+
+class TimeoutExpired(BackendError):
+    """Raised if a command did not finish in time."""
+    pass
+
+
+@contextmanager
+def deadline(seconds):
+    """Use a timeout of ``seconds`` for backend calls in this thread, ``None`` means no timeout."""
+
+    old = getattr(_local, 'timeout', _unset)
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        if old is _unset:
+            del _local.timeout
+        else:
+            _local.timeout = old
+
+
+def get_timeout(default=None):
+    """Get the timeout set with :py:func:`deadline` or ``default`` if none is set."""
+
+    return getattr(_local, 'timeout', default)
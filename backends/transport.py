@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of xmppregister (https://account.jabber.at/doc).
+#
+# xmppregister is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmppregister is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmppregister.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import select
+import socket
+import threading
+
+from django.utils.six.moves import http_client
+from django.utils.six.moves import xmlrpc_client
+
+from .timeouts import get_timeout
+
+log = logging.getLogger(__name__)
+
+
+class PooledTransport(xmlrpc_client.Transport):
+    """Thread-safe XML-RPC transport that keeps HTTP connections alive and reuses them.
+
+    Connections are taken from a pool of idle connections for every call and put back afterwards.
+    If no idle connection is available a new one is created, so calls never wait for each other.
+    At most ``pool_size`` idle connections are kept. ``timeout`` is applied to every single call,
+    unless another timeout is set with :py:func:`~backends.timeouts.deadline`.
+
+    A failed call is only retried (once, with a new connection) if sending the request to a reused
+    connection failed, so the server never executes a call twice.
+
+    The attributes ``created``, ``reused`` and ``discarded`` count how many connections were
+    created, how many calls reused an idle connection and how many connections were closed because
+    of an error or because the pool was full.
+    """
+
+    def __init__(self, https=False, pool_size=10, timeout=10, **kwargs):
+        xmlrpc_client.Transport.__init__(self, **kwargs)
+        self.https = https
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def acquire(self, host, reuse=True):
+        while reuse:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+
+            if self.is_dropped(conn):
+                # The server closed the idle connection (e.g. keep-alive timeout)
+                self.discard(conn)
+                continue
+
+            with self.lock:
+                self.reused += 1
+            return conn, True
+
+        with self.lock:
+            self.created += 1
+        cls = http_client.HTTPSConnection if self.https else http_client.HTTPConnection
+        return cls(host, timeout=get_timeout(self.timeout)), False
+
+    def is_dropped(self, conn):
+        """If an idle connection was closed by the server.
+
+        An idle connection should never be readable, if it is, the server either closed it or sent
+        something we cannot make sense of.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (socket.error, ValueError):
+            return True
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+            self.discarded += 1
+        conn.close()
+
+    def discard(self, conn):
+        with self.lock:
+            self.discarded += 1
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, host, handler, request_body, verbose=False):
+        host, extra_headers, x509 = self.get_host_info(host)
+        headers = dict(extra_headers or [])
+        headers.update({
+            'Content-Type': 'text/xml',
+            'User-Agent': self.user_agent,
+        })
+
+        conn, reused = self.acquire(host)
+        try:
+            self.send(conn, handler, request_body, headers, verbose)
+        except (socket.error, http_client.HTTPException) as e:
+            self.discard(conn)
+            if not reused or isinstance(e, socket.timeout):
+                raise
+
+            # The server closed the connection before it received the complete request, so it did
+            # not execute it and it is safe to retry once with a new connection. Errors after the
+            # request was sent are never retried, as calls like create_user are not idempotent.
+            conn, reused = self.acquire(host, reuse=False)
+            try:
+                self.send(conn, handler, request_body, headers, verbose)
+            except Exception:
+                self.discard(conn)
+                raise
+
+        return self.receive(conn, host, handler, verbose)
+
+    def send(self, conn, handler, request_body, headers, verbose):
+        if conn.sock is not None:
+            conn.sock.settimeout(get_timeout(self.timeout))
+        conn.set_debuglevel(1 if verbose else 0)
+        conn.request('POST', handler, request_body, headers)
+
+    def receive(self, conn, host, handler, verbose):
+        try:
+            response = conn.getresponse()
+
+            if response.status != 200:
+                response.read()
+                raise xmlrpc_client.ProtocolError(host + handler, response.status,
+                                                  response.reason, response.msg)
+
+            self.verbose = verbose
+            result = self.parse_response(response)
+        except Exception:
+            self.discard(conn)
+            raise
+
+        if response.will_close:
+            self.discard(conn)
+        else:
+            self.release(conn)
+        return result
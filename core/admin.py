@@ -17,22 +17,28 @@
 from __future__ import unicode_literals
 
 from django.conf import settings
+from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.urlresolvers import reverse
 from django.db import models
+from django.http import Http404
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.utils.translation import ugettext_lazy as _
 
-from django_xmpp_backends import backend
-from core.constants import PURPOSE_REGISTER
-from core.constants import PURPOSE_SET_EMAIL
-from core.constants import PURPOSE_SET_PASSWORD
+from core.backend import backend
+from core.constants import NEW_PURPOSE_REGISTER
+from core.constants import NEW_PURPOSE_SET_EMAIL
+from core.constants import NEW_PURPOSE_SET_PASSWORD
 from core.models import Confirmation
 from core.models import Address
 from core.models import UserAddresses
 from core.models import RegistrationUser
-from core.tasks import send_email
-from core.utils import confirm
+from core.tasks import get_email_progress
+from core.utils import send_confirmation
+from core.utils import send_confirmations
 
 User = get_user_model()
 
@@ -131,11 +137,7 @@ class RegistrationUserAdmin(admin.ModelAdmin):
         backend.remove_user(username, domain)
 
     def _confirm(self, request, user, purpose, payload=None):
-        key, kwargs = confirm(request, user, purpose=purpose, payload=payload)
-        if settings.BROKER_URL is None:
-            key.send(**kwargs)
-        else:
-            send_email.delay(key_id=key.pk, **kwargs)
+        send_confirmation(request, user, purpose=purpose, payload=payload)
 
     def save_model(self, request, obj, form, change):
         site = settings.XMPP_HOSTS[obj.domain]
@@ -148,28 +150,63 @@ class RegistrationUserAdmin(admin.ModelAdmin):
                     'gpg_fingerprint': form.cleaned_data.get('gpg_fingerprint'),
                     'email': form.cleaned_data['email'],
                 }
-                self._confirm(request, obj, purpose=PURPOSE_REGISTER, payload=payload)
+                self._confirm(request, obj, purpose=NEW_PURPOSE_REGISTER, payload=payload)
         else: # new user
             if site.get('RESERVE', False):
                 backend.create_reservation(username=obj.node, domain=obj.domain, email=obj.email)
             if obj.email:
-                self._confirm(request, obj, purpose=PURPOSE_REGISTER)
+                self._confirm(request, obj, purpose=NEW_PURPOSE_REGISTER)
+
+    def _resend(self, request, queryset, purpose):
+        """Send confirmations to all selected users and show the progress."""
+
+        users = list(queryset)
+        token = send_confirmations(request, users, purpose=purpose)
+        if token is None:
+            self.message_user(request, _('%s emails were added to the outbox.') % len(users))
+            return None
+
+        opts = self.model._meta
+        urlname = 'admin:%s_%s_resend' % (opts.app_label, opts.model_name)
+        return HttpResponseRedirect(reverse(urlname, kwargs={'token': token}))
+
+    def get_urls(self):
+        opts = self.model._meta
+        return [
+            url(r'^resend/(?P<token>\w+)/$', self.admin_site.admin_view(self.resend_progress),
+                name='%s_%s_resend' % (opts.app_label, opts.model_name)),
+        ] + super(RegistrationUserAdmin, self).get_urls()
+
+    def resend_progress(self, request, token):
+        progress = get_email_progress(token)
+        if progress is None:
+            raise Http404
+
+        total, sent, failed = progress
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=_('Resending emails'),
+            total=total,
+            sent=sent,
+            failed=failed,
+            done=sent + failed >= total,
+        )
+        return TemplateResponse(request, 'admin/core/registrationuser/resend_progress.html',
+                                context)
 
     def resend_registration(self, request, queryset):
-        for user in queryset:
-            #TODO: This does not use the original payload - e.g. GPG encryption
-            self._confirm(request, user, purpose=PURPOSE_REGISTER)
+        #TODO: This does not use the original payload - e.g. GPG encryption
+        return self._resend(request, queryset, purpose=NEW_PURPOSE_REGISTER)
     resend_registration.short_description = _("Resend registration email")
 
     def resend_password_reset(self, request, queryset):
-        for user in queryset:
-            self._confirm(request, user, purpose=PURPOSE_SET_PASSWORD)
+        return self._resend(request, queryset, purpose=NEW_PURPOSE_SET_PASSWORD)
     resend_password_reset.short_description = _("Resend password reset email")
 
     def resend_email_reset(self, request, queryset):
-        for user in queryset:
-            #TODO: This does not use the original payload - e.g. GPG encryption
-            self._confirm(request, user, purpose=PURPOSE_SET_EMAIL)
+        #TODO: This does not use the original payload - e.g. GPG encryption
+        return self._resend(request, queryset, purpose=NEW_PURPOSE_SET_EMAIL)
     resend_email_reset.short_description = _("Resend email reset email")
 
 
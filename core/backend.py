@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Guards around calls to the XMPP backend.
+
+Use ``from core.backend import backend`` instead of ``from django_xmpp_backends import backend``
+in code that runs in a request. Every call then has a deadline, a circuit breaker fails fast if
+the backend is down and the latency of every operation is recorded.
+
+Deadlines are enforced by the backends in the :py:mod:`backends` package (see
+:py:mod:`backends.timeouts`), which apply them as socket or process timeouts. Calls to other
+backends have no deadline.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import functools
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+from django_xmpp_backends import backend as xmpp_backend
+from xmpp_backends.base import UserExists
+from xmpp_backends.base import UserNotFound
+
+from backends.timeouts import TimeoutExpired
+from backends.timeouts import deadline
+from core.exceptions import BackendUnavailable
+from core.ratelimit import get_redis_client
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# Exceptions that are a regular result of an operation and not a failure of the backend
+_RESULTS = (UserExists, UserNotFound, )
+
+
+def bucket_label(bound):
+    return '+Inf' if bound == float('inf') else '%g' % bound
+
+
+class LatencyHistogram(object):
+    """Histogram of the latency of an operation.
+
+    ``counts[i]`` is the number of calls that took at most ``LATENCY_BUCKETS[i]`` seconds (and more
+    than the previous bound).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+        return index
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for the XMPP backend.
+
+    After ``threshold`` consecutive failures, the breaker opens and :py:meth:`allow` returns
+    ``False`` for ``reset_timeout`` seconds. After that, a single trial call is allowed: If it
+    succeeds, the breaker closes again, otherwise it stays open for another ``reset_timeout``
+    seconds.
+
+    Every process has its own circuit breaker.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None  # timestamp when the breaker opened
+        self.trial = False  # if a trial call is in progress
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() < self.opened + self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                log.info('XMPP backend recovered, closing circuit breaker.')
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened is not None or self.failures >= self.threshold:
+                if self.opened is None:
+                    log.error('XMPP backend failed %s times in a row, opening circuit breaker.',
+                              self.failures)
+                self.opened = time.time()
+
+
+class GuardedBackend(object):
+    """Wrapper around an XMPP backend adding deadlines, a circuit breaker and latency histograms.
+
+    Any method of the wrapped backend can be called on this class. Operations not returning within
+    the timeout configured for them raise :py:class:`~core.exceptions.BackendUnavailable`, as do
+    all operations while the circuit breaker is open. Any other exception is passed on unchanged.
+
+    The timeout is passed to the backend with :py:func:`~backends.timeouts.deadline`, so only
+    backends that support it (e.g. the ones in :py:mod:`backends`) abort operations in time.
+
+    With a Redis cache, the histograms of all processes are added up every ``flush_interval``
+    seconds, the ``backend_stats`` management command displays them.
+
+    :param   timeouts: Per-operation timeouts in seconds, a timeout of ``None`` disables the
+        deadline for an operation.
+    :param    timeout: Timeout for operations not in ``timeouts``.
+    """
+
+    def __init__(self, backend, timeout=5, timeouts=None, threshold=5, reset_timeout=30,
+                 flush_interval=10):
+        self.backend = backend
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.breaker = CircuitBreaker(threshold, reset_timeout)
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.pending = {}  # observations not yet added to Redis
+        self.last_flush = time.time()
+
+    def __getattr__(self, name):
+        value = getattr(self.backend, name)
+        if not callable(value):
+            return value
+        return functools.partial(self.call, name)
+
+    def get_histogram(self, name):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            return self.histograms[name]
+
+    def observe(self, name, seconds):
+        index = self.get_histogram(name).observe(seconds)
+
+        with self.lock:
+            pending = self.pending.setdefault(name, {'counts': {}, 'sum': 0.0})
+            pending['counts'][index] = pending['counts'].get(index, 0) + 1
+            pending['sum'] += seconds
+            flush = time.time() >= self.last_flush + self.flush_interval
+
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Add the latencies observed in this process to the histograms of all processes."""
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+
+        client = get_redis_client()
+        if client is None or not pending:
+            return
+
+        pipe = client.pipeline(transaction=False)
+        for name, values in pending.items():
+            key = 'xmppaccount:backend-latency:%s' % name
+            for index, count in values['counts'].items():
+                pipe.hincrby(key, bucket_label(LATENCY_BUCKETS[index]), count)
+            pipe.hincrbyfloat(key, 'sum', values['sum'])
+        try:
+            pipe.execute()
+        except Exception as e:
+            log.warn('Could not record backend latencies: %s', e)
+
+    def run(self, timeout, func, *args, **kwargs):
+        with deadline(timeout):
+            try:
+                return func(*args, **kwargs)
+            except (socket.timeout, TimeoutExpired):
+                raise BackendUnavailable('The XMPP server did not answer in time.')
+
+    def call(self, name, *args, **kwargs):
+        if not self.breaker.allow():
+            raise BackendUnavailable('The XMPP server is currently not available.')
+
+        func = getattr(self.backend, name)
+        timeout = self.timeouts.get(name, self.timeout)
+        start = time.time()
+        try:
+            result = self.run(timeout, func, *args, **kwargs)
+        except _RESULTS:
+            self.breaker.success()
+            raise
+        except Exception as e:
+            log.error('%s: XMPP backend call failed: %s', name, e)
+            self.breaker.failure()
+            raise
+        else:
+            self.breaker.success()
+            return result
+        finally:
+            self.observe(name, time.time() - start)
+
+    def stats(self):
+        """Get the latency histograms recorded in this process.
+
+        Returns a dict mapping each operation to a dict with the keys ``buckets`` (a list of
+        ``(bound, count)`` tuples), ``count`` and ``sum``.
+        """
+
+        with self.lock:
+            histograms = list(self.histograms.items())
+        return {name: {
+            'buckets': list(zip(LATENCY_BUCKETS, h.counts)),
+            'count': h.count,
+            'sum': h.sum,
+        } for name, h in histograms}
+
+
+backend = GuardedBackend(xmpp_backend, timeout=settings.XMPP_BACKEND_TIMEOUT,
+                         timeouts=settings.XMPP_BACKEND_TIMEOUTS,
+                         threshold=settings.XMPP_BACKEND_FAILURE_THRESHOLD,
+                         reset_timeout=settings.XMPP_BACKEND_RESET_TIMEOUT)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from core.ipindex import IPIndex
+from core.ipindex import get_network
+from core.ipindex import load_networks
+from core.ratelimit import get_redis_client
+
+log = logging.getLogger(__name__)
+cache = caches['default']
+
+# The version of a local copy that was never synced, never equal to a version read from Redis
+_NOT_SYNCED = object()
+
+
+def _load_index(networks, setting):
+    try:
+        return IPIndex(networks)
+    except ValueError as e:
+        raise ImproperlyConfigured('%s: %s' % (setting, e))
+
+
+class Whitelist(object):
+    """Hosts and networks never rate-limited or blocked (the ``RATELIMIT_WHITELIST`` setting).
+
+    The index is built when it is first used and rebuilt if the setting changes.
+    """
+
+    def __init__(self):
+        self.index = None
+
+    def __contains__(self, host):
+        if self.index is None:
+            self.index = _load_index(settings.RATELIMIT_WHITELIST, 'RATELIMIT_WHITELIST')
+        return host in self.index
+
+
+whitelist = Whitelist()
+
+
+@receiver(setting_changed)
+def reset_whitelist(setting, **kwargs):
+    if setting == 'RATELIMIT_WHITELIST':
+        whitelist.index = None
+
+
+class BlockList(object):
+    """Hosts blocked because of a :py:class:`~core.exceptions.SpamException`.
+
+    Hosts are blocked by network, the size of the network is configured with the
+    ``SPAM_BLOCK_IPV4_PREFIX`` and ``SPAM_BLOCK_IPV6_PREFIX`` settings. The message for a blocked
+    network is stored in the cache as ``spamblock-<network>``. This base class looks up that key on
+    every request. Blocks stored by older versions (as ``spamblock-<host>``) are still honoured.
+
+    Networks from the ``SPAM_BLOCK_NETWORKS`` setting and the file named by ``SPAM_BLOCK_FILE`` are
+    blocked permanently.
+    """
+
+    message = 'Your network is blocked.'
+
+    def __init__(self):
+        networks = list(settings.SPAM_BLOCK_NETWORKS)
+        if settings.SPAM_BLOCK_FILE:
+            networks += load_networks(settings.SPAM_BLOCK_FILE)
+        self.networks = _load_index(networks, 'SPAM_BLOCK_NETWORKS')
+
+    def get_network(self, host):
+        try:
+            return get_network(host, settings.SPAM_BLOCK_IPV4_PREFIX,
+                               settings.SPAM_BLOCK_IPV6_PREFIX)
+        except ValueError:
+            return host  # not an IP address, just use the raw value
+
+    def get(self, host):
+        """Get the message why ``host`` was blocked or ``None`` if it is not blocked."""
+
+        if host in whitelist:
+            return None
+        if host in self.networks:
+            return self.message
+
+        keys = ['spamblock-%s' % self.get_network(host), 'spamblock-%s' % host]
+        blocked = cache.get_many(keys)
+        return blocked.get(keys[0], blocked.get(keys[1]))
+
+    def block(self, host, message, timeout):
+        if host in whitelist:
+            return
+        cache.set('spamblock-%s' % self.get_network(host), message, timeout)
+
+
+class RedisBlockList(BlockList):
+    """Block list that keeps a process-local copy of all blocked hosts.
+
+    Blocked networks are also added to a Redis hash (mapping the network to the time the block
+    expires) and a version counter is incremented. Every ``SPAM_BLOCK_SYNC_INTERVAL`` seconds each
+    process compares the counter with the version of its local copy and reloads the hash if it
+    changed. Requests from hosts that are not blocked thus never cause a network round trip in
+    between.
+
+    Blocks stored by older versions are not in the hash, they are added by :py:meth:`migrate` the
+    first time any process syncs.
+    """
+
+    index_key = 'xmppaccount:spamblock-index'
+    version_key = 'xmppaccount:spamblock-version'
+    migrated_key = 'xmppaccount:spamblock-migrated'
+
+    def __init__(self, client, interval):
+        super(RedisBlockList, self).__init__()
+        self.client = client
+        self.interval = interval
+        self.blocked = IPIndex()
+        self.version = _NOT_SYNCED
+        self.synced = 0
+        self.lock = threading.Lock()
+
+    def sync(self, now):
+        if now - self.synced < self.interval:
+            return
+
+        with self.lock:
+            if now - self.synced < self.interval:  # another thread was faster
+                return
+            self.synced = now
+            if self.version is _NOT_SYNCED:
+                self.migrate()
+
+            # If the version is missing (e.g. evicted), the hash is reloaded every time
+            version = self.client.get(self.version_key)
+            if version is not None and version == self.version:
+                return
+
+            blocked = IPIndex()
+            expired = []
+            for network, expires in self.client.hgetall(self.index_key).items():
+                network = network.decode('utf-8')
+                if float(expires) > now:
+                    self.add(blocked, network, float(expires))
+                else:
+                    expired.append(network)
+            if expired:
+                self.client.hdel(self.index_key, *expired)
+
+            self.blocked = blocked
+            self.version = version
+
+    def migrate(self):
+        """Add hosts blocked by older versions (stored as ``spamblock-<host>``) to the hash."""
+
+        if not cache.add(self.migrated_key, True, None):
+            return  # already done by another process
+
+        for key in cache.iter_keys('spamblock-*'):
+            host = key[len('spamblock-'):]
+            if '/' in host:  # already stored by network
+                continue
+
+            message = cache.get(key)
+            timeout = cache.ttl(key)
+            if message is None or timeout == 0:  # expired in the meantime
+                continue
+            if timeout is None:
+                timeout = settings.SPAM_BLOCK_TIME
+            self.block(host, message, timeout)
+            cache.delete(key)
+
+    def add(self, index, network, expires):
+        try:
+            index.add(network, expires)
+        except ValueError:
+            log.warning('%s: Cannot add to the local copy of blocked hosts.', network)
+
+    def get(self, host):
+        now = time.time()
+        self.sync(now)
+
+        if host in whitelist:
+            return None
+        if host in self.networks:
+            return self.message
+
+        expires = self.blocked.lookup(host)
+        if expires is None or expires < now:
+            return None
+        return super(RedisBlockList, self).get(host)
+
+    def block(self, host, message, timeout):
+        if host in whitelist:
+            return
+        super(RedisBlockList, self).block(host, message, timeout)
+
+        network = self.get_network(host)
+        expires = time.time() + timeout
+        self.add(self.blocked, network, expires)
+
+        pipe = self.client.pipeline()
+        pipe.hset(self.index_key, network, expires)
+        pipe.incr(self.version_key)
+        pipe.execute()
+
+
+def get_blocklist():
+    """Get a block list, using a process-local copy if the default cache is a Redis cache."""
+
+    client = get_redis_client()
+    if client is not None:
+        return RedisBlockList(client, interval=settings.SPAM_BLOCK_SYNC_INTERVAL)
+    return BlockList()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import logging
+import math
+
+from django.conf import settings
+
+from core.ratelimit import get_redis_client
+
+log = logging.getLogger(__name__)
+
+# Runs BITFIELD on KEYS[1] with ARGV as arguments, but only if the key already exists.
+_BITFIELD_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('BITFIELD', KEYS[1], unpack(ARGV))
+end
+"""
+
+
+class BloomFilter(object):
+    """A simple Bloom filter.
+
+    A Bloom filter can tell with certainty that a value was *not* added, but may falsely report
+    that a value was added with a probability of about ``error_rate`` once ``capacity`` values
+    were added. Values can not be removed.
+
+    Bits are numbered from the most significant bit of the first byte, like Redis numbers the bits
+    of a string with ``SETBIT``.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def offsets(self, value):
+        digest = hashlib.md5(value.encode('utf-8')).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for offset in self.offsets(value):
+            self.bits[offset // 8] |= 0x80 >> (offset % 8)
+
+    def __contains__(self, value):
+        return all(self.bits[o // 8] & (0x80 >> (o % 8)) for o in self.offsets(value))
+
+
+class RedisBloomFilter(BloomFilter):
+    """A Bloom filter stored as a string in Redis, so it is shared by all processes.
+
+    All methods use a single pipeline, no matter how many values are passed.
+    """
+
+    def __init__(self, client, key, capacity, error_rate=0.001):
+        super(RedisBloomFilter, self).__init__(capacity, error_rate)
+        self.bits = None  # stored in Redis
+        self.client = client
+        self.key = key
+
+    def add(self, *values):
+        pipe = self.client.pipeline(transaction=False)
+        for value in values:
+            for offset in self.offsets(value):
+                pipe.setbit(self.key, offset, 1)
+        pipe.execute()
+
+    def contains(self, values):
+        """Get a dict mapping each value to ``False`` if it was certainly not added.
+
+        Returns ``None`` if the filter was not yet built.
+        """
+        values = list(values)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(self.key)
+        for value in values:
+            for offset in self.offsets(value):
+                pipe.getbit(self.key, offset)
+        result = pipe.execute()
+
+        if not result[0]:
+            return None
+
+        bits = iter(result[1:])
+        return {value: all([next(bits) for i in range(self.hashes)]) for value in values}
+
+    def __contains__(self, value):
+        result = self.contains([value])
+        return result is None or result[value]
+
+    def replace(self, values):
+        """Atomically replace the filter with a new one containing exactly ``values``."""
+
+        local = BloomFilter(self.capacity, self.error_rate)
+        for value in values:
+            local.add(value)
+
+        tmp = '%s:new' % self.key
+        pipe = self.client.pipeline()
+        pipe.set(tmp, bytes(local.bits))
+        pipe.rename(tmp, self.key)
+        pipe.execute()
+
+
+class RedisCountingBloomFilter(BloomFilter):
+    """A counting Bloom filter stored in Redis, so values can also be removed again.
+
+    Every position is a 4-bit counter, accessed with ``BITFIELD`` (requires Redis 3.2 or later).
+    Counters saturate at 15, so only remove values that were actually added. Adding and removing
+    values does nothing until the filter was created with :py:meth:`create`.
+    """
+
+    def __init__(self, client, key, capacity, error_rate=0.001):
+        super(RedisCountingBloomFilter, self).__init__(capacity, error_rate)
+        self.bits = None  # stored in Redis
+        self.client = client
+        self.key = key
+        self.bitfield_if_exists = client.register_script(_BITFIELD_IF_EXISTS_SCRIPT)
+
+    def create(self, pipe):
+        pipe.delete(self.key)
+        pipe.execute_command('BITFIELD', self.key, 'SET', 'u4', '#0', 0)
+
+    def incrby(self, pipe, value, increment):
+        args = ['OVERFLOW', 'SAT']
+        for offset in self.offsets(value):
+            args += ['INCRBY', 'u4', '#%s' % offset, increment]
+        self.bitfield_if_exists(keys=[self.key], args=args, client=pipe)
+
+    def get(self, pipe, value):
+        args = ['BITFIELD', self.key]
+        for offset in self.offsets(value):
+            args += ['GET', 'u4', '#%s' % offset]
+        pipe.execute_command(*args)
+
+    def add(self, *values):
+        pipe = self.client.pipeline(transaction=False)
+        for value in values:
+            self.incrby(pipe, value, 1)
+        pipe.execute()
+
+    def remove(self, value):
+        pipe = self.client.pipeline(transaction=False)
+        self.incrby(pipe, value, -1)
+        pipe.execute()
+
+
+class KeyFilter(object):
+    """Counting Bloom filter of all valid confirmation keys.
+
+    Keys that the filter says do not exist are rejected without asking the confirmation store.
+    Keys are added when they are created and removed when they are used. Expired keys remain in
+    the filter until it is rebuilt with ``manage.py rebuild_key_filter``, which should run
+    regularly. Until the filter was built for the first time, all keys are looked up normally.
+
+    The filter counts how many keys were looked up, how many were rejected and how many were not
+    rejected but still not found (false positives or expired keys).
+    """
+
+    def __init__(self, client, capacity, error_rate):
+        self.client = client
+        self.filter = RedisCountingBloomFilter(client, 'xmppaccount:keyfilter', capacity,
+                                               error_rate)
+        self.new = RedisCountingBloomFilter(client, 'xmppaccount:keyfilter:new', capacity,
+                                            error_rate)
+        self.rebuilding_key = 'xmppaccount:keyfilter:rebuilding'
+        self.stats_key = 'xmppaccount:keyfilter:stats'
+
+    def might_exist(self, key):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(self.filter.key)
+        self.filter.get(pipe, key)
+        pipe.hincrby(self.stats_key, 'lookups', 1)
+        built, counters = pipe.execute()[:2]
+
+        if not built or all(counters):
+            return True
+        self.client.hincrby(self.stats_key, 'rejected', 1)
+        return False
+
+    def add(self, *keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            self.filter.incrby(pipe, key, 1)
+        pipe.exists(self.rebuilding_key)
+        if pipe.execute()[-1]:  # the filter is rebuilt right now, also add to the new filter
+            self.new.add(*keys)
+
+    def remove(self, key):
+        self.filter.remove(key)
+
+    def miss(self):
+        """Record that a key passed the filter but was not found."""
+        self.client.hincrby(self.stats_key, 'misses', 1)
+
+    def rebuild(self, keys, batch_size=1000):
+        """Replace the filter with a new one containing exactly ``keys``.
+
+        ``keys`` should be an iterator: The rebuild is marked as running before it is consumed, so
+        keys added in the meantime are added to the new filter as well. Keys must only be added
+        once they are committed: A key created in a transaction that is still open when ``keys``
+        is consumed is not included in it, it would be missing from the new filter if it was
+        added before the rebuild was marked as running.
+        """
+        self.client.setex(self.rebuilding_key, 3600, 1)
+        try:
+            pipe = self.client.pipeline()
+            self.new.create(pipe)
+            pipe.execute()
+
+            batch = []
+            for key in keys:
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    self.new.add(*batch)
+                    batch = []
+            if batch:
+                self.new.add(*batch)
+
+            self.client.rename(self.new.key, self.filter.key)
+        finally:
+            self.client.delete(self.rebuilding_key)
+
+    def stats(self, reset=False):
+        """Get a dict with the counters ``lookups``, ``rejected`` and ``misses``."""
+
+        pipe = self.client.pipeline()
+        pipe.hgetall(self.stats_key)
+        if reset:
+            pipe.delete(self.stats_key)
+        data = pipe.execute()[0]
+
+        stats = {'lookups': 0, 'rejected': 0, 'misses': 0}
+        stats.update({k.decode('utf-8'): int(v) for k, v in data.items()})
+        return stats
+
+
+class UserFilter(object):
+    """Per-domain Bloom filters of all existing JIDs.
+
+    If a filter says a JID does not exist, it is not necessary to ask the database or the XMPP
+    backend. New users are added whenever they are saved to the database, deleted users remain in
+    the filter until it is rebuilt with ``manage.py rebuild_user_filter``. Users registered in the
+    XMPP server directly (e.g. via In-Band Registration) are only added by rebuilding the filter,
+    so the command should run regularly.
+    """
+
+    def __init__(self, client, capacity, error_rate):
+        self.filters = {}
+        for domain in settings.XMPP_HOSTS:
+            key = 'xmppaccount:userfilter:%s' % domain
+            self.filters[domain] = RedisBloomFilter(client, key, capacity, error_rate)
+
+    def might_exist(self, jids):
+        """Get the subset of ``jids`` that might exist.
+
+        JIDs are compared case-insensitively, but returned as passed. JIDs of domains where the
+        filter was not yet built are always included, invalid JIDs never.
+        """
+        by_domain = {}
+        for jid in jids:
+            lower = jid.lower()  # XMPP usernames are case insensitive
+            if '@' not in lower:
+                continue
+            domain_jids = by_domain.setdefault(lower.split('@', 1)[1], {})
+            domain_jids.setdefault(lower, []).append(jid)
+
+        result = set()
+        for domain, domain_jids in by_domain.items():
+            contained = None
+            if domain in self.filters:
+                contained = self.filters[domain].contains(domain_jids)
+
+            for lower, originals in domain_jids.items():
+                if contained is None or contained[lower]:
+                    result.update(originals)
+        return result
+
+    def add(self, jid):
+        jid = jid.lower()  # XMPP usernames are case insensitive
+        if '@' not in jid:
+            return
+        domain = jid.split('@', 1)[1]
+        if domain in self.filters:
+            self.filters[domain].add(jid)
+
+    def rebuild(self, domain, jids):
+        self.filters[domain].replace(jids)
+
+
+_user_filter = None
+
+
+def get_user_filter():
+    """Get the :py:class:`UserFilter` or ``None`` if it is disabled or no Redis cache is used."""
+
+    global _user_filter
+    if _user_filter is None and settings.USER_FILTER:
+        client = get_redis_client()
+        if client is None:
+            log.warn('USER_FILTER requires a Redis cache, filter is disabled.')
+            return None
+        _user_filter = UserFilter(client, settings.USER_FILTER_CAPACITY,
+                                  settings.USER_FILTER_ERROR_RATE)
+    return _user_filter
+
+
+_key_filter = None
+
+
+def get_key_filter():
+    """Get the :py:class:`KeyFilter` or ``None`` if it is disabled or no Redis cache is used."""
+
+    global _key_filter
+    if _key_filter is None and settings.KEY_FILTER:
+        client = get_redis_client()
+        if client is None:
+            log.warn('KEY_FILTER requires a Redis cache, filter is disabled.')
+            return None
+        _key_filter = KeyFilter(client, settings.KEY_FILTER_CAPACITY,
+                                settings.KEY_FILTER_ERROR_RATE)
+    return _key_filter
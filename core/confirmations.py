@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import time
+
+from calendar import timegm
+from datetime import datetime
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.crypto import get_random_string
+from django.utils.crypto import salted_hmac
+from django.utils.http import base36_to_int
+from django.utils.http import int_to_base36
+from django.utils.module_loading import import_string
+
+from core.bloom import get_key_filter
+from core.ratelimit import get_redis_client
+
+cache = caches['default']
+
+# KEYS[1] is the hash of a confirmation, ARGV[1] the new payload. Does nothing if the confirmation
+# already expired, because HSET would otherwise create a hash without a TTL.
+_UPDATE_PAYLOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'payload', ARGV[1])
+end
+"""
+
+
+class ConfirmationQuery(object):
+    """A filtered view of a :py:class:`ConfirmationStore`, like a ``ConfirmationQuerySet``."""
+
+    def __init__(self, store, valid=False, purpose=None):
+        self.store = store
+        self._valid = valid
+        self._purpose = purpose
+
+    def valid(self):
+        return ConfirmationQuery(self.store, True, self._purpose)
+
+    def purpose(self, purpose):
+        return ConfirmationQuery(self.store, self._valid, purpose)
+
+    def get(self, key):
+        return self.store.find(key, purpose=self._purpose, valid=self._valid)
+
+    def in_bulk(self, keys):
+        return self.store.find_many(keys, purpose=self._purpose, valid=self._valid)
+
+
+class ConfirmationStore(object):
+    """Base class for stores of confirmation keys, configured with ``CONFIRMATION_STORE``.
+
+    Stores are used just like the manager of the ``Confirmation`` model, e.g.::
+
+        get_confirmation_store().valid().purpose(purpose).get(key=key)
+
+    ``get()`` raises ``Confirmation.DoesNotExist`` if the key is not found. Stores always return
+    ``Confirmation`` instances, but they are not necessarily saved in the database. Calling
+    ``save()`` or ``delete()`` on such an instance is handled by the store that returned it.
+
+    A confirmation should be claimed with :py:meth:`claim` before it is handled. Only one claim
+    can succeed, so the same key can never be handled twice, even by concurrent requests.
+
+    Subclasses implement :py:meth:`insert`, :py:meth:`lookup`, :py:meth:`save`,
+    :py:meth:`remove`, :py:meth:`claim`, :py:meth:`release` and :py:meth:`valid_keys`. If
+    ``use_key_filter`` is ``True``, the ``KEY_FILTER`` is used to reject unknown keys before they
+    are looked up. Subclasses may override :py:meth:`insert_many` and :py:meth:`find_many` to
+    create and look up many keys at once.
+    """
+
+    use_key_filter = True
+
+    @property
+    def model(self):
+        return apps.get_model('core', 'Confirmation')
+
+    @property
+    def timeout(self):
+        return int(settings.CONFIRMATION_TIMEOUT.total_seconds())
+
+    def valid(self):
+        return ConfirmationQuery(self, valid=True)
+
+    def purpose(self, purpose):
+        return ConfirmationQuery(self, purpose=purpose)
+
+    def get(self, key):
+        return self.find(key, purpose=None, valid=False)
+
+    def in_bulk(self, keys):
+        return self.find_many(keys, purpose=None, valid=False)
+
+    def get_key_filter(self):
+        if self.use_key_filter:
+            return get_key_filter()
+
+    def create(self, user, purpose, payload):
+        """Create a new confirmation with a JSON-encoded ``payload``."""
+
+        confirmation = self.insert(user, purpose, payload)
+        key_filter = self.get_key_filter()
+        if key_filter is not None:
+            # Keys are only added once they are committed, see KeyFilter.rebuild()
+            transaction.on_commit(lambda: key_filter.add(confirmation.key))
+        return confirmation
+
+    def create_many(self, users, purpose, payload):
+        """Create a new confirmation with the same JSON-encoded ``payload`` for all ``users``."""
+
+        confirmations = self.insert_many(users, purpose, payload)
+        key_filter = self.get_key_filter()
+        if key_filter is not None and confirmations:
+            transaction.on_commit(lambda: key_filter.add(*[c.key for c in confirmations]))
+        return confirmations
+
+    def find(self, key, purpose, valid):
+        key_filter = self.get_key_filter()
+        if key_filter is not None and not key_filter.might_exist(key):
+            raise self.model.DoesNotExist('Confirmation key not found.')
+
+        try:
+            return self.lookup(key, purpose=purpose, valid=valid)
+        except self.model.DoesNotExist:
+            if key_filter is not None:
+                key_filter.miss()
+            raise
+
+    def find_many(self, keys, purpose, valid):
+        """Get a dictionary mapping all ``keys`` that were found to their confirmation."""
+
+        found = {}
+        for key in keys:
+            try:
+                found[key] = self.find(key, purpose=purpose, valid=valid)
+            except self.model.DoesNotExist:
+                pass
+        return found
+
+    def delete(self, confirmation):
+        if not confirmation._claimed:  # a claimed confirmation is already removed
+            self.remove(confirmation)
+        key_filter = self.get_key_filter()
+        if key_filter is not None:
+            transaction.on_commit(lambda: key_filter.remove(confirmation.key))
+
+    def insert(self, user, purpose, payload):
+        raise NotImplementedError
+
+    def insert_many(self, users, purpose, payload):
+        return [self.insert(user, purpose, payload) for user in users]
+
+    def lookup(self, key, purpose, valid):
+        raise NotImplementedError
+
+    def save(self, confirmation, *args, **kwargs):
+        """Save a changed payload, ``args`` and ``kwargs`` are the arguments of ``save()``."""
+        raise NotImplementedError
+
+    def remove(self, confirmation):
+        raise NotImplementedError
+
+    def claim(self, confirmation):
+        """Atomically remove the confirmation from the store.
+
+        Returns ``False`` if the confirmation was already claimed (or removed) by somebody else.
+        After a successful claim, either :py:meth:`release` or ``delete()`` the confirmation.
+        """
+        confirmation._claimed = self._claim(confirmation)
+        return confirmation._claimed
+
+    def release(self, confirmation):
+        """Put a claimed confirmation back, so that the key can be used again."""
+        self._release(confirmation)
+        confirmation._claimed = False
+
+    def _claim(self, confirmation):
+        raise NotImplementedError
+
+    def _release(self, confirmation):
+        raise NotImplementedError
+
+    def valid_keys(self):
+        """Iterate over all keys that are currently valid (used to build the ``KEY_FILTER``)."""
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """Get the user of a confirmation, the confirmation does not exist if the user is gone."""
+
+        try:
+            return get_user_model().objects.get(pk=user_id)
+        except get_user_model().DoesNotExist:
+            raise self.model.DoesNotExist('User of the confirmation not found.')
+
+    def instance(self, **kwargs):
+        confirmation = self.model(**kwargs)
+        confirmation._store = self
+        return confirmation
+
+
+class DatabaseStore(ConfirmationStore):
+    """Store confirmations as rows of the ``Confirmation`` model (the default)."""
+
+    def insert(self, user, purpose, payload):
+        confirmation = self.model.objects.create(user=user, purpose=purpose, payload=payload)
+        confirmation._store = self
+        return confirmation
+
+    def insert_many(self, users, purpose, payload):
+        confirmations = [
+            self.model(user=user, purpose=purpose, payload=payload,
+                       key=self.model.objects.make_key(user))
+            for user in users
+        ]
+        self.model.objects.bulk_create(confirmations, batch_size=500)
+        for confirmation in confirmations:
+            confirmation._store = self
+        return confirmations
+
+    def queryset(self, purpose, valid):
+        qs = self.model.objects.valid() if valid else self.model.objects.all()
+        if purpose is not None:
+            qs = qs.purpose(purpose)
+        # Confirmations are always handled together with their user
+        return qs.select_related('user')
+
+    def lookup(self, key, purpose, valid):
+        confirmation = self.queryset(purpose, valid).get(key=key)
+        confirmation._store = self
+        return confirmation
+
+    def find_many(self, keys, purpose, valid):
+        found = {}
+        for confirmation in self.queryset(purpose, valid).filter(key__in=keys):
+            confirmation._store = self
+            found[confirmation.key] = confirmation
+        return found
+
+    def save(self, confirmation, *args, **kwargs):
+        super(self.model, confirmation).save(*args, **kwargs)
+
+    def remove(self, confirmation):
+        super(self.model, confirmation).delete()
+
+    def _claim(self, confirmation):
+        return self.model.objects.filter(pk=confirmation.pk).delete()[0] > 0
+
+    def _release(self, confirmation):
+        created = confirmation.created
+        super(self.model, confirmation).save(force_insert=True)
+
+        # created is set to the current time on insert, but the key should not live any longer
+        self.model.objects.filter(pk=confirmation.pk).update(created=created)
+        confirmation.created = created
+
+    def valid_keys(self):
+        return self.model.objects.valid().values_list('key', flat=True).iterator()
+
+
+class TokenStore(ConfirmationStore):
+    """Stateless confirmation keys signed with the ``SECRET_KEY``.
+
+    Keys have the form ``<user id>_<purpose>_<timestamp>_<payload digest>_<signature>``, so they
+    still match the URL patterns. Checking the signature, purpose and age of a key requires no
+    database access at all, only the user of a valid key is loaded from the database. Payloads
+    are stored in the cache (except for empty payloads) and keys are single use: Once a
+    confirmation is deleted, its key is remembered in the cache until it would have expired
+    anyway.
+    """
+
+    salt = 'core.confirmations.TokenStore'
+    use_key_filter = False  # validating keys requires no I/O anyway
+
+    def digest(self, payload):
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+
+    def sign(self, value):
+        return salted_hmac(self.salt, value).hexdigest()[:32]
+
+    def payload_key(self, user_id, digest):
+        return 'xmppaccount:confirmation-payload:%s:%s' % (user_id, digest)
+
+    def used_key(self, key):
+        return 'xmppaccount:confirmation-used:%s' % key.rsplit('_', 1)[-1]
+
+    def insert(self, user, purpose, payload):
+        now = int(time.time())
+        digest = self.digest(payload)
+        value = '%s_%s_%s_%s' % (int_to_base36(user.pk), purpose, int_to_base36(now), digest)
+        key = '%s_%s' % (value, self.sign(value))
+
+        if digest != self.digest('{}'):
+            cache.set(self.payload_key(user.pk, digest), payload, self.timeout)
+        created = datetime.utcfromtimestamp(now).replace(tzinfo=timezone.utc)
+        return self.instance(key=key, user=user, purpose=purpose, payload=payload, created=created)
+
+    def lookup(self, key, purpose, valid):
+        try:
+            value, signature = key.rsplit('_', 1)
+            user_id, key_purpose, timestamp, digest = value.split('_')
+            user_id = base36_to_int(user_id)
+            created = datetime.utcfromtimestamp(base36_to_int(timestamp))
+        except (ValueError, OverflowError):
+            raise self.model.DoesNotExist('Malformed confirmation key.')
+
+        if not constant_time_compare(signature, self.sign(value)):
+            raise self.model.DoesNotExist('Invalid signature.')
+        if purpose is not None and key_purpose != purpose:
+            raise self.model.DoesNotExist('Wrong purpose.')
+
+        created = created.replace(tzinfo=timezone.utc)
+        if valid and created <= timezone.now() - settings.CONFIRMATION_TIMEOUT:
+            raise self.model.DoesNotExist('Confirmation key expired.')
+
+        used_key = self.used_key(key)
+        payload_key = self.payload_key(user_id, digest)
+        cached = cache.get_many([used_key, payload_key])
+        if used_key in cached:
+            raise self.model.DoesNotExist('Confirmation key was already used.')
+
+        payload = cached.get(payload_key)
+        if payload is None:
+            if digest != self.digest('{}'):
+                raise self.model.DoesNotExist('Payload expired.')
+            payload = '{}'
+
+        return self.instance(key=key, user=self.get_user(user_id), purpose=key_purpose,
+                             payload=payload, created=created)
+
+    def save(self, confirmation, *args, **kwargs):
+        user_id, purpose, timestamp, digest, signature = confirmation.key.split('_')
+        cache.set(self.payload_key(base36_to_int(user_id), digest), confirmation.payload,
+                  self.timeout)
+
+    def remove(self, confirmation):
+        cache.set(self.used_key(confirmation.key), True, self.timeout)
+
+    def _claim(self, confirmation):
+        return cache.add(self.used_key(confirmation.key), True, self.timeout)
+
+    def _release(self, confirmation):
+        cache.delete(self.used_key(confirmation.key))
+
+
+class RedisStore(ConfirmationStore):
+    """Store confirmations as hashes in Redis that expire after ``CONFIRMATION_TIMEOUT``.
+
+    Expired confirmations are removed by Redis itself, so they never have to be purged. This store
+    requires the default cache to be a Redis cache.
+    """
+
+    def __init__(self):
+        self.client = get_redis_client()
+        if self.client is None:
+            raise ImproperlyConfigured('%s requires a Redis cache.' % self.__class__.__name__)
+        self.update_payload = self.client.register_script(_UPDATE_PAYLOAD_SCRIPT)
+
+    def redis_key(self, key):
+        return 'xmppaccount:confirmation:%s' % key
+
+    def insert(self, user, purpose, payload):
+        key = salted_hmac(get_random_string(32), '%s-%s' % (user.jid, purpose)).hexdigest()
+        created = datetime.utcfromtimestamp(time.time()).replace(tzinfo=timezone.utc)
+        confirmation = self.instance(key=key, user=user, purpose=purpose, payload=payload,
+                                     created=created)
+        self.write(confirmation, self.timeout)
+        return confirmation
+
+    def write(self, confirmation, timeout):
+        redis_key = self.redis_key(confirmation.key)
+        pipe = self.client.pipeline()
+        pipe.hmset(redis_key, {
+            'user': confirmation.user_id,
+            'purpose': confirmation.purpose,
+            'payload': confirmation.payload,
+            # in microseconds, a float would lose precision when converted to a string
+            'created': timegm(confirmation.created.utctimetuple()) * 1000000 +
+            confirmation.created.microsecond,
+        })
+        pipe.expire(redis_key, timeout)
+        pipe.execute()
+
+    def lookup(self, key, purpose, valid):
+        data = self.client.hgetall(self.redis_key(key))
+        if not data:
+            raise self.model.DoesNotExist('Confirmation key expired or not found.')
+
+        data = {k.decode('utf-8'): v.decode('utf-8') for k, v in data.items()}
+        if purpose is not None and data['purpose'] != purpose:
+            raise self.model.DoesNotExist('Wrong purpose.')
+
+        created = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(
+            microseconds=int(data['created']))
+        if valid and created <= timezone.now() - settings.CONFIRMATION_TIMEOUT:
+            raise self.model.DoesNotExist('Confirmation key expired.')
+
+        return self.instance(key=key, user=self.get_user(int(data['user'])),
+                             purpose=data['purpose'], payload=data['payload'], created=created)
+
+    def save(self, confirmation, *args, **kwargs):
+        self.update_payload(keys=[self.redis_key(confirmation.key)], args=[confirmation.payload])
+
+    def remove(self, confirmation):
+        self.client.delete(self.redis_key(confirmation.key))
+
+    def _claim(self, confirmation):
+        return self.client.delete(self.redis_key(confirmation.key)) == 1
+
+    def _release(self, confirmation):
+        expires = confirmation.created + settings.CONFIRMATION_TIMEOUT
+        timeout = int((expires - timezone.now()).total_seconds())
+        if timeout > 0:
+            self.write(confirmation, timeout)
+
+    def valid_keys(self):
+        prefix = self.redis_key('')
+        for key in self.client.scan_iter(match='%s*' % prefix, count=1000):
+            yield key.decode('utf-8')[len(prefix):]
+
+
+_store = None
+
+
+def get_confirmation_store():
+    """Get the store configured with the ``CONFIRMATION_STORE`` setting."""
+
+    global _store
+    if _store is None:
+        _store = import_string(settings.CONFIRMATION_STORE)()
+    return _store
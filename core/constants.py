@@ -28,3 +28,7 @@ NEW_PURPOSE_DELETE = 'delete'
 REGISTRATION_WEBSITE = 0
 REGISTRATION_INBAND = 1
 REGISTRATION_UNKNOWN = 99
+
+BACKEND_STATUS_PENDING = 'pending'
+BACKEND_STATUS_DONE = 'done'
+BACKEND_STATUS_FAILED = 'failed'
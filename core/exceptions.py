@@ -33,6 +33,11 @@ class TemporaryError(Exception):
     pass
 
 
+class BackendUnavailable(TemporaryError):
+    """Raised when the XMPP backend does not answer in time or is known to be down."""
+    pass
+
+
 class RegistrationRateException(RateException):
     """Raised when the user exceeds rate for registrations."""
 
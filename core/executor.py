@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Run functions in background threads of the current process.
+
+This is used to send emails outside of the request if no Celery broker is configured, see the
+``EMAIL_WORKER_THREADS`` setting.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.six.moves import queue
+
+log = logging.getLogger(__name__)
+
+
+class BoundedExecutor(object):
+    """A pool of ``workers`` threads that run functions passed to :py:meth:`submit`.
+
+    At most ``queue_size`` functions are queued. If the queue is full, :py:meth:`submit` runs the
+    function in the calling thread instead, so a burst of requests slows down to the speed of the
+    workers instead of queueing work without bounds.
+
+    Threads are started when the first function is submitted (and again after a fork). When the
+    process exits, queued functions are still run for up to ``shutdown_timeout`` seconds.
+    """
+
+    def __init__(self, workers, queue_size=100, shutdown_timeout=30):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.shutdown_timeout = shutdown_timeout
+
+        self.lock = threading.Lock()
+        self.queue = None
+        self.threads = []
+        self.pid = None
+        self.registered = False
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # Threads (and queued functions) of a parent process do not exist after a fork
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, args=(self.queue, ),
+                                          name='executor-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+            if not self.registered:
+                atexit.register(self.shutdown)
+                self.registered = True
+
+    def submit(self, func, *args, **kwargs):
+        self.start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            log.warn('Background queue is full, running %s in the current thread.',
+                     func.__name__)
+            self.run(func, args, kwargs)
+
+    def run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            log.exception('Error running %s in the background.', func.__name__)
+
+    def work(self, jobs):
+        while True:
+            item = jobs.get()
+            try:
+                if item is None:  # see shutdown()
+                    return
+                self.run(*item)
+            finally:
+                close_old_connections()  # database connections are per thread
+                jobs.task_done()
+
+    def shutdown(self, timeout=None):
+        """Run all queued functions and stop the threads.
+
+        Waits for up to ``timeout`` seconds (``shutdown_timeout`` by default).
+        """
+        if self.pid != os.getpid():
+            return
+        if timeout is None:
+            timeout = self.shutdown_timeout
+
+        with self.lock:
+            threads, self.threads = self.threads, []
+            self.pid = None
+
+        deadline = time.time() + timeout
+        try:
+            for thread in threads:
+                self.queue.put(None, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            pass
+
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        if any(t.is_alive() for t in threads):
+            log.error('Background threads did not finish within %s seconds.', timeout)
+
+
+email_executor = BoundedExecutor(workers=settings.EMAIL_WORKER_THREADS,
+                                 queue_size=settings.EMAIL_QUEUE_SIZE)
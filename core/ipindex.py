@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import binascii
+import socket
+
+_FAMILIES = {
+    4: (socket.AF_INET, 32),
+    6: (socket.AF_INET6, 128),
+}
+
+
+def parse_address(address):
+    """Parse an IPv4 or IPv6 address into a tuple of ``(version, integer)``.
+
+    Raises ``ValueError`` if ``address`` is not a valid IP address.
+    """
+    version = 6 if ':' in address else 4
+    try:
+        packed = socket.inet_pton(_FAMILIES[version][0], address)
+    except (socket.error, TypeError):
+        raise ValueError('%s: Not a valid IP address.' % address)
+    return version, int(binascii.hexlify(packed), 16)
+
+
+def format_address(version, value):
+    bits = _FAMILIES[version][1]
+    packed = binascii.unhexlify('%0*x' % (bits // 4, value))
+    return socket.inet_ntop(_FAMILIES[version][0], packed)
+
+
+def parse_network(network):
+    """Parse a network like ``"192.0.2.0/24"`` into a tuple of ``(version, integer, prefixlen)``.
+
+    A plain address is treated as a network with the full prefix length. Host bits are silently
+    discarded.
+    """
+    address, _sep, prefixlen = network.strip().partition('/')
+    version, value = parse_address(address)
+    bits = _FAMILIES[version][1]
+
+    if prefixlen:
+        try:
+            prefixlen = int(prefixlen)
+        except ValueError:
+            raise ValueError('%s: Not a valid prefix length.' % network)
+        if not 0 <= prefixlen <= bits:
+            raise ValueError('%s: Not a valid prefix length.' % network)
+    else:
+        prefixlen = bits
+
+    value = value >> (bits - prefixlen) << (bits - prefixlen)
+    return version, value, prefixlen
+
+
+def get_network(address, ipv4_prefixlen=32, ipv6_prefixlen=128):
+    """Get the network (as string) that ``address`` is in, given the prefix length for each
+    protocol version."""
+
+    version, value = parse_address(address)
+    prefixlen = ipv4_prefixlen if version == 4 else ipv6_prefixlen
+    bits = _FAMILIES[version][1]
+    value = value >> (bits - prefixlen) << (bits - prefixlen)
+    return '%s/%s' % (format_address(version, value), prefixlen)
+
+
+class IPIndex(object):
+    """A binary prefix tree of IPv4 and IPv6 networks.
+
+    Each network added to the index can be associated with a value, :py:meth:`lookup` returns the
+    value of the most specific network that contains a given address. Lookups walk at most one
+    node per bit of the address, independent of the number of networks in the index.
+
+    >>> index = IPIndex(['192.0.2.0/24', '2001:db8::/32'])
+    >>> '192.0.2.10' in index
+    True
+    >>> '198.51.100.1' in index
+    False
+    """
+
+    def __init__(self, networks=None):
+        # each node is a list of [child for bit 0, child for bit 1, value]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+
+        for network in networks or []:
+            self.add(network)
+
+    def add(self, network, value=True):
+        version, address, prefixlen = parse_network(network)
+        bits = _FAMILIES[version][1]
+
+        node = self.roots[version]
+        for i in range(bits - 1, bits - 1 - prefixlen, -1):
+            bit = (address >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            self.count += 1
+        node[2] = value
+
+    def lookup(self, address, default=None):
+        """Get the value of the most specific network containing ``address``.
+
+        Returns ``default`` if no network matches or if ``address`` is not a valid IP address.
+        """
+        try:
+            version, address = parse_address(address)
+        except ValueError:
+            return default
+
+        node = self.roots[version]
+        value = node[2]
+        for i in range(_FAMILIES[version][1] - 1, -1, -1):
+            node = node[(address >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                value = node[2]
+
+        return default if value is None else value
+
+    def __contains__(self, address):
+        return self.lookup(address) is not None
+
+    def __len__(self):
+        return self.count
+
+
+def load_networks(path):
+    """Load networks from a file with one network per line. Empty lines and comments starting with
+    ``#`` are ignored."""
+
+    with open(path) as stream:
+        lines = [line.split('#', 1)[0].strip() for line in stream]
+    return [line for line in lines if line]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Reuse SMTP connections for sending emails.
+
+``msg.send()`` opens (and authenticates) a new SMTP connection for every single message. Use
+``smtp_pool.send(msg)`` instead, which keeps connections open and shares them between all threads
+of a process.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+log = logging.getLogger(__name__)
+
+# Errors that mean that the connection is gone. The message is sent again with a new connection.
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error, )
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of open connections of the configured ``EMAIL_BACKEND``.
+
+    At most ``size`` idle connections are kept. Connections idle for more than ``idle_timeout``
+    seconds are closed instead of being reused, as SMTP servers close idle connections themselves
+    after a while. If a connection turns out to be closed anyway, the message is sent again with a
+    new connection.
+
+    After a fork (e.g. in Celery worker processes), connections of the parent process are never
+    used.
+    """
+
+    def __init__(self, size=4, idle_timeout=60):
+        self.size = size
+        self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        self.idle = []  # (last used, connection)
+        self.pid = os.getpid()
+
+    def acquire(self):
+        now = time.time()
+        expired = []
+
+        with self.lock:
+            if self.pid != os.getpid():  # we were forked, the sockets belong to the parent
+                self.idle = []
+                self.pid = os.getpid()
+
+            while self.idle:
+                last_used, conn = self.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    break
+                expired.append(conn)
+            else:
+                conn = None
+
+        for old in expired:
+            self.discard(old)
+
+        if conn is None:
+            conn = get_connection(fail_silently=False)
+            conn.open()
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size and self.pid == os.getpid():
+                self.idle.append((time.time(), conn))
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:  # the connection might already be broken
+            log.debug('Error closing email connection.', exc_info=True)
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for last_used, conn in idle:
+            self.discard(conn)
+
+    def send(self, msg):
+        """Send ``msg`` (an ``EmailMessage``) with a pooled connection."""
+
+        conn = self.acquire()
+        try:
+            try:
+                conn.send_messages([msg])
+            except _CONNECTION_ERRORS:
+                log.info('Email connection was closed, reconnecting.')
+                self.discard(conn)
+                conn = get_connection(fail_silently=False)
+                conn.open()
+                conn.send_messages([msg])
+        except smtplib.SMTPRecipientsRefused:
+            # The connection is still usable, the caller handles the error
+            self.release(conn)
+            raise
+        except Exception:
+            self.discard(conn)
+            raise
+
+        self.release(conn)
+
+
+smtp_pool = ConnectionPool(size=settings.SMTP_POOL_SIZE, idle_timeout=settings.SMTP_IDLE_TIMEOUT)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.backend import LATENCY_BUCKETS
+from core.backend import bucket_label
+from core.ratelimit import get_redis_client
+
+
+class Command(BaseCommand):
+    help = "Show latency histograms of calls to the XMPP backend and calls saved by coalescing " \
+        "(requires a Redis cache)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help="Reset all histograms and counters after displaying them.")
+
+    def handle(self, *args, **kwargs):
+        client = get_redis_client()
+        if client is None:
+            raise CommandError("Latency histograms are only recorded with a Redis cache.")
+
+        keys = sorted(client.keys('xmppaccount:backend-latency:*'))
+        for key in keys:
+            histogram = {k.decode('utf-8'): v for k, v in client.hgetall(key).items()}
+            name = key.decode('utf-8').rsplit(':', 1)[1]
+            counts = [int(histogram.get(bucket_label(b), 0)) for b in LATENCY_BUCKETS]
+            count = sum(counts)
+            if not count:
+                continue
+
+            self.stdout.write("%s: %s calls, %.3f seconds average" % (
+                name, count, float(histogram.get('sum', 0)) / count))
+
+            total = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, counts):
+                total += bucket
+                self.stdout.write("    <= %-6s %8s (%5.1f%%)" % (
+                    bucket_label(bound), bucket, 100.0 * total / count))
+
+        flights = sorted(client.keys('xmppaccount:singleflight:*'))
+        for key in flights:
+            counters = {k.decode('utf-8'): int(v) for k, v in client.hgetall(key).items()}
+            name = key.decode('utf-8').rsplit(':', 1)[1]
+            saved = counters.get('shared', 0) + counters.get('remote_shared', 0)
+            self.stdout.write("%s: %s calls made, %s saved (%s in-process, %s remote)" % (
+                name, counters.get('calls', 0), saved, counters.get('shared', 0),
+                counters.get('remote_shared', 0)))
+        keys += flights
+
+        if kwargs['reset'] and keys:
+            client.delete(*keys)
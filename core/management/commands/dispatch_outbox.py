@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.outbox import drain
+
+
+class Command(BaseCommand):
+    help = "Send due emails in the outbox (see the EMAIL_OUTBOX setting)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="Keep running and check for new emails every OUTBOX_INTERVAL.")
+
+    def handle(self, *args, **kwargs):
+        interval = settings.OUTBOX_INTERVAL.total_seconds()
+
+        while True:
+            count = drain()
+            if count:
+                self.stdout.write("Processed %s emails." % count)
+            if not kwargs['loop']:
+                break
+            time.sleep(interval)
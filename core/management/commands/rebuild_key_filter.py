@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division, unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core.bloom import get_key_filter
+from core.confirmations import get_confirmation_store
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Bloom filter of valid confirmation keys (see the KEY_FILTER setting)."
+
+    def handle(self, *args, **kwargs):
+        key_filter = get_key_filter()
+        store = get_confirmation_store()
+        if key_filter is None:
+            raise CommandError("KEY_FILTER is disabled or no Redis cache is configured.")
+        if not store.use_key_filter:
+            raise CommandError("%s does not use the KEY_FILTER." % store.__class__.__name__)
+
+        stats = key_filter.stats(reset=True)
+        if stats['lookups']:
+            unknown = stats['rejected'] + stats['misses']
+            self.stdout.write("Since the last rebuild: %s lookups, %s rejected (%.1f%%)." % (
+                stats['lookups'], stats['rejected'], 100 * stats['rejected'] / stats['lookups']))
+            if unknown:
+                self.stdout.write("%s of %s unknown keys were not rejected (%.2f%%)." % (
+                    stats['misses'], unknown, 100 * stats['misses'] / unknown))
+
+        key_filter.rebuild(store.valid_keys())
+        self.stdout.write("Rebuilt filter of valid confirmation keys.")
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from django_xmpp_backends import backend
+
+from core.bloom import get_user_filter
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Bloom filters of existing users (see the USER_FILTER setting)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('domain', nargs='*',
+                            help="Only rebuild filters for the given domains.")
+
+    def handle(self, *args, **kwargs):
+        user_filter = get_user_filter()
+        if user_filter is None:
+            raise CommandError("USER_FILTER is disabled or no Redis cache is configured.")
+
+        domains = kwargs['domain'] or list(settings.XMPP_HOSTS)
+        for domain in domains:
+            if domain not in settings.XMPP_HOSTS:
+                raise CommandError("%s: Domain not configured in XMPP_HOSTS setting." % domain)
+
+            start = timezone.now()
+            users = User.objects.filter(jid__endswith='@%s' % domain)
+            jids = set(u.lower() for u in users.values_list('jid', flat=True))
+            jids |= set('%s@%s' % (u.lower(), domain) for u in backend.all_users(domain))
+            user_filter.rebuild(domain, jids)
+
+            # Users registered while the filter was built were added to the old filter.
+            for jid in users.filter(registered__gte=start).values_list('jid', flat=True):
+                user_filter.add(jid)
+
+            self.stdout.write("%s: Added %s users." % (domain, len(jids)))
@@ -70,10 +70,13 @@ class ConfirmationManager(models.Manager):
     def get_queryset(self):
         return ConfirmationQuerySet(self.model)
 
+    def make_key(self, user):
+        salt = get_random_string(32)
+        value = '%s-%s-%s' % (user.email, user.node, user.domain)
+        return salted_hmac(salt, value).hexdigest()
+
     def create(self, user, purpose, key=None, **kwargs):
         if key is None:
-            salt = get_random_string(32)
-            value = '%s-%s-%s' % (user.email, user.node, user.domain)
-            key = salted_hmac(salt, value).hexdigest()
+            key = self.make_key(user)
         return super(ConfirmationManager, self).create(
             user=user, purpose=purpose, key=key, **kwargs)
@@ -19,35 +19,30 @@ from __future__ import unicode_literals
 import logging
 
 from django.conf import settings
-from django.core.cache import cache
 from django.shortcuts import render
 from django.utils import six
 from django.utils.six.moves.urllib.parse import urlsplit
 
+from core.blocklist import get_blocklist
 from core.exceptions import RateException
 from core.exceptions import RegistrationRateException
 from core.exceptions import SpamException
 from core.exceptions import TemporaryError
+from core.sites import sites
 
 log = logging.getLogger(__name__)
 
 
 class SiteMiddleware(object):
     def process_request(self, request):
-        host = request.META.get('HTTP_HOST', request.META.get('SERVER_NAME'))
-        config = settings.XMPP_HOSTS_MAPPING.get(host)
-        if config is None:
-            config = settings.DEFAULT_XMPP_HOST
-
-        request.site = settings.XMPP_HOSTS[config]
-        request.site['DOMAIN'] = config
-        request.site.setdefault('BRAND', settings.BRAND or config)
-        request.site.setdefault('CONTACT_URL', settings.CONTACT_URL)
-        request.site.setdefault('FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
-        request.site.setdefault('HOMEPAGE', 'https://%s' % config)
+        host = request.META.get('HTTP_HOST', request.META.get('SERVER_NAME', ''))
+        request.site = sites.get(host)
 
 
 class AntiSpamMiddleware(object):
+    def __init__(self):
+        self.blocklist = get_blocklist()
+
     def get_context(self, request, message):
         host = request.META['REMOTE_ADDR']
 
@@ -63,10 +58,11 @@ class AntiSpamMiddleware(object):
         return context
 
     def process_request(self, request):
-        message = cache.get('spamblock-%s' % request.META['REMOTE_ADDR'])  # Added by previous SpamException
+        # Added by a previous SpamException
+        message = self.blocklist.get(request.META['REMOTE_ADDR'])
         if message:
             context = self.get_context(request, message)
-            return render(request, 'core/spambot.html', context)
+            return render(request, 'core/spambot.html', context, status=403)
 
     def process_exception(self, request, exception):
         if six.PY3:
@@ -78,12 +74,13 @@ class AntiSpamMiddleware(object):
         context = self.get_context(request, message)
 
         if isinstance(exception, SpamException):
-            cache.set('spamblock-%s' % context['HOST'], context['EXCEPTION'], settings.SPAM_BLOCK_TIME)
-            return render(request, 'core/spambot.html', context)
+            self.blocklist.block(context['HOST'], context['EXCEPTION'], settings.SPAM_BLOCK_TIME)
+            return render(request, 'core/spambot.html', context, status=403)
         elif isinstance(exception, RegistrationRateException):
-            return render(request, 'core/registration_rate.html', context)
+            return render(request, 'core/registration_rate.html', context, status=429)
         elif isinstance(exception, RateException):
             log.info('RateException: %s', message)
-            return render(request, 'core/rate.html', context)
+            return render(request, 'core/rate.html', context, status=429)
         elif isinstance(exception, TemporaryError):
-            return render(request, 'core/temporary_error.html', context)
+            # Not a 2xx status, API clients (e.g. the username widget) must not see a success
+            return render(request, 'core/temporary_error.html', context, status=503)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_auto_20160902_1229'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='confirmation',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='confirmation',
+            name='key',
+            field=models.CharField(max_length=40, unique=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='confirmation',
+            index_together=set([('purpose', 'created')]),
+        ),
+    ]
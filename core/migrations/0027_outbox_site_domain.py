@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 10:41
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+
+def site_to_domain(apps, schema_editor):
+    # Emails queued before this migration contain the JSON encoded site configuration
+    Outbox = apps.get_model('core', 'Outbox')
+    for email in Outbox.objects.filter(site__startswith='{'):
+        email.site = json.loads(email.site)['DOMAIN']
+        email.save(update_fields=['site'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_outbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(site_to_domain, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='outbox',
+            name='site',
+            field=models.CharField(max_length=255),
+        ),
+    ]
@@ -31,7 +31,10 @@ from email.mime.text import MIMEText
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy as _l
@@ -53,7 +56,10 @@ from core.exceptions import GpgError
 from core.exceptions import GpgFingerprintError
 from core.exceptions import GpgKeyError
 from core.exceptions import TemporaryError
+from core.bloom import get_user_filter
+from core.confirmations import get_confirmation_store
 from core.lock import GpgLock
+from core.mail import smtp_pool
 from core.managers import ConfirmationManager
 from core.managers import RegistrationUserManager
 from core.querysets import ConfirmationQuerySet
@@ -137,7 +143,7 @@ class RegistrationUser(XmppBackendUser):
             raise TemporaryError(
                 "It appears you have entered some weird characters. Please try again.")
 
-        return self.confirmation_set.create(purpose=purpose, payload=payload)
+        return get_confirmation_store().create(self, purpose=purpose, payload=payload)
 
     def has_perm(self, perm, obj=None):
         return self.is_admin
@@ -161,14 +167,33 @@ class RegistrationUser(XmppBackendUser):
 
 @python_2_unicode_compatible
 class Confirmation(models.Model):
-    key = models.CharField(max_length=40)
+    key = models.CharField(max_length=40, unique=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
     purpose = models.CharField(max_length=12, choices=NEW_PURPOSE_CHOICES)
     payload = models.TextField(null=True, blank=True)
 
     objects = ConfirmationManager.from_queryset(ConfirmationQuerySet)()
 
+    # Set by the store that returned this confirmation, see core.confirmations
+    _store = None
+    _claimed = False
+
+    class Meta:
+        index_together = [
+            ('purpose', 'created'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._store is not None:
+            return self._store.save(self, *args, **kwargs)
+        return super(Confirmation, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if self._store is not None:
+            return self._store.delete(self)
+        return super(Confirmation, self).delete(*args, **kwargs)
+
     def should_use_gpg(self, payload, site):
         if not settings.GPG:  # GPG not configured
             return False
@@ -348,7 +373,7 @@ class Confirmation(models.Model):
             msg = self.msg_without_gpg(subject, frm, recipient, text, html)
 
         try:
-            msg.send()
+            smtp_pool.send(msg)
         except smtplib.SMTPRecipientsRefused:
             pass
 
@@ -384,3 +409,35 @@ class UserAddresses(models.Model):
     def __str__(self):
         return '%s: %s/%s' % (PURPOSE_DICT[self.purpose], self.address.address,
                               self.user.jid)
+
+
+@python_2_unicode_compatible
+class Outbox(models.Model):
+    """A confirmation email that is not yet sent, see ``core.outbox``."""
+
+    key = models.CharField(max_length=255)
+    uri = models.CharField(max_length=255)
+    site = models.CharField(max_length=255)  # a domain in XMPP_HOSTS
+    lang = models.CharField(max_length=16)
+    created = models.DateTimeField(auto_now_add=True)
+
+    # When the email is (again) due. A dispatcher that claims the email sets this to the time when
+    # its claim expires, so that the email is sent again if the dispatcher dies.
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    dispatcher = models.CharField(max_length=32, blank=True, default='', db_index=True)
+
+    class Meta:
+        verbose_name = _('Outgoing email')
+        verbose_name_plural = _('Outgoing emails')
+
+    def __str__(self):
+        return '%s (%s attempts)' % (self.key, self.attempts)
+
+
+@receiver(post_save, sender=RegistrationUser)
+def add_to_user_filter(sender, instance, created, **kwargs):
+    if created is True:
+        user_filter = get_user_filter()
+        if user_filter is not None:
+            user_filter.add(instance.jid)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Transactional outbox for confirmation emails.
+
+With ``EMAIL_OUTBOX = True``, no email is sent (or handed to Celery) while handling a request.
+Instead, :py:func:`enqueue` adds it to the ``Outbox`` table in the same transaction that creates
+the confirmation key. :py:func:`dispatch`, run by Celery beat or ``manage.py dispatch_outbox``,
+sends due emails in batches. An email is only removed from the outbox after it was sent, so every
+email is sent at least once.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.confirmations import get_confirmation_store
+from core.models import Outbox
+from core.sites import get_site
+
+log = logging.getLogger(__name__)
+
+
+def enqueue(key, uri, site, lang):
+    """Add the email for confirmation ``key`` to the outbox.
+
+    ``site`` is the domain of the site in ``XMPP_HOSTS``.
+    """
+
+    return Outbox.objects.create(key=key.key, uri=uri, site=site, lang=lang)
+
+
+def enqueue_many(emails):
+    """Add many emails to the outbox, ``emails`` is a list of keyword arguments for
+    :py:func:`enqueue` (with ``key`` being the confirmation key itself)."""
+
+    return Outbox.objects.bulk_create([Outbox(**kwargs) for kwargs in emails], batch_size=500)
+
+
+def claim(batch_size, lease):
+    """Claim up to ``batch_size`` due emails for ``lease`` seconds.
+
+    Only emails that are still due are updated, so concurrent dispatchers never claim the same
+    email. Emails claimed by a dispatcher that died become due again once the claim expires.
+    """
+    now = timezone.now()
+    dispatcher = uuid.uuid4().hex
+    due = Outbox.objects.filter(next_attempt__lte=now)
+
+    pks = list(due.order_by('next_attempt').values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return []
+
+    due.filter(pk__in=pks).update(dispatcher=dispatcher,
+                                  next_attempt=now + timedelta(seconds=lease))
+    return list(Outbox.objects.filter(dispatcher=dispatcher))
+
+
+def dispatch(batch_size=None, max_attempts=None, lease=None):
+    """Send one batch of due emails and return the number of emails in the batch.
+
+    Emails that fail are retried with an exponential backoff, up to ``max_attempts`` times. Emails
+    for confirmation keys that expired or were already used are dropped.
+    """
+    if batch_size is None:
+        batch_size = settings.OUTBOX_BATCH_SIZE
+    if max_attempts is None:
+        max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+    if lease is None:
+        lease = settings.OUTBOX_LEASE
+
+    batch = claim(batch_size, lease)
+    if not batch:
+        return 0
+
+    keys = get_confirmation_store().valid().in_bulk([email.key for email in batch])
+    done = []
+
+    for email in batch:
+        key = keys.get(email.key)
+        if key is None:
+            log.info('%s: Confirmation expired or already used, not sending email.', email.key)
+            done.append(email.pk)
+            continue
+
+        try:
+            key.send(uri=email.uri, site=get_site(email.site), lang=email.lang)
+        except Exception as e:
+            attempts = email.attempts + 1
+            if attempts >= max_attempts:
+                log.error('%s: Giving up after %s attempts: %s', email.key, attempts, e)
+                done.append(email.pk)
+            else:
+                log.warn('%s: Sending email failed: %s', email.key, e)
+                next_attempt = timezone.now() + timedelta(seconds=min(5 * 2 ** attempts, 600))
+                Outbox.objects.filter(pk=email.pk).update(
+                    attempts=attempts, next_attempt=next_attempt, dispatcher='')
+            continue
+
+        done.append(email.pk)
+
+    Outbox.objects.filter(pk__in=done).delete()
+    return len(batch)
+
+
+def drain(**kwargs):
+    """Send due emails until no full batch is left. Returns the number of processed emails."""
+
+    batch_size = kwargs.setdefault('batch_size', settings.OUTBOX_BATCH_SIZE)
+    total = 0
+    while True:
+        count = dispatch(**kwargs)
+        total += count
+        if count < batch_size:
+            return total
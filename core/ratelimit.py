@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+cache = caches['default']
+
+# KEYS[1] is the sorted set holding timestamps, ARGV[1] is the current time, ARGV[2] a unique
+# member for this hit and ARGV[3:] are pairs of (window in seconds, maximum number of hits).
+_SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local longest = 0
+for i = 3, #ARGV, 2 do
+    longest = math.max(longest, tonumber(ARGV[i]))
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - longest)
+for i = 3, #ARGV, 2 do
+    local count = redis.call('ZCOUNT', KEYS[1], now - tonumber(ARGV[i]), '+inf')
+    if count >= tonumber(ARGV[i + 1]) then
+        return 0
+    end
+end
+
+redis.call('ZADD', KEYS[1], now, ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(longest))
+return 1
+"""
+
+# KEYS[1] is a hash holding the bucket, ARGV[1] is the current time, ARGV[2] the capacity of the
+# bucket and ARGV[3] the number of tokens added per second.
+_TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(bucket[1]) or capacity
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - stamp) * rate)
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+return allowed
+"""
+_PERIODS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 60 * 60 * 24,
+}
+
+
+def get_redis_client():
+    """Get the raw Redis client of the default cache or ``None`` if it is not a Redis cache."""
+
+    if cache.__module__ == 'django_redis.cache':
+        return cache.client.get_client(True)
+
+
+class SlidingWindowLimiter(object):
+    """Rate limiter that enforces multiple sliding windows at once.
+
+    ``windows`` is a dict mapping a ``timedelta`` to the number of hits allowed within that
+    timeframe, exactly like the ``REGISTRATION_RATE`` setting.
+
+    Hits are stored as a list of timestamps in the default cache, so limits are shared by all WSGI
+    processes using the same (e.g. memcached) cache. Concurrent hits for the same key might both
+    be allowed, see :py:class:`RedisSlidingWindowLimiter` for an atomic implementation.
+    """
+
+    def __init__(self, windows):
+        self.windows = sorted((w.total_seconds(), int(c)) for w, c in windows.items())
+        self.longest = max([w for w, c in self.windows] or [0])
+
+    def allowed(self, hits, now):
+        """Check if a hit at ``now`` is allowed, given the sorted list of previous ``hits``."""
+
+        for window, count in self.windows:
+            if len(hits) - bisect.bisect_right(hits, now - window) >= count:
+                return False
+        return True
+
+    def hit(self, key):
+        """Record a hit for ``key``.
+
+        Returns ``False`` (and does not record the hit) if any window would be exceeded.
+        """
+        now = time.time()
+        cache_key = 'xmppaccount:ratelimit:%s' % key
+
+        hits = cache.get(cache_key, [])
+        del hits[:bisect.bisect_right(hits, now - self.longest)]
+        if not self.allowed(hits, now):
+            return False
+
+        hits.append(now)
+        cache.set(cache_key, hits, int(math.ceil(self.longest)))
+        return True
+
+
+class RedisSlidingWindowLimiter(SlidingWindowLimiter):
+    """Limiter using a Redis sorted set per key.
+
+    All windows are checked, expired entries pruned and the new hit recorded in a single Lua
+    script, so decisions are atomic across all WSGI processes using the same Redis server.
+    """
+
+    def __init__(self, windows, client):
+        super(RedisSlidingWindowLimiter, self).__init__(windows)
+        self.client = client
+        self.script = client.register_script(_SLIDING_WINDOW_SCRIPT)
+
+    def hit(self, key):
+        args = [time.time(), uuid.uuid4().hex]
+        for window, count in self.windows:
+            args += [window, count]
+        return bool(self.script(keys=['xmppaccount:ratelimit:%s' % key], args=args))
+
+
+def get_sliding_window_limiter(windows):
+    """Get a limiter for the given windows, using Redis if the default cache is a Redis cache."""
+
+    client = get_redis_client()
+    if client is not None:
+        return RedisSlidingWindowLimiter(windows, client)
+    return SlidingWindowLimiter(windows)
+
+
+def parse_rate(rate):
+    """Parse a rate like ``"15/m"`` into a tuple of ``(capacity, tokens per second)``."""
+
+    count, period = rate.split('/', 1)
+    count = int(count)
+    return count, float(count) / _PERIODS[period.lower()[0]]
+
+
+class LocMemTokenBucketStore(object):
+    """Process-local token buckets, only suitable for setups with a single WSGI process."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, rate):
+        now = time.time()
+
+        with self.lock:
+            tokens, stamp = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+
+            # drop buckets that are full again anyway
+            if len(self.buckets) > 1024:
+                for k in [k for k, (t, s) in self.buckets.items() if s < now - capacity / rate]:
+                    del self.buckets[k]
+            return allowed
+
+
+class CacheTokenBucketStore(object):
+    """Token buckets stored in the default cache, shared by all WSGI processes using it.
+
+    Concurrent requests from the same client might both take the last token, use the
+    :py:class:`RedisTokenBucketStore` if that matters.
+    """
+
+    def consume(self, key, capacity, rate):
+        now = time.time()
+        cache_key = 'xmppaccount:ratelimit:%s' % key
+
+        tokens, stamp = cache.get(cache_key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        cache.set(cache_key, (tokens, now), int(math.ceil(capacity / rate)))
+        return allowed
+
+
+class RedisTokenBucketStore(object):
+    """Token buckets stored in Redis, each check is a single atomic script invocation.
+
+    ``client`` is the Redis client of the default cache by default.
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            client = get_redis_client()
+        if client is None:
+            raise ImproperlyConfigured('%s requires a Redis cache.' % self.__class__.__name__)
+        self.client = client
+        self.script = client.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    def consume(self, key, capacity, rate):
+        args = [time.time(), capacity, rate]
+        return bool(self.script(keys=['xmppaccount:ratelimit:%s' % key], args=args))
+
+
+_token_bucket_store = None
+
+
+def get_token_bucket_store():
+    """Get the token bucket store configured with the ``RATELIMIT_STORE`` setting.
+
+    If the setting is ``None``, Redis is used if the default cache is a Redis cache.
+    """
+
+    global _token_bucket_store
+    if _token_bucket_store is None:
+        if settings.RATELIMIT_STORE is not None:
+            _token_bucket_store = import_string(settings.RATELIMIT_STORE)()
+        elif get_redis_client() is not None:
+            _token_bucket_store = RedisTokenBucketStore()
+        else:
+            _token_bucket_store = CacheTokenBucketStore()
+    return _token_bucket_store
+
+
+class RequestRateLimiter(object):
+    """Rate limiter for requests, with one token bucket per HTTP method and client.
+
+    ``rates`` is a dict mapping HTTP methods to rates like ``"15/m"``. Rates are parsed only once
+    when the limiter is created, so checking a request costs a single operation on the store.
+    """
+
+    def __init__(self, name, rates, store=None):
+        self.name = name
+        self.rates = {method.upper(): parse_rate(rate) for method, rate in rates.items()}
+        if store is None:
+            store = get_token_bucket_store()
+        self.store = store
+
+    def limited(self, method, ip):
+        """Return ``True`` if the client at ``ip`` exceeded the rate for ``method``."""
+
+        rate = self.rates.get(method)
+        if rate is None:
+            return False
+
+        key = '%s:%s:%s' % (self.name, method, ip)
+        return not self.store.consume(key, *rate)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Route email tasks to separate Celery queues, see the ``EMAIL_QUEUES`` setting.
+
+GPG emails are slow (they are serialized by the ``GpgLock``) and go to ``gpg-<n>`` queues, all
+other emails go to ``email-<n>`` queues. ``n`` is derived from the domain of the site (there are
+``EMAIL_QUEUES`` queues of each kind). Workers consume all queues of a kind in turn, so a burst
+of emails for one domain does not delay emails for other domains.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+
+TASK_KINDS = {
+    'core.tasks.send_email': 'email',
+    'core.tasks.send_gpg_email': 'gpg',
+}
+
+
+def get_queues(kind):
+    """Get the names of all queues of ``kind`` (``"email"`` or ``"gpg"``)."""
+
+    return ['%s-%s' % (kind, i) for i in range(settings.EMAIL_QUEUES)]
+
+
+def get_queue(kind, domain):
+    """Get the queue for emails of ``kind`` for ``domain``.
+
+    As long as there are no more domains than queues, every domain gets its own queue.
+    """
+    domains = sorted(settings.XMPP_HOSTS)
+    index = domains.index(domain) if domain in domains else len(domains)
+    return '%s-%s' % (kind, index % settings.EMAIL_QUEUES)
+
+
+class EmailRouter(object):
+    def route_for_task(self, task, args=None, kwargs=None):
+        kind = TASK_KINDS.get(task)
+        if kind is None or not kwargs or 'site' not in kwargs:
+            return None
+
+        queue = get_queue(kind, kwargs['site'])
+        return {'queue': queue, 'routing_key': queue}
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+import time
+
+from django.core.cache import caches
+
+from core.ratelimit import get_redis_client
+
+cache = caches['default']
+log = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key into a single call.
+
+    Threads calling :py:meth:`do` with a key that is already being computed in this process wait
+    for the first call and share its result (or exception).
+
+    If ``lock_timeout`` is given, calls are also coalesced across processes: The first process
+    acquires a short lock in the cache and stores the result there for ``result_timeout`` seconds.
+    Other processes poll for the result for as long as the lock is held and then fall back to
+    calling the function themselves.
+
+    The counters ``calls``, ``shared`` and ``remote_shared`` count calls actually made, calls that
+    waited for another thread and calls that received the result from another process. With a
+    Redis cache, they are also added up for all processes every ``flush_interval`` seconds, the
+    ``backend_stats`` management command displays the totals.
+    """
+
+    def __init__(self, prefix, lock_timeout=None, result_timeout=5, poll_interval=0.05,
+                 flush_interval=10):
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.calls = 0
+        self.shared = 0
+        self.remote_shared = 0
+
+        self.flushed = {'calls': 0, 'shared': 0, 'remote_shared': 0}
+        self.last_flush = time.time()
+
+    @property
+    def saved(self):
+        """Number of calls that were saved."""
+        return self.shared + self.remote_shared
+
+    def stats(self):
+        """Get the counters of this process as dict."""
+        with self.lock:
+            return {'calls': self.calls, 'shared': self.shared,
+                    'remote_shared': self.remote_shared}
+
+    def flush(self):
+        """Add the counters of this process to the totals of all processes stored in Redis."""
+
+        client = get_redis_client()
+        if client is None:
+            return
+
+        with self.lock:
+            stats = {'calls': self.calls, 'shared': self.shared,
+                     'remote_shared': self.remote_shared}
+            delta = {k: v - self.flushed[k] for k, v in stats.items() if v != self.flushed[k]}
+            self.flushed = stats
+            self.last_flush = time.time()
+        if not delta:
+            return
+
+        key = 'xmppaccount:singleflight:%s' % self.prefix
+        pipe = client.pipeline(transaction=False)
+        for field, value in delta.items():
+            pipe.hincrby(key, field, value)
+        try:
+            pipe.execute()
+        except Exception as e:
+            log.warn('Could not record single-flight counters of %s: %s', self.prefix, e)
+
+    def do(self, key, func, *args, **kwargs):
+        if time.time() >= self.last_flush + self.flush_interval:
+            self.flush()
+
+        with self.lock:
+            call = self.pending.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self.pending[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            if self.lock_timeout:
+                call.result = self._do_remote(key, func, *args, **kwargs)
+            else:
+                call.result = self._call(func, *args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            call.event.set()
+
+    def _call(self, func, *args, **kwargs):
+        with self.lock:
+            self.calls += 1
+        return func(*args, **kwargs)
+
+    def _do_remote(self, key, func, *args, **kwargs):
+        lock_key = '%s-lock-%s' % (self.prefix, key)
+        result_key = '%s-result-%s' % (self.prefix, key)
+
+        if cache.add(lock_key, 1, self.lock_timeout):
+            try:
+                result = self._call(func, *args, **kwargs)
+                cache.set(result_key, result, self.result_timeout)
+                return result
+            finally:
+                cache.delete(lock_key)
+
+        # Another process is already calling the function, wait for its result. If the lock is
+        # gone without a result, the other process failed and there is no point in waiting.
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            values = cache.get_many([result_key, lock_key])
+            if result_key in values:
+                with self.lock:
+                    self.remote_shared += 1
+                return values[result_key]
+            if lock_key not in values:
+                break
+
+        return self._call(func, *args, **kwargs)
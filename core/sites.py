@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class Site(dict):
+    """Read-only configuration of a host in the ``XMPP_HOSTS`` setting.
+
+    This is a dict so it can still be used for string formatting, in templates and serialized to
+    JSON, but any attempt to modify it raises ``TypeError``. Instances are shared between all
+    requests and threads.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Site configuration is read-only.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (Site, (dict(self), ))
+
+
+class SiteIndex(object):
+    """Maps HTTP hosts to :py:class:`Site` instances.
+
+    Hosts are mapped with the ``XMPP_HOSTS_MAPPING`` setting. Keys may contain a port (which is
+    otherwise ignored) or start with ``*.`` to match any subdomain. Hosts not matching any key
+    map to the ``DEFAULT_XMPP_HOST``.
+    """
+
+    def __init__(self, hosts, mapping, default):
+        self.sites = {}
+        for domain, config in hosts.items():
+            config = dict(config, DOMAIN=domain)
+            config.setdefault('BRAND', settings.BRAND or domain)
+            config.setdefault('CONTACT_URL', settings.CONTACT_URL)
+            config.setdefault('FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
+            config.setdefault('HOMEPAGE', 'https://%s' % domain)
+            self.sites[domain] = Site(config)
+
+        if default not in self.sites:
+            raise ImproperlyConfigured('DEFAULT_XMPP_HOST: %s: Not in XMPP_HOSTS.' % default)
+        self.default = self.sites[default]
+
+        self.hosts = {}
+        self.wildcards = {}
+        for host, domain in mapping.items():
+            if domain not in self.sites:
+                raise ImproperlyConfigured('XMPP_HOSTS_MAPPING: %s: Not in XMPP_HOSTS.' % domain)
+
+            host = self.normalize(host)
+            if host.startswith('*.'):
+                self.wildcards[host[2:]] = self.sites[domain]
+            else:
+                self.hosts[host] = self.sites[domain]
+
+    def normalize(self, host):
+        """Lowercase ``host`` and strip the port."""
+
+        host = host.lower()
+        if ':' in host and not host.endswith(']'):  # strip port, but not from an IPv6 literal
+            host = host.rsplit(':', 1)[0]
+        return host
+
+    def get(self, host):
+        """Get the site for the given value of the ``Host`` header."""
+
+        # Fast path: The host is used exactly as configured.
+        site = self.hosts.get(host)
+        if site is not None:
+            return site
+
+        host = self.normalize(host)
+        site = self.hosts.get(host)
+        if site is not None:
+            return site
+
+        if self.wildcards:
+            parent = host
+            while '.' in parent:
+                parent = parent.split('.', 1)[1]
+                site = self.wildcards.get(parent)
+                if site is not None:
+                    return site
+
+        return self.default
+
+
+sites = SiteIndex(settings.XMPP_HOSTS, settings.XMPP_HOSTS_MAPPING, settings.DEFAULT_XMPP_HOST)
+
+
+def get_site(domain):
+    """Get the site for a domain in ``XMPP_HOSTS``."""
+
+    return sites.sites[domain]
@@ -19,30 +19,270 @@ import json
 import logging
 
 from celery import shared_task
+from celery.signals import worker_process_shutdown
 
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils import timezone
+
+from django_xmpp_backends import backend
+from xmpp_backends.base import UserExists
+from xmpp_backends.base import UserNotFound
+
+from core.bloom import get_user_filter
+from core.confirmations import get_confirmation_store
+from core.constants import BACKEND_STATUS_DONE
+from core.constants import BACKEND_STATUS_FAILED
+from core.constants import REGISTRATION_INBAND
 from core.lock import GpgLock
-from core.models import Confirmation
+from core.mail import smtp_pool
+from core.outbox import drain
+from core.sites import get_site
 
+User = get_user_model()
 log = logging.getLogger(__name__)
 
+# Exceptions meaning that an operation was already done by a previous attempt of the task that
+# failed after the backend applied it. On the first attempt, they are real errors (e.g. someone
+# registered the same username via in-band registration in the meantime).
+_ALREADY_DONE = {
+    'create_user': UserExists,
+    'remove_user': UserNotFound,
+}
+
+
+def _remove_registration(username, domain, **kwargs):
+    # The account was never created. Remove the user, so that the user can register again right
+    # away (instead of the username being taken until the registration expires).
+    User.objects.filter(jid='%s@%s' % (username, domain)).delete()
+
+
+# Functions undoing the database changes made for an operation that failed permanently
+_ROLLBACK = {
+    'create_user': _remove_registration,
+}
+
+
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    smtp_pool.close()
+
+
+def set_backend_status(token, status):
+    cache.set('xmppaccount:backend-status:%s' % token, status, settings.BACKEND_STATUS_TIMEOUT)
+
+
+def get_backend_status(token):
+    return cache.get('xmppaccount:backend-status:%s' % token)
+
+
+def set_email_progress(token, total):
+    cache.set_many({
+        'xmppaccount:email-progress:%s' % token: total,
+        'xmppaccount:email-progress:%s:sent' % token: 0,
+        'xmppaccount:email-progress:%s:failed' % token: 0,
+    }, settings.BACKEND_STATUS_TIMEOUT)
+
+
+def get_email_progress(token):
+    """Get a tuple of the total number of emails and how many were sent and failed so far.
+
+    Returns ``None`` if ``token`` is unknown or expired.
+    """
+    key = 'xmppaccount:email-progress:%s' % token
+    progress = cache.get_many([key, '%s:sent' % key, '%s:failed' % key])
+    if key not in progress:
+        return None
+    return progress[key], progress.get('%s:sent' % key, 0), progress.get('%s:failed' % key, 0)
+
+
+def _record_email_progress(token, sent=0, failed=0):
+    key = 'xmppaccount:email-progress:%s' % token
+    try:
+        if sent:
+            cache.incr('%s:sent' % key, sent)
+        if failed:
+            cache.incr('%s:failed' % key, failed)
+    except ValueError:  # progress already expired
+        pass
+
 
 @shared_task(bind=True)
-def send_email(self, key_id, uri, site, lang):
-    key = Confirmation.objects.get(id=key_id)
+def send_email(self, key, uri, site, lang):
+    """Send the email for the confirmation ``key``.
+
+    Tasks only get references (``site`` is a domain in ``XMPP_HOSTS``), the email is rendered by
+    the worker that sends it.
+    """
+    _send_email(get_confirmation_store().get(key=key), uri, site, lang)
 
-    payload = json.loads(key.payload)
-    frm, recipient, subject, text, html = key.get_msg_data(payload, uri, site, lang)
 
-    if key.should_use_gpg(payload=payload, site=site):
-        send_gpg_email.delay(key_id=key_id, site=site, frm=frm, subject=subject, text=text, html=html)
-    else:
-        msg = key.msg_without_gpg(subject, frm, recipient, text, html)
-        msg.send()
+def _send_email(confirmation, uri, site, lang, token=None):
+    """Send the email for ``confirmation``.
+
+    Returns ``False`` if the email was handed to the :py:func:`send_gpg_email` task instead, which
+    records the progress for ``token`` itself once it is done.
+    """
+    payload = json.loads(confirmation.payload)
+    site_config = get_site(site)
+
+    if confirmation.should_use_gpg(payload=payload, site=site_config):
+        kwargs = dict(key=confirmation.key, uri=uri, site=site, lang=lang)
+        if settings.BROKER_URL is None:  # called by the in-process executor
+            send_gpg_email(**kwargs)
+            return True
+        send_gpg_email.delay(token=token, **kwargs)
+        return False
+
+    frm, recipient, subject, text, html = confirmation.get_msg_data(payload, uri, site_config,
+                                                                    lang)
+    msg = confirmation.msg_without_gpg(subject, frm, recipient, text, html)
+    smtp_pool.send(msg)
+    return True
 
 
 @shared_task(bind=True)
-def send_gpg_email(self, key_id, site, frm, subject, text, html):
-    key = Confirmation.objects.get(id=key_id)
-    with GpgLock(cache_fallback=getattr(self.backend, 'client')):
-        msg = key.msg_with_gpg(site, frm, subject, text, html)
-    msg.send()
+def send_gpg_email(self, key, uri, site, lang, token=None):
+    """Send the GPG signed and/or encrypted email for the confirmation ``key``.
+
+    If ``token`` is given, the email is counted as sent or failed for
+    :py:func:`get_email_progress`.
+    """
+    try:
+        confirmation = get_confirmation_store().get(key=key)
+        payload = json.loads(confirmation.payload)
+        site = get_site(site)
+
+        frm, recipient, subject, text, html = confirmation.get_msg_data(payload, uri, site, lang)
+        with GpgLock(cache_fallback=getattr(self.backend, 'client', None)):
+            msg = confirmation.msg_with_gpg(site, frm, subject, text, html, payload=payload)
+        smtp_pool.send(msg)
+    except Exception:
+        if token is not None:
+            _record_email_progress(token, failed=1)
+        raise
+
+    if token is not None:
+        _record_email_progress(token, sent=1)
+
+
+@shared_task(ignore_result=True)
+def send_emails(emails, token=None):
+    """Send many emails, ``emails`` is a list of keyword arguments for :py:func:`send_email`.
+
+    All confirmations are looked up at once and a failing email does not stop the others. If
+    ``token`` is given, the progress is recorded for :py:func:`get_email_progress` - GPG emails
+    are only counted once their :py:func:`send_gpg_email` task is done.
+    """
+    confirmations = get_confirmation_store().in_bulk([kwargs['key'] for kwargs in emails])
+    sent = failed = 0
+    for kwargs in emails:
+        try:
+            if _send_email(confirmations[kwargs['key']], kwargs['uri'], kwargs['site'],
+                           kwargs['lang'], token=token):
+                sent += 1
+        except Exception:
+            log.exception('Could not send email for %s', kwargs['key'])
+            failed += 1
+
+    if token is not None:
+        _record_email_progress(token, sent=sent, failed=failed)
+
+
+@shared_task(ignore_result=True)
+def dispatch_outbox():
+    """Send all due emails in the outbox, see ``EMAIL_OUTBOX``."""
+
+    count = drain()
+    if count:
+        log.info('Processed %s emails in the outbox.', count)
+
+
+@shared_task
+def reconcile_users():
+    """Synchronize the users in the database with the users in the XMPP backend.
+
+    Users only found in the backend are added, users gone from the backend are removed. Users that
+    registered recently are left alone, as they might have a pending confirmation. This keeps the
+    database accurate enough to be used with the ``AUTHORITATIVE_DATABASE`` setting.
+    """
+    created_before = timezone.now() - settings.CONFIRMATION_TIMEOUT
+    user_filter = get_user_filter()
+
+    for domain in settings.MANAGED_HOSTS:
+        # lowercase usernames from backend just to be sure
+        backend_users = set(['%s@%s' % (u.lower(), domain) for u in backend.all_users(domain)])
+        if len(backend_users) < 100:
+            # A silent safety check if the backend for some reason does not return any users and
+            # does not raise an exception.
+            log.warn('Skipping %s: Only %s users received.', domain, len(backend_users))
+            continue
+
+        # Map normalized JIDs to the JIDs actually stored in the database
+        users = User.objects.filter(jid__endswith='@%s' % domain)
+        db_users = {}
+        for jid in users.values_list('jid', flat=True):
+            db_users.setdefault(jid.lower(), []).append(jid)
+
+        to_create = backend_users - set(db_users)
+        User.objects.bulk_create([User(jid=jid, registration_method=REGISTRATION_INBAND)
+                                  for jid in to_create], batch_size=500)
+        if user_filter is not None and to_create:
+            user_filter.filters[domain].add(*to_create)
+
+        to_delete = [jid for key in set(db_users) - backend_users for jid in db_users[key]]
+        for i in range(0, len(to_delete), 500):
+            users.filter(jid__in=to_delete[i:i + 500], registered__lt=created_before).delete()
+
+        log.info('%s: Added %s and removed up to %s users.', domain, len(to_create),
+                 len(to_delete))
+
+
+def _backend_operation_failed(token, method, kwargs, exc):
+    log.error('%s: Failed permanently: %s', method, exc)
+    set_backend_status(token, BACKEND_STATUS_FAILED)
+    if method in _ROLLBACK:
+        _ROLLBACK[method](**kwargs)
+
+
+@shared_task(bind=True, max_retries=10)
+def backend_operations(self, operations, token):
+    """Execute XMPP backend operations deferred by a request (see ``DEFER_BACKEND_WRITES``).
+
+    ``operations`` is a list of ``(method, kwargs)`` tuples, executed in order. Operations that
+    already succeeded are skipped if the task is retried, so the task can safely be retried with an
+    exponential backoff if the backend is unavailable. The outcome is stored in the cache under
+    ``token``, see :py:func:`get_backend_status`.
+
+    If an operation fails permanently, the remaining operations are skipped and the changes made
+    to the database for it are rolled back where possible, e.g. a registration is removed if the
+    account could not be created.
+    """
+    done_key = 'xmppaccount:backend-done:%s' % token
+    done = cache.get(done_key, 0)
+
+    for i, (method, kwargs) in enumerate(operations[done:], done):
+        # Only the first remaining operation was attempted before, the previous attempt failed
+        # there.
+        retried = self.request.retries > 0 and i == done
+
+        try:
+            getattr(backend, method)(**kwargs)
+        except (UserExists, UserNotFound) as e:
+            if retried and isinstance(e, _ALREADY_DONE.get(method, ())):
+                log.info('%s: Already done in a previous attempt.', method)
+            else:
+                _backend_operation_failed(token, method, kwargs, e)
+                return
+        except Exception as e:
+            if self.request.retries >= self.max_retries:
+                _backend_operation_failed(token, method, kwargs, e)
+                raise
+
+            log.warn('%s: %s, retrying.', method, e)
+            raise self.retry(exc=e, countdown=min(5 * 2 ** self.request.retries, 600))
+
+        cache.set(done_key, i + 1, settings.BACKEND_STATUS_TIMEOUT)
+
+    set_backend_status(token, BACKEND_STATUS_DONE)
@@ -1,8 +1,1186 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
 
-Replace this with more appropriate tests for your application.
-"""
+from __future__ import unicode_literals
 
-from django.test import TestCase
+import json
+import os
+import pickle
+import socket
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.utils import six
+from django.utils.http import int_to_base36
+from django.utils.six.moves import http_client
+from django.utils.six.moves import xmlrpc_client
+from django.utils.timezone import now
+
+from xmpp_backends.base import BackendError
+from xmpp_backends.base import UserExists
+from xmpp_backends.base import UserNotFound
+from xmpp_backends.ejabberdctl import EjabberdctlBackend as BaseEjabberdctlBackend
+
+from backends.ejabberdctl import EjabberdctlBackend
+from backends.ejabberdctl import PersistentEjabberdctlBackend
+from backends.timeouts import deadline
+from backends.transport import PooledTransport
+from core import bloom
+from core import confirmations
+from core import ratelimit
+from core import singleflight
+from core import tasks
+from core import backend as guarded_backend
+from core.backend import GuardedBackend
+from core.blocklist import BlockList
+from core.blocklist import RedisBlockList
+from core.blocklist import whitelist
+from core.bloom import KeyFilter
+from core.bloom import UserFilter
+from core.confirmations import DatabaseStore
+from core.confirmations import RedisStore
+from core.confirmations import TokenStore
+from core.constants import BACKEND_STATUS_DONE
+from core.constants import BACKEND_STATUS_FAILED
+from core.exceptions import BackendUnavailable
+from core.executor import BoundedExecutor
+from core.management.commands import backend_stats
+from core.ipindex import IPIndex
+from core.ipindex import get_network
+from core.ipindex import load_networks
+from core.ipindex import parse_address
+from core.ipindex import parse_network
+from core.mail import smtp_pool
+from core.models import Confirmation
+from core.models import Outbox
+from core.outbox import dispatch
+from core.outbox import drain
+from core.outbox import enqueue
+from core.ratelimit import CacheTokenBucketStore
+from core.ratelimit import LocMemTokenBucketStore
+from core.ratelimit import RequestRateLimiter
+from core.ratelimit import SlidingWindowLimiter
+from core.ratelimit import parse_rate
+from core.singleflight import SingleFlight
+from core.sites import SiteIndex
+from core.routers import EmailRouter
+
+from core.testutils import DOMAIN
+from core.testutils import BackendTestCase
+from core.testutils import FakeBackend
+from core.testutils import FakeRedis
+from core.testutils import FixtureMixin
+from core.testutils import XMLRPCServer
+from core.testutils import override_hosts
+from xmpp_accounts.constants import PURPOSE_DELETE
+from xmpp_accounts.constants import PURPOSE_REGISTER
+from xmpp_accounts.constants import PURPOSE_SET_EMAIL
+from xmpp_accounts.constants import PURPOSE_SET_PASSWORD
+from xmpp_accounts.constants import REGISTRATION_WEBSITE
+
+User = get_user_model()
+
+
+class SlidingWindowLimiterTestCase(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.limiter = SlidingWindowLimiter({
+            timedelta(minutes=2): 1,
+            timedelta(hours=1): 2,
+        })
+
+    def test_hit(self):
+        self.assertTrue(self.limiter.hit('a'))
+        self.assertFalse(self.limiter.hit('a'))
+        self.assertTrue(self.limiter.hit('b'))
+
+    def test_allowed(self):
+        now = time.time()
+        self.assertTrue(self.limiter.allowed([], now))
+        self.assertFalse(self.limiter.allowed([now - 60], now))
+        self.assertTrue(self.limiter.allowed([now - 180], now))
+        self.assertFalse(self.limiter.allowed([now - 600, now - 180], now))
+
+    def test_expired_hits(self):
+        # Hits older than the longest window are dropped
+        caches['default'].set('xmppaccount:ratelimit:a', [time.time() - 7200] * 5)
+        self.assertTrue(self.limiter.hit('a'))
+        self.assertEqual(len(caches['default'].get('xmppaccount:ratelimit:a')), 1)
+
+
+class RequestRateLimiterTestCase(FixtureMixin, SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('15/m'), (15, 0.25))
+        self.assertEqual(parse_rate('2/s'), (2, 2.0))
+        self.assertEqual(parse_rate('24/day'), (24, 24.0 / 86400))
+
+    def assertLimits(self, store):
+        limiter = RequestRateLimiter('test', {'get': '2/m', 'POST': '1/m'}, store=store)
+        self.assertFalse(limiter.limited('GET', '127.0.0.1'))
+        self.assertFalse(limiter.limited('GET', '127.0.0.1'))
+        self.assertTrue(limiter.limited('GET', '127.0.0.1'))
+
+        # Methods and clients have their own buckets, methods without a rate are not limited
+        self.assertFalse(limiter.limited('POST', '127.0.0.1'))
+        self.assertTrue(limiter.limited('POST', '127.0.0.1'))
+        self.assertFalse(limiter.limited('GET', '127.0.0.2'))
+        self.assertFalse(limiter.limited('PUT', '127.0.0.1'))
+
+    def test_locmem(self):
+        self.assertLimits(LocMemTokenBucketStore())
+
+    def test_cache(self):
+        self.assertLimits(CacheTokenBucketStore())
+
+        # The buckets are stored in the cache, so all processes see the same buckets
+        limiter = RequestRateLimiter('test', {'GET': '2/m'}, store=CacheTokenBucketStore())
+        self.assertTrue(limiter.limited('GET', '127.0.0.1'))
+
+    def test_setting(self):
+        self.patch(ratelimit, '_token_bucket_store', None)
+        with override_settings(RATELIMIT_STORE='core.ratelimit.LocMemTokenBucketStore'):
+            self.assertIsInstance(RequestRateLimiter('test', {}).store, LocMemTokenBucketStore)
+
+        ratelimit._token_bucket_store = None
+        with override_settings(RATELIMIT_STORE=None):
+            self.assertIsInstance(RequestRateLimiter('test', {}).store, CacheTokenBucketStore)
+
+        ratelimit._token_bucket_store = None
+        with override_settings(RATELIMIT_STORE='core.ratelimit.RedisTokenBucketStore'):
+            with self.assertRaises(ImproperlyConfigured):
+                RequestRateLimiter('test', {})
+
+
+class RedisBlockListTestCase(FixtureMixin, SimpleTestCase):
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+        self.client = FakeRedis()
+
+        # The locmem cache does not implement the django-redis API used to migrate old blocks
+        self.old_keys = []
+        self.patch(self.cache, 'iter_keys', lambda pattern: iter(self.old_keys))
+        self.patch(self.cache, 'ttl', lambda key: 60)
+
+    def blocklist(self):
+        return RedisBlockList(self.client, interval=0)
+
+    def test_block(self):
+        blocklist = self.blocklist()
+        other = self.blocklist()  # e.g. in another WSGI process
+        self.assertIsNone(other.get('192.0.2.1'))
+
+        blocklist.block('192.0.2.1', 'spam', 60)
+        self.assertEqual(blocklist.get('192.0.2.1'), 'spam')
+        self.assertEqual(other.get('192.0.2.1'), 'spam')
+        self.assertIsNone(other.get('192.0.2.2'))
+
+    def test_migrate(self):
+        self.old_keys = ['spamblock-192.0.2.1', 'spamblock-192.0.2.2/32']
+        self.cache.set('spamblock-192.0.2.1', 'old spam')
+
+        blocklist = self.blocklist()
+        self.assertEqual(blocklist.get('192.0.2.1'), 'old spam')
+        self.assertEqual(self.cache.get('spamblock-192.0.2.1/32'), 'old spam')
+        self.assertIsNone(self.cache.get('spamblock-192.0.2.1'))
+
+        # Old blocks are only migrated once
+        self.cache.set('spamblock-192.0.2.1', 'old spam')
+        self.blocklist().get('192.0.2.3')
+        self.assertEqual(self.cache.get('spamblock-192.0.2.1'), 'old spam')
+
+    def test_missing_version(self):
+        self.blocklist().block('192.0.2.1', 'spam', 60)
+        self.client.delete(RedisBlockList.version_key)  # e.g. evicted
+
+        # A new process still loads blocked hosts
+        self.assertEqual(self.blocklist().get('192.0.2.1'), 'spam')
+
+    def test_expired(self):
+        self.client.hset(RedisBlockList.index_key, '192.0.2.1/32', time.time() - 1)
+        self.client.incr(RedisBlockList.version_key)
+        caches['default'].set('spamblock-192.0.2.1/32', 'spam')
+
+        self.assertIsNone(self.blocklist().get('192.0.2.1'))
+        self.assertEqual(self.client.hgetall(RedisBlockList.index_key), {})
+
+
+class BlockListTestCase(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    @override_settings(SPAM_BLOCK_IPV4_PREFIX=24, SPAM_BLOCK_IPV6_PREFIX=64)
+    def test_block_network(self):
+        blocklist = BlockList()
+        blocklist.block('192.0.2.1', 'spam', 60)
+        blocklist.block('2001:db8::1', 'spam6', 60)
+
+        self.assertEqual(blocklist.get('192.0.2.200'), 'spam')
+        self.assertIsNone(blocklist.get('192.0.3.1'))
+        self.assertEqual(blocklist.get('2001:db8::ffff'), 'spam6')
+        self.assertIsNone(blocklist.get('2001:db8:0:1::1'))
+
+    def test_old_blocks(self):
+        # Blocks stored by older versions use the plain address
+        caches['default'].set('spamblock-192.0.2.1', 'old spam')
+        self.assertEqual(BlockList().get('192.0.2.1'), 'old spam')
+
+    @override_settings(SPAM_BLOCK_NETWORKS={'198.51.100.0/24'})
+    def test_networks(self):
+        self.assertEqual(BlockList().get('198.51.100.1'), BlockList.message)
+        self.assertIsNone(BlockList().get('198.51.101.1'))
+
+    @override_settings(RATELIMIT_WHITELIST={'192.0.2.0/24'})
+    def test_whitelist(self):
+        blocklist = BlockList()
+        blocklist.block('192.0.2.1', 'spam', 60)
+        self.assertIsNone(blocklist.get('192.0.2.1'))
+        self.assertIn('192.0.2.1', whitelist)
+
+        with self.settings(RATELIMIT_WHITELIST=set()):
+            self.assertNotIn('192.0.2.1', whitelist)
+
+
+class IPIndexTestCase(SimpleTestCase):
+    def test_parse_address(self):
+        self.assertEqual(parse_address('192.0.2.1'), (4, 0xc0000201))
+        self.assertEqual(parse_address('::1'), (6, 1))
+        for address in ['192.0.2', '192.0.2.256', 'example.com', '::g']:
+            with self.assertRaises(ValueError):
+                parse_address(address)
+
+    def test_parse_network(self):
+        self.assertEqual(parse_network('192.0.2.77/24'), (4, 0xc0000200, 24))
+        self.assertEqual(parse_network(' 192.0.2.1 '), (4, 0xc0000201, 32))
+        self.assertEqual(parse_network('2001:db8::/32'), (6, 0x20010db8 << 96, 32))
+        for network in ['192.0.2.0/33', '192.0.2.0/x', '2001:db8::/129']:
+            with self.assertRaises(ValueError):
+                parse_network(network)
+
+    def test_get_network(self):
+        self.assertEqual(get_network('192.0.2.77'), '192.0.2.77/32')
+        self.assertEqual(get_network('192.0.2.77', 24), '192.0.2.0/24')
+        self.assertEqual(get_network('2001:db8::1', 24, 64), '2001:db8::/64')
+
+    def test_lookup(self):
+        index = IPIndex()
+        index.add('192.0.2.0/24', 'net')
+        index.add('192.0.2.128/25', 'subnet')
+        index.add('2001:db8::/32', 'net6')
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.lookup('192.0.2.1'), 'net')
+        self.assertEqual(index.lookup('192.0.2.200'), 'subnet')  # most specific network
+        self.assertEqual(index.lookup('2001:db8::1'), 'net6')
+        self.assertIsNone(index.lookup('192.0.3.1'))
+        self.assertEqual(index.lookup('not an address', 'default'), 'default')
+
+        self.assertIn('192.0.2.1', IPIndex(['0.0.0.0/0']))
+        self.assertNotIn('::1', IPIndex(['0.0.0.0/0']))
+
+    def test_load_networks(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as stream:
+            stream.write('# comment\n192.0.2.0/24\n\n2001:db8::1  # host\n')
+            stream.flush()
+            self.assertEqual(load_networks(stream.name), ['192.0.2.0/24', '2001:db8::1'])
+
+
+class SiteIndexTestCase(SimpleTestCase):
+    hosts = {
+        'example.com': {'BRAND': 'Example'},
+        'example.org': {},
+    }
+    mapping = {
+        'example.com': 'example.com',
+        'Account.Example.Org:8000': 'example.org',
+        '*.example.net': 'example.org',
+    }
+
+    def setUp(self):
+        self.index = SiteIndex(self.hosts, self.mapping, 'example.com')
+
+    def test_get(self):
+        self.assertEqual(self.index.get('example.com')['DOMAIN'], 'example.com')
+        self.assertEqual(self.index.get('example.com:8000')['DOMAIN'], 'example.com')
+        self.assertEqual(self.index.get('account.example.org')['DOMAIN'], 'example.org')
+        self.assertEqual(self.index.get('a.b.EXAMPLE.net')['DOMAIN'], 'example.org')
+        self.assertEqual(self.index.get('example.net')['DOMAIN'], 'example.com')  # default
+        self.assertEqual(self.index.get('[::1]:8000')['DOMAIN'], 'example.com')
+
+        # The same (precomputed) instance is returned every time
+        self.assertIs(self.index.get('example.com'), self.index.get('EXAMPLE.com'))
+
+    def test_defaults(self):
+        site = self.index.get('example.com')
+        self.assertEqual(site['BRAND'], 'Example')
+        self.assertEqual(site['HOMEPAGE'], 'https://example.com')
+        self.assertEqual(self.index.get('account.example.org')['BRAND'],
+                         settings.BRAND or 'example.org')
+
+    def test_readonly(self):
+        site = self.index.get('example.com')
+        with self.assertRaises(TypeError):
+            site['BRAND'] = 'Changed'
+        with self.assertRaises(TypeError):
+            site.update(BRAND='Changed')
+        self.assertEqual(json.loads(json.dumps(site)), dict(site))
+        self.assertEqual(pickle.loads(pickle.dumps(site)), site)
+
+    def test_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SiteIndex(self.hosts, self.mapping, 'example.net')
+        with self.assertRaises(ImproperlyConfigured):
+            SiteIndex(self.hosts, {'example.net': 'example.net'}, 'example.com')
+
+
+class UserFilterTestCase(BackendTestCase):
+    def setUp(self):
+        super(UserFilterTestCase, self).setUp()
+        self.filter = UserFilter(FakeRedis(), capacity=1000, error_rate=0.001)
+        self.filter.rebuild(DOMAIN, {'alice@%s' % DOMAIN})
+        self.patch(bloom, '_user_filter', self.filter)
+
+    def test_might_exist(self):
+        jids = ['alice@%s' % DOMAIN, 'Alice@%s' % DOMAIN.upper(), 'bob@%s' % DOMAIN,
+                'invalid', 'bob@unknown.example']
+        self.assertEqual(self.filter.might_exist(jids), {
+            'alice@%s' % DOMAIN, 'Alice@%s' % DOMAIN.upper(),
+            'bob@unknown.example',  # no filter for this domain
+        })
+
+    def test_add(self):
+        self.filter.add('Bob@%s' % DOMAIN)
+        self.filter.add('invalid')
+        self.assertEqual(self.filter.might_exist(['bob@%s' % DOMAIN]), {'bob@%s' % DOMAIN})
+
+    @override_settings(USER_FILTER=True)
+    def test_register(self):
+        self.backend.existing.add('alice@%s' % DOMAIN)
+        response = self.post('xmpp_accounts:register', {
+            'username_0': 'Alice', 'username_1': DOMAIN, 'email': 'alice@example.net',
+        })
+        self.assertFormError(response, 'form', 'username', 'User already exists.')
+        self.assertEqual(self.backend.calls, ['user_exists'])
+
+        # Users that certainly do not exist are not looked up
+        response = self.post('xmpp_accounts:register', {
+            'username_0': 'Bob', 'username_1': DOMAIN, 'email': 'bob@example.net',
+        })
+        self.assertEqual(response.context['form'].errors, {})
+        self.assertEqual(self.backend.calls, ['user_exists'])
+
+
+class SingleFlightTestCase(FixtureMixin, SimpleTestCase):
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+        self.client = self.fake_redis(singleflight, backend_stats)
+
+    def test_coalesce(self):
+        flight = SingleFlight('test')
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            started.set()
+            release.wait(5)
+            return value
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', func, 1)))]
+        threads[0].start()
+        started.wait(5)
+        for i in range(3):
+            thread = threading.Thread(target=lambda: results.append(flight.do('key', func, 2)))
+            threads.append(thread)
+            thread.start()
+        while flight.shared < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1, 1, 1, 1])
+        self.assertEqual(flight.stats(), {'calls': 1, 'shared': 3, 'remote_shared': 0})
+        self.assertEqual(flight.saved, 3)
+
+        # Once the call is done, the next call calls the function again
+        self.assertEqual(flight.do('key', func, 2), 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_exception(self):
+        flight = SingleFlight('test')
+
+        def func():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', func)
+        self.assertEqual(flight.pending, {})
+
+    def test_remote(self):
+        flight = SingleFlight('test', lock_timeout=5, poll_interval=0.01)
+        self.assertEqual(flight.do('key', lambda: 'leader'), 'leader')
+        self.assertIsNone(self.cache.get('test-lock-key'))
+
+        # Another process holds the lock and stores its result
+        self.cache.set('test-result-key', 'remote')
+        self.cache.add('test-lock-key', 1)
+        self.assertEqual(flight.do('key', lambda: 'local'), 'remote')
+        self.assertEqual(flight.stats(), {'calls': 1, 'shared': 0, 'remote_shared': 1})
+
+    def test_remote_failure(self):
+        flight = SingleFlight('test', lock_timeout=5, poll_interval=0.01)
+
+        # The other process fails and releases the lock without storing a result
+        self.cache.add('test-lock-key', 1)
+        threading.Timer(0.05, self.cache.delete, ('test-lock-key', )).start()
+
+        start = time.time()
+        self.assertEqual(flight.do('key', lambda: 'local'), 'local')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(flight.stats(), {'calls': 1, 'shared': 0, 'remote_shared': 0})
+
+    def test_flush(self):
+        flight = SingleFlight('test', flush_interval=0)
+        flight.do('key', lambda: None)
+        flight.shared = 2
+        flight.flush()
+        self.assertEqual(self.client.hgetall('xmppaccount:singleflight:test'),
+                         {b'calls': b'1', b'shared': b'2'})
+
+        # Only the difference to the last flush is added, the next call flushes automatically
+        flight.do('key', lambda: None)
+        flight.do('key', lambda: None)
+        self.assertEqual(self.client.hgetall('xmppaccount:singleflight:test'),
+                         {b'calls': b'2', b'shared': b'2'})
+
+    def test_backend_stats(self):
+        self.client.hincrby('xmppaccount:singleflight:exists', 'calls', 3)
+        self.client.hincrby('xmppaccount:singleflight:exists', 'shared', 2)
+        self.client.hincrby('xmppaccount:singleflight:exists', 'remote_shared', 1)
+
+        stdout = six.StringIO()
+        call_command('backend_stats', reset=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(),
+                         'exists: 3 calls made, 3 saved (2 in-process, 1 remote)\n')
+        self.assertEqual(self.client.data, {})
+
+
+class ReconcileUsersTestCase(BackendTestCase):
+    def setUp(self):
+        super(ReconcileUsersTestCase, self).setUp()
+        self.patch(tasks, 'backend', self.backend)
+
+    def test_reconcile(self):
+        self.backend.existing = set(['user%s@%s' % (i, DOMAIN) for i in range(100)])
+        self.backend.existing |= {'mixed@%s' % DOMAIN, 'existing@%s' % DOMAIN}
+
+        old = now() - settings.CONFIRMATION_TIMEOUT - timedelta(days=1)
+        for jid in ['Mixed@%s' % DOMAIN, 'existing@%s' % DOMAIN, 'gone@%s' % DOMAIN]:
+            User.objects.create(jid=jid, registration_method=REGISTRATION_WEBSITE)
+        User.objects.exclude(jid=self.user.jid).update(registered=old)
+
+        tasks.reconcile_users()
+
+        jids = set(User.objects.values_list('jid', flat=True))
+        self.assertEqual(len(jids), 103)
+        self.assertIn('Mixed@%s' % DOMAIN, jids)  # not deleted or created again in lowercase
+        self.assertIn('existing@%s' % DOMAIN, jids)
+        self.assertIn('user0@%s' % DOMAIN, jids)
+        self.assertIn(self.user.jid, jids)  # registered recently
+        self.assertNotIn('gone@%s' % DOMAIN, jids)
+
+
+class PooledTransportTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = XMLRPCServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.transport = PooledTransport(timeout=5)
+        self.proxy = xmlrpc_client.ServerProxy(
+            'http://127.0.0.1:%s' % self.server.server_address[1], transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.proxy.create_user('user%s' % i), 0)
+        self.assertEqual(self.server.calls, ['user0', 'user1', 'user2'])
+        self.assertEqual((self.transport.created, self.transport.reused), (1, 2))
+        self.assertEqual(len(self.transport.idle), 1)
+
+    def test_closed_idle_connection(self):
+        self.server.close = True
+        self.proxy.create_user('user0')
+        time.sleep(0.1)  # let the connection close
+
+        self.proxy.create_user('user1')
+        self.assertEqual(self.server.calls, ['user0', 'user1'])
+        self.assertEqual((self.transport.created, self.transport.reused), (2, 0))
+
+    def test_no_retry(self):
+        self.proxy.create_user('user0')
+
+        # The server executes the call on the reused connection but fails to respond
+        self.server.drop = True
+        with self.assertRaises((socket.error, http_client.HTTPException)):
+            self.proxy.create_user('user1')
+        self.assertEqual(self.server.calls, ['user0', 'user1'])
+        self.assertEqual(self.transport.idle, [])
+
+    def test_deadline(self):
+        self.proxy.create_user('user0')
+
+        self.server.delay = 1
+        with deadline(0.1), self.assertRaises(socket.timeout):
+            self.proxy.create_user('user1')
+        self.assertEqual(self.transport.idle, [])  # the connection is not reused
+
+
+class PersistentEjabberdctlTestCase(FixtureMixin, SimpleTestCase):
+    fake_ejabberdctl = os.path.join(settings.BASE_DIR, 'files', 'ejabberdctl', 'fake-ejabberdctl')
+
+    def setUp(self):
+        self.backend = PersistentEjabberdctlBackend(worker=[self.fake_ejabberdctl, '--worker'],
+                                                    timeout=5)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def get_worker(self):
+        worker = self.backend.workers.get()
+        self.backend.workers.put(worker)
+        return worker
+
+    def test_operations(self):
+        self.assertFalse(self.backend.user_exists('user', DOMAIN))
+        pid = self.get_worker().proc.pid
+        self.backend.create_user('user', DOMAIN, 'password')
+        with self.assertRaises(UserExists):
+            self.backend.create_user('user', DOMAIN, 'password')
+
+        self.assertTrue(self.backend.user_exists('user', DOMAIN))
+        self.assertTrue(self.backend.check_password('user', DOMAIN, 'password'))
+        self.assertFalse(self.backend.check_password('user', DOMAIN, 'wrong'))
+        self.assertEqual(self.get_worker().proc.pid, pid)  # all commands used the same worker
+
+    def test_restart(self):
+        self.backend.create_user('user', DOMAIN, 'password')
+        worker = self.get_worker()
+        pid = worker.proc.pid
+        worker.proc.kill()
+        worker.proc.wait()
+
+        # The new worker has a new state, as the fake ejabberdctl stores users in memory
+        self.assertFalse(self.backend.user_exists('user', DOMAIN))
+        self.assertNotEqual(worker.proc.pid, pid)
+
+    def test_init_runs_commands(self):
+        # Newer versions of xmpp-backends run "ejabberdctl status" in the constructor
+        init = BaseEjabberdctlBackend.__init__
+
+        def __init__(backend, *args, **kwargs):
+            init(backend, *args, **kwargs)
+            backend.ctl('status')
+
+        self.patch(BaseEjabberdctlBackend, '__init__', __init__)
+        backend = PersistentEjabberdctlBackend(worker=[self.fake_ejabberdctl, '--worker'])
+        self.assertEqual(backend.calls, 1)
+        backend.close()
+
+    def test_timeout(self):
+        backend = PersistentEjabberdctlBackend(worker=['sleep', '10'], timeout=0.1)
+        with six.assertRaisesRegex(self, BackendError, 'timed out'):
+            backend.user_exists('user', DOMAIN)
+        self.assertIsNone(backend.workers.get().proc)
+
+
+class GuardedBackendTestCase(FixtureMixin, SimpleTestCase):
+    fake_ejabberdctl = PersistentEjabberdctlTestCase.fake_ejabberdctl
+
+    def setUp(self):
+        self.client = self.fake_redis(guarded_backend)
+
+    def test_deadline(self):
+        guarded = GuardedBackend(PersistentEjabberdctlBackend(worker=['sleep', '10']),
+                                 timeout=0.1, timeouts={'check_password': 5})
+        threads = threading.active_count()
+        start = time.time()
+        with self.assertRaises(BackendUnavailable):
+            guarded.user_exists('user', DOMAIN)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(threading.active_count(), threads)
+
+        # The worker was killed, so the call does not continue in the background
+        worker = guarded.backend.workers.get()
+        self.assertIsNone(worker.proc)
+        self.assertEqual(worker.timeout, 10)
+
+    def test_subprocess_timeout(self):
+        guarded = GuardedBackend(EjabberdctlBackend(path=self.fake_ejabberdctl), timeout=0.1)
+        os.environ['FAKE_EJABBERDCTL_DELAY'] = '5'
+        try:
+            start = time.time()
+            with self.assertRaises(BackendUnavailable):
+                guarded.user_exists('user', DOMAIN)
+            self.assertLess(time.time() - start, 2)
+        finally:
+            del os.environ['FAKE_EJABBERDCTL_DELAY']
+
+        # Starting the process alone may take longer than 0.1 seconds
+        guarded.timeout = 10
+        self.assertFalse(guarded.user_exists('user', DOMAIN))
+
+    def test_circuit_breaker(self):
+        guarded = GuardedBackend(FakeBackend(), threshold=2, reset_timeout=60)
+        guarded.backend.set_password = lambda *args: 1 / 0
+
+        for i in range(2):
+            with self.assertRaises(ZeroDivisionError):
+                guarded.set_password('user', DOMAIN, 'password')
+        with self.assertRaises(BackendUnavailable):
+            guarded.user_exists('user', DOMAIN)
+        self.assertEqual(guarded.backend.calls, [])
+
+    def test_histograms(self):
+        guarded = GuardedBackend(FakeBackend(), flush_interval=60)
+        for i in range(3):
+            guarded.user_exists('user', DOMAIN)
+        self.assertEqual(guarded.stats()['user_exists']['count'], 3)
+
+        # Latencies are only added to Redis in batches
+        self.assertEqual(self.client.data, {})
+        guarded.flush()
+        histogram = self.client.hgetall('xmppaccount:backend-latency:user_exists')
+        self.assertEqual(histogram[b'0.005'], b'3')
+        self.assertLess(float(histogram[b'sum']), 0.015)
+
+        guarded.flush_interval = 0
+        guarded.user_exists('user', DOMAIN)
+        histogram = self.client.hgetall('xmppaccount:backend-latency:user_exists')
+        self.assertEqual(histogram[b'0.005'], b'4')
+
+
+class BackendOperationsTestCase(BackendTestCase):
+    def setUp(self):
+        super(BackendOperationsTestCase, self).setUp()
+        self.patch(tasks, 'backend', self.backend)
+
+        self.user.confirmed = now()
+        self.user.save()
+        self.operations = [
+            ('create_user', {'username': 'user', 'domain': DOMAIN, 'password': 'foobar123'}),
+            ('set_email', {'username': 'user', 'domain': DOMAIN, 'email': 'user@example.net'}),
+        ]
+
+    def run_task(self, retries=0):
+        return tasks.backend_operations.apply(
+            kwargs={'operations': self.operations, 'token': 'abc'}, retries=retries)
+
+    def test_operations(self):
+        self.run_task()
+        self.assertEqual(self.backend.calls, ['create_user', 'set_email'])
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_DONE)
+
+    def test_retry(self):
+        # create_user succeeded in a previous attempt
+        caches['default'].set('xmppaccount:backend-done:abc', 1)
+        self.run_task(retries=1)
+        self.assertEqual(self.backend.calls, ['set_email'])
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_DONE)
+
+    def test_failed(self):
+        def fail():
+            raise BackendUnavailable('down')
+        self.backend.hook = fail
+
+        self.run_task(retries=tasks.backend_operations.max_retries)
+        self.assertEqual(self.backend.calls, ['create_user'])
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_FAILED)
+
+        # The registration was rolled back, so the user can register again
+        self.assertFalse(User.objects.filter(jid=self.user.jid).exists())
+
+    def test_user_exists(self):
+        def exists():
+            raise UserExists()
+        self.backend.hook = exists
+
+        # Someone else registered the username in the meantime (e.g. via in-band registration)
+        self.run_task()
+        self.assertEqual(self.backend.calls, ['create_user'])
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_FAILED)
+        self.assertFalse(User.objects.filter(jid=self.user.jid).exists())
+
+    def test_user_exists_retry(self):
+        def exists():
+            raise UserExists()
+        self.backend.hook = exists
+
+        # A previous attempt created the user but failed afterwards
+        self.run_task(retries=1)
+        self.assertEqual(self.backend.calls, ['create_user', 'set_email'])
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_DONE)
+        self.assertTrue(User.objects.filter(jid=self.user.jid).exists())
+
+    def test_failed_set_email(self):
+        def fail():
+            raise UserNotFound()
+        self.operations = self.operations[1:]
+        self.backend.hook = fail
+
+        self.run_task()
+        self.assertEqual(tasks.get_backend_status('abc'), BACKEND_STATUS_FAILED)
+        self.assertTrue(User.objects.filter(jid=self.user.jid).exists())
+
+        response = self.get('xmpp_accounts:status', token='abc')
+        self.assertContains(response, 'could not be applied')
+
+
+class TokenStoreTestCase(BackendTestCase):
+    def setUp(self):
+        super(TokenStoreTestCase, self).setUp()
+        self.store = TokenStore()
+        self.patch(confirmations, '_store', self.store)
+
+    def test_lookup(self):
+        key = self.store.create(self.user, PURPOSE_SET_EMAIL, '{"email": "new@example.net"}')
+        confirmation = self.store.valid().purpose(PURPOSE_SET_EMAIL).get(key=key.key)
+        self.assertEqual(confirmation.user, self.user)
+        self.assertEqual(confirmation.payload, '{"email": "new@example.net"}')
+        self.assertEqual(confirmation.created, key.created)
+
+    def test_signature(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}').key
+        value, signature = key.rsplit('_', 1)
+        other_user = int_to_base36(self.user.pk + 1)
+
+        for invalid in [
+            '%s_%s' % (value, signature[::-1]),
+            '%s_%s' % (value.replace(PURPOSE_DELETE, PURPOSE_REGISTER), signature),
+            '%s_%s' % (value.replace(int_to_base36(self.user.pk), other_user, 1), signature),
+            value,
+            'abc',
+        ]:
+            with self.assertRaises(Confirmation.DoesNotExist):
+                self.store.get(key=invalid)
+
+        # The purpose is part of the key
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.purpose(PURPOSE_REGISTER).get(key=key)
+
+    def test_expired(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}').key
+        with override_settings(CONFIRMATION_TIMEOUT=timedelta(0)):
+            with self.assertRaises(Confirmation.DoesNotExist):
+                self.store.valid().get(key=key)
+            self.assertEqual(self.store.get(key=key).user, self.user)
+
+    def test_single_use(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+        key.delete()
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.get(key=key.key)
+
+    def test_deleted_user(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}').key
+        self.user.delete()
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.valid().get(key=key)
+
+        response = self.post('xmpp_accounts:delete_confirm', {'password': 'foobar123'}, key=key)
+        self.assertFormError(response, 'form', None, 'Confirmation key expired or not found.')
+        self.assertEqual(self.backend.calls, [])
+
+
+class RedisStoreTestCase(BackendTestCase):
+    def setUp(self):
+        super(RedisStoreTestCase, self).setUp()
+        self.client = self.fake_redis(confirmations)
+        self.client.scripts[confirmations._UPDATE_PAYLOAD_SCRIPT] = self.update_payload
+        self.store = RedisStore()
+
+    def update_payload(self, key, payload):
+        if key in self.client.data:
+            self.client.hset(key, 'payload', payload)
+
+    def test_create(self):
+        key = self.store.create(self.user, PURPOSE_SET_EMAIL, '{"email": "new@example.net"}')
+        redis_key = 'xmppaccount:confirmation:%s' % key.key
+        self.assertEqual(self.client.ttls[redis_key],
+                         int(settings.CONFIRMATION_TIMEOUT.total_seconds()))
+
+        # Stored as an integer, because redis-py converts floats with str() on Python 2
+        created = int(self.client.hgetall(redis_key)[b'created'])
+        self.assertEqual(created % 1000000, key.created.microsecond)
+
+        confirmation = self.store.valid().purpose(PURPOSE_SET_EMAIL).get(key=key.key)
+        self.assertEqual(confirmation.user, self.user)
+        self.assertEqual(confirmation.payload, '{"email": "new@example.net"}')
+        self.assertEqual(confirmation.created, key.created)
+        self.assertEqual(list(self.store.valid_keys()), [key.key])
+
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.purpose(PURPOSE_REGISTER).get(key=key.key)
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.get(key='unknown')
+
+    def test_expired(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}').key
+        with override_settings(CONFIRMATION_TIMEOUT=timedelta(0)):
+            with self.assertRaises(Confirmation.DoesNotExist):
+                self.store.valid().get(key=key)
+
+    def test_save(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+        key.payload = '{"sent": true}'
+        key.save()
+        self.assertEqual(self.store.get(key=key.key).payload, '{"sent": true}')
+
+        # Saving a confirmation that is gone does not create it again
+        key.delete()
+        key.save()
+        self.assertEqual(self.client.data, {})
+
+    def test_claim(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+        confirmation = self.store.valid().get(key=key.key)
+        self.assertTrue(self.store.claim(confirmation))
+        self.assertFalse(self.store.claim(self.store.instance(key=key.key)))
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.get(key=key.key)
+
+        # A released key expires when it would have expired anyway
+        self.store.release(confirmation)
+        redis_key = 'xmppaccount:confirmation:%s' % key.key
+        self.assertLessEqual(self.client.ttls[redis_key],
+                             int(settings.CONFIRMATION_TIMEOUT.total_seconds()))
+        self.assertEqual(self.store.get(key=key.key).created, key.created)
+
+    def test_deleted_user(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}').key
+        self.user.delete()
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.valid().get(key=key)
+
+
+class KeyFilterTestCase(FixtureMixin, TransactionTestCase):
+    # Keys are added to the filter when the transaction is committed, so this test case needs
+    # real transactions.
+
+    def setUp(self):
+        self.client = FakeRedis()
+        self.client.scripts[bloom._BITFIELD_IF_EXISTS_SCRIPT] = self.bitfield_if_exists
+        self.filter = KeyFilter(self.client, capacity=1000, error_rate=0.001)
+        self.patch(bloom, '_key_filter', self.filter)
+
+        self.store = DatabaseStore()
+        self.user = User.objects.create(jid='user@%s' % DOMAIN, email='user@example.net',
+                                        registration_method=REGISTRATION_WEBSITE)
+
+    def bitfield_if_exists(self, key, *args):
+        if key in self.client.data:
+            return self.client.execute_command('BITFIELD', key, *args)
+
+    def test_filter(self):
+        # Until the filter is built, all keys might exist
+        self.assertTrue(self.filter.might_exist('unknown'))
+
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+        self.filter.rebuild(self.store.valid_keys())
+        self.assertTrue(self.filter.might_exist(key.key))
+        self.assertFalse(self.filter.might_exist('unknown'))
+        with self.assertRaises(Confirmation.DoesNotExist):
+            self.store.get(key='unknown')
+
+        # New keys are added, used keys are removed
+        new = self.store.create(self.user, PURPOSE_REGISTER, '{}')
+        self.assertTrue(self.filter.might_exist(new.key))
+        key.delete()
+        self.assertFalse(self.filter.might_exist(key.key))
+        self.assertEqual(self.filter.stats(), {'lookups': 6, 'rejected': 3, 'misses': 0})
+
+    def test_uncommitted_key(self):
+        self.filter.rebuild(iter([]))
+
+        with transaction.atomic():
+            key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+            self.assertFalse(self.filter.might_exist(key.key))  # not yet committed
+
+            # The filter is rebuilt while the transaction is still open, so the snapshot of valid
+            # keys does not include the new key.
+            self.filter.rebuild(iter([]))
+
+        self.assertTrue(self.filter.might_exist(key.key))
+        self.assertEqual(self.store.valid().get(key=key.key), key)
+
+    def test_rollback(self):
+        self.filter.rebuild(iter([]))
+        with self.assertRaises(ValueError), transaction.atomic():
+            key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+            raise ValueError()
+        self.assertFalse(self.filter.might_exist(key.key))
+
+    def test_save(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+        created = key.created
+        key.created = now() - timedelta(days=10)
+        key.payload = '{"sent": true}'
+        key.save(update_fields=['payload'])
+
+        confirmation = Confirmation.objects.get(pk=key.pk)
+        self.assertEqual(confirmation.payload, '{"sent": true}')
+        self.assertEqual(confirmation.created, created)
+
+
+@override_settings(EMAIL_OUTBOX=True)
+class OutboxTestCase(BackendTestCase):
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self.user.confirmed = now()
+        self.user.save()
+        self.store = DatabaseStore()
+        smtp_pool.close()
+
+    def tearDown(self):
+        smtp_pool.close()
+        super(OutboxTestCase, self).tearDown()
+
+    def enqueue(self):
+        key = self.store.create(self.user, PURPOSE_SET_PASSWORD, '{}')
+        return enqueue(key, uri='https://example.com/confirm/', site=DOMAIN, lang='en')
+
+    def test_request(self):
+        data = {'username_0': 'user', 'username_1': DOMAIN}
+        response = self.post('xmpp_accounts:password', data)
+        self.assertFalse(response.context['form'].errors)
+        self.assertEqual(len(mail.outbox), 0)
+
+        email = Outbox.objects.get()
+        self.assertTrue(Confirmation.objects.filter(key=email.key).exists())
+
+        self.assertEqual(drain(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(Outbox.objects.exists())
+
+    def test_batches(self):
+        for i in range(5):
+            self.enqueue()
+
+        with self.assertNumQueries(5):  # claim (3 queries), get keys, delete sent emails
+            self.assertEqual(dispatch(batch_size=3), 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+        self.assertEqual(drain(batch_size=3), 2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(Outbox.objects.exists())
+
+    def test_claimed(self):
+        self.enqueue()
+        # claimed by another dispatcher
+        Outbox.objects.update(next_attempt=now() + timedelta(seconds=60))
+        self.assertEqual(dispatch(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_used_key(self):
+        email = self.enqueue()
+        Confirmation.objects.filter(key=email.key).delete()
+
+        self.assertEqual(dispatch(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(Outbox.objects.exists())
+
+    @override_settings(EMAIL_BACKEND='core.testutils.FailingEmailBackend')
+    def test_retry(self):
+        self.enqueue()
+
+        self.assertEqual(dispatch(max_attempts=2), 1)
+        email = Outbox.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.dispatcher, '')
+        self.assertGreater(email.next_attempt, now())
+        self.assertEqual(dispatch(max_attempts=2), 0)  # not yet due
+
+        Outbox.objects.update(next_attempt=now())
+        self.assertEqual(dispatch(max_attempts=2), 1)
+        self.assertFalse(Outbox.objects.exists())  # gave up
+
+
+class BoundedExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.executor = BoundedExecutor(workers=1, queue_size=1)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.threads = []
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def job(self, name):
+        self.threads.append((name, threading.current_thread()))
+        self.started.set()
+        self.release.wait(5)
+
+    def test_submit(self):
+        self.release.set()
+        self.executor.submit(self.job, 'a')
+        self.executor.shutdown()
+        self.assertEqual(len(self.threads), 1)
+        self.assertNotEqual(self.threads[0][1], threading.current_thread())
+
+    def test_full_queue(self):
+        self.executor.submit(self.job, 'running')
+        self.started.wait(5)
+        self.executor.submit(self.job, 'queued')
+
+        # The queue is full, so the job is run in this thread right away
+        self.release.set()
+        self.executor.submit(self.job, 'inline')
+        self.assertEqual(self.threads[-1], ('inline', threading.current_thread()))
+
+        # Shutting down still runs the queued job
+        self.executor.shutdown()
+        self.assertEqual(sorted(name for name, thread in self.threads),
+                         ['inline', 'queued', 'running'])
+
+
+@override_hosts({'a.example': {}, 'b.example': {}, 'c.example': {}}, default='a.example')
+@override_settings(EMAIL_QUEUES=2)
+class EmailRouterTestCase(SimpleTestCase):
+    def route(self, task, site):
+        return EmailRouter().route_for_task(task, kwargs={'key': 'k', 'site': site})
+
+    def test_route(self):
+        self.assertEqual(self.route('core.tasks.send_email', 'a.example'),
+                         {'queue': 'email-0', 'routing_key': 'email-0'})
+        self.assertEqual(self.route('core.tasks.send_email', 'b.example')['queue'], 'email-1')
+        self.assertEqual(self.route('core.tasks.send_gpg_email', 'c.example')['queue'], 'gpg-0')
+        self.assertEqual(self.route('core.tasks.send_gpg_email', 'other.example')['queue'],
+                         'gpg-1')
+
+    def test_other_tasks(self):
+        self.assertIsNone(self.route('core.tasks.dispatch_outbox', 'a.example'))
+        self.assertIsNone(EmailRouter().route_for_task('core.tasks.send_email', args=('k', )))
+
+
+class EmailProgressTestCase(BackendTestCase):
+    def setUp(self):
+        super(EmailProgressTestCase, self).setUp()
+        self.queued = []
+        self.patch(Confirmation, 'should_use_gpg', lambda self, payload, site: True)
+        self.patch(Confirmation, 'msg_with_gpg',
+                   lambda self, site, frm, subject, text, html, payload: self.msg_without_gpg(
+                       subject, frm, self.user.email, text, html))
+        self.patch(tasks.send_gpg_email, 'delay', lambda **kwargs: self.queued.append(kwargs))
+        self.patch(tasks, 'GpgLock', contextmanager(lambda **kwargs: (yield)))
+
+    @override_settings(BROKER_URL='memory://')
+    def test_gpg(self):
+        store = DatabaseStore()
+        emails = [{'key': store.create(self.user, PURPOSE_SET_PASSWORD, '{}').key,
+                   'uri': 'https://example.com/confirm/', 'site': DOMAIN, 'lang': 'en'}
+                  for i in range(2)]
+        tasks.set_email_progress('token', 2)
+
+        # GPG emails are only counted once send_gpg_email is done
+        tasks.send_emails(emails, token='token')
+        self.assertEqual(tasks.get_email_progress('token'), (2, 0, 0))
+        self.assertEqual([kwargs['token'] for kwargs in self.queued], ['token', 'token'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        tasks.send_gpg_email(**self.queued[0])
+        self.assertEqual(tasks.get_email_progress('token'), (2, 1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+        Confirmation.objects.filter(key=self.queued[1]['key']).delete()
+        with self.assertRaises(Confirmation.DoesNotExist):
+            tasks.send_gpg_email(**self.queued[1])
+        self.assertEqual(tasks.get_email_progress('token'), (2, 1, 1))
+
+
+class ResendTestCase(BackendTestCase):
+    def setUp(self):
+        super(ResendTestCase, self).setUp()
+        self.users = [self.user] + [
+            User.objects.create(jid='user%s@%s' % (i, DOMAIN), email='user%s@example.net' % i,
+                                registration_method=REGISTRATION_WEBSITE)
+            for i in range(4)
+        ]
+        admin = User.objects.create(jid='admin@%s' % DOMAIN, email='admin@example.net',
+                                    registration_method=REGISTRATION_WEBSITE, is_admin=True)
+        self.client.force_login(admin)
+
+    def resend(self, action='resend_password_reset'):
+        return self.client.post(reverse('admin:core_registrationuser_changelist'), {
+            'action': action,
+            '_selected_action': [u.pk for u in self.users],
+        }, HTTP_USER_AGENT='test')
+
+    @override_settings(EMAIL_CHUNK_SIZE=2)
+    def test_resend(self):
+        # Confirmations are created with one query and looked up with one query per chunk
+        with self.assertNumQueries(11):
+            response = self.resend()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(u.email for u in self.users))
+        self.assertEqual(Confirmation.objects.purpose(PURPOSE_SET_PASSWORD).count(), 5)
+
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(response['Location'])
+        self.assertContains(response, '5 of 5 emails sent, 0 failed.')
+        self.assertContains(response, 'All emails have been processed.')
+
+    @override_settings(EMAIL_OUTBOX=True)
+    def test_outbox(self):
+        response = self.resend()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Outbox.objects.count(), 5)
+        self.assertEqual(len(mail.outbox), 0)
+        drain()
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_unknown_token(self):
+        response = self.client.get(reverse('admin:core_registrationuser_resend',
+                                           kwargs={'token': 'unknown'}))
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Fixtures shared by the tests of all apps of this project."""
+
+from __future__ import unicode_literals
+
+import fnmatch
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.signals import setting_changed
+from django.core.urlresolvers import reverse
+from django.dispatch import receiver
+from django.test import TestCase
+from django.test import override_settings
+from django.utils.six.moves import socketserver
+from django.utils.six.moves import xmlrpc_server
+
+from captcha.models import CaptchaStore
+
+from core.backend import backend
+from core.sites import sites
+from xmpp_accounts.constants import REGISTRATION_WEBSITE
+
+User = get_user_model()
+
+# Hosts used by all tests, so they do not depend on the XMPP_HOSTS in localsettings.py
+DOMAIN = 'example.com'
+XMPP_HOSTS = {
+    'example.com': {'REGISTRATION': True},
+    'example.net': {'MANAGE': False, 'EMAIL': True},  # used for email addresses
+}
+
+
+def override_hosts(hosts=XMPP_HOSTS, default=DOMAIN):
+    """Override ``XMPP_HOSTS`` and the settings derived from it in ``xmppaccount/settings.py``.
+
+    Note that the domain choices of forms are built when they are imported, so the hosts in
+    localsettings.py must still allow registration on :py:data:`DOMAIN`.
+    """
+
+    no_email = [k for k, v in hosts.items() if not v.get('EMAIL')]
+    blocked_tlds = set(settings.BLOCKED_EMAIL_TLDS) - set(settings.NO_EMAIL_HOSTS)
+
+    return override_settings(
+        XMPP_HOSTS=hosts,
+        XMPP_HOSTS_MAPPING={},
+        DEFAULT_XMPP_HOST=default,
+        MANAGED_HOSTS=[k for k, v in hosts.items() if v.get('MANAGE', True)],
+        RESERVATION_HOSTS=[k for k, v in hosts.items()
+                           if v.get('RESERVATION') and v.get('MANAGE', True)],
+        REGISTRATION_HOSTS=[k for k, v in hosts.items()
+                            if v.get('REGISTRATION') and v.get('MANAGE', True)],
+        NO_EMAIL_HOSTS=no_email,
+        BLOCKED_EMAIL_TLDS=blocked_tlds | set(no_email),
+    )
+
+
+@receiver(setting_changed)
+def reload_sites(setting, **kwargs):
+    # All settings are already changed when the signal is sent. The SiteIndex is updated in place,
+    # because other modules (e.g. the middleware) imported the instance.
+    if setting == 'XMPP_HOSTS':
+        sites.__init__(settings.XMPP_HOSTS, settings.XMPP_HOSTS_MAPPING,
+                       settings.DEFAULT_XMPP_HOST)
+
+
+class FixtureMixin(object):
+    """Mixin for test cases to replace attributes for the duration of a test."""
+
+    def patch(self, obj, name, value):
+        """Set the attribute ``name`` of ``obj`` to ``value`` until the test is done."""
+
+        if name in vars(obj):
+            self.addCleanup(setattr, obj, name, vars(obj)[name])
+        else:  # e.g. a method of a class
+            self.addCleanup(delattr, obj, name)
+        setattr(obj, name, value)
+
+    def fake_redis(self, *modules):
+        """Get a :py:class:`FakeRedis` returned by ``get_redis_client()`` of all ``modules``."""
+
+        client = FakeRedis()
+        for module in modules:
+            self.patch(module, 'get_redis_client', lambda: client)
+        return client
+
+
+class FakeBackend(object):
+    """Records all calls instead of talking to an XMPP server.
+
+    If ``hook`` is set, it is called (once) during the next call, e.g. to send another request
+    while the first one is still waiting for the XMPP server.
+    """
+
+    def __init__(self, password='foobar123'):
+        self.password = password
+        self.calls = []
+        self.hook = None
+        self.existing = set()  # JIDs that exist (lowercase)
+
+    def call(self, name):
+        self.calls.append(name)
+        if self.hook is not None:
+            hook, self.hook = self.hook, None
+            hook()
+
+    def check_password(self, username, domain, password):
+        self.call('check_password')
+        return password == self.password
+
+    def create_user(self, username, domain, password, email=None):
+        self.call('create_user')
+
+    def remove_user(self, username, domain):
+        self.call('remove_user')
+
+    def set_password(self, username, domain, password):
+        self.call('set_password')
+
+    def set_email(self, username, domain, email):
+        self.call('set_email')
+
+    def user_exists(self, username, domain):
+        self.call('user_exists')
+        return ('%s@%s' % (username, domain)).lower() in self.existing
+
+    def all_users(self, domain):
+        self.call('all_users')
+        return set(jid.split('@')[0] for jid in self.existing if jid.endswith('@%s' % domain))
+
+
+class CacheCounter(object):
+    """Context manager that records all operations on the default cache.
+
+    Operations called by other operations (e.g. ``get_many()`` calling ``get()``) are not counted.
+    """
+
+    operations = ('add', 'get', 'set', 'delete', 'get_many', 'set_many', 'delete_many', 'has_key',
+                  'incr', 'decr')
+
+    def __enter__(self):
+        self.cache = caches['default']
+        self.calls = []
+        self.depth = 0
+        for name in self.operations:
+            setattr(self.cache, name, self.wrap(name, getattr(self.cache, name)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for name in self.operations:
+            delattr(self.cache, name)
+
+    def wrap(self, name, func):
+        def wrapper(*args, **kwargs):
+            if self.depth == 0:
+                self.calls.append(name)
+            self.depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+
+class FakeRedis(object):
+    """In-memory stand-in for the few Redis commands used by the project.
+
+    Like Redis, values are returned as bytes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.scripts = {}  # Python implementations of Lua scripts
+
+    def encode(self, value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def decode(self, key):
+        return key.decode('utf-8') if isinstance(key, bytes) else key
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def incr(self, key, amount=1):
+        value = int(self.data.get(key, 0)) + amount
+        self.data[key] = self.encode(value)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = self.encode(value)
+
+    def exists(self, key):
+        return key in self.data
+
+    def delete(self, *keys):
+        keys = [self.decode(key) for key in keys]
+        for key in keys:
+            self.ttls.pop(key, None)
+        return len([self.data.pop(key) for key in keys if key in self.data])
+
+    def rename(self, src, dst):
+        self.data[dst] = self.data.pop(src)
+
+    def setbit(self, key, offset, value):
+        bits = bytearray(self.data.get(key, b''))
+        if len(bits) <= offset // 8:
+            bits += bytearray(offset // 8 + 1 - len(bits))
+        if value:
+            bits[offset // 8] |= 0x80 >> (offset % 8)
+        else:
+            bits[offset // 8] &= ~(0x80 >> (offset % 8)) & 0xff
+        self.data[key] = bytes(bits)
+
+    def getbit(self, key, offset):
+        bits = bytearray(self.data.get(key, b''))
+        if len(bits) <= offset // 8:
+            return 0
+        return 1 if bits[offset // 8] & (0x80 >> (offset % 8)) else 0
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[self.encode(field)] = self.encode(value)
+
+    def hgetall(self, key):
+        return dict(self.data.get(self.decode(key), {}))
+
+    def hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        return len([values.pop(self.encode(f)) for f in fields if self.encode(f) in values])
+
+    def hincrby(self, key, field, amount=1):
+        values = self.data.setdefault(key, {})
+        value = int(values.get(self.encode(field), 0)) + amount
+        values[self.encode(field)] = self.encode(value)
+        return value
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        values = self.data.setdefault(key, {})
+        value = float(values.get(self.encode(field), 0)) + amount
+        values[self.encode(field)] = self.encode(repr(value))
+        return value
+
+    def hmset(self, key, mapping):
+        for field, value in mapping.items():
+            self.hset(key, field, value)
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def keys(self, pattern):
+        return [k.encode('utf-8') for k in self.data if fnmatch.fnmatchcase(k, pattern)]
+
+    def scan_iter(self, match, count=None):
+        return iter(self.keys(match))
+
+    def setex(self, key, seconds, value):
+        self.set(key, value)
+        self.expire(key, seconds)
+
+    def execute_command(self, name, key, *args):
+        """Only supports ``BITFIELD`` with unsigned 4-bit fields that saturate on overflow."""
+
+        assert name == 'BITFIELD'
+        bits = bytearray(self.data.get(key, b''))
+        args = list(args)
+        result = []
+        while args:
+            op = args.pop(0)
+            if op == 'OVERFLOW':
+                assert args.pop(0) == 'SAT'
+                continue
+
+            assert args.pop(0) == 'u4'
+            offset = int(args.pop(0).lstrip('#'))
+            if len(bits) <= offset // 2:
+                bits += bytearray(offset // 2 + 1 - len(bits))
+            shift = 0 if offset % 2 else 4
+            value = (bits[offset // 2] >> shift) & 0xf
+            if op == 'GET':
+                result.append(value)
+                continue
+
+            old, value = value, int(args.pop(0))
+            if op == 'INCRBY':
+                value = max(0, min(15, old + value))
+            bits[offset // 2] = bits[offset // 2] & ~(0xf << shift) & 0xff | (value << shift)
+            result.append(old if op == 'SET' else value)
+
+        self.data[key] = bytes(bits)
+        return result
+
+    def run_script(self, script, keys, args):
+        return self.scripts[script](*(list(keys) + list(args)))
+
+    def register_script(self, script):
+        def call(keys=(), args=(), client=None):
+            return (client or self).run_script(script, keys, args)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.client, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [func(*args, **kwargs) for func, args, kwargs in commands]
+
+
+class XMLRPCRequestHandler(xmlrpc_server.SimpleXMLRPCRequestHandler):
+    """Keeps connections alive, unless the server is told to close or drop them."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.server.drop:  # execute the call but close the connection without a response
+            body = self.rfile.read(int(self.headers['content-length']))
+            self.server._marshaled_dispatch(body)
+            self.close_connection = True
+            return
+
+        xmlrpc_server.SimpleXMLRPCRequestHandler.do_POST(self)
+        if self.server.close:  # close the connection without announcing it
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class XMLRPCServer(socketserver.ThreadingMixIn, xmlrpc_server.SimpleXMLRPCServer):
+    """Local stand-in for the XML-RPC interface of ejabberd."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        xmlrpc_server.SimpleXMLRPCServer.__init__(
+            self, ('127.0.0.1', 0), requestHandler=XMLRPCRequestHandler, logRequests=False)
+        self.calls = []
+        self.delay = 0
+        self.drop = False
+        self.close = False
+        self.register_function(self.create_user)
+
+    def create_user(self, username):
+        self.calls.append(username)
+        time.sleep(self.delay)
+        return 0
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise RuntimeError('SMTP server unavailable')
+
+
+def captcha():
+    """Get POST data for a solved CAPTCHA."""
+
+    if not settings.ENABLE_CAPTCHAS:
+        return {}
+    hashkey = CaptchaStore.generate_key()
+    return {
+        'captcha_0': hashkey,
+        'captcha_1': CaptchaStore.objects.get(hashkey=hashkey).response,
+    }
+
+
+@override_hosts()
+@override_settings(DEBUG=True)  # disables rate limits
+class BackendTestCase(FixtureMixin, TestCase):
+    """Test case with a :py:class:`FakeBackend` as XMPP backend and an existing user."""
+
+    def setUp(self):
+        caches['default'].clear()  # e.g. spam blocks and rate limits
+        self.backend = FakeBackend()
+        self.patch(backend, 'backend', self.backend)
+
+        self.user = User.objects.create(jid='user@%s' % DOMAIN, email='user@example.net',
+                                        registration_method=REGISTRATION_WEBSITE)
+
+    def get(self, urlname, **kwargs):
+        return self.client.get(reverse(urlname, kwargs=kwargs), HTTP_USER_AGENT='test')
+
+    def submit(self, urlname, data, **kwargs):
+        return self.client.post(reverse(urlname, kwargs=kwargs), data, HTTP_USER_AGENT='test')
+
+    def post(self, urlname, data, **kwargs):
+        return self.submit(urlname, dict(data, **captcha()), **kwargs)
@@ -16,8 +16,24 @@
 
 from __future__ import unicode_literals
 
+import json
+import uuid
+
+from celery import group
+
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
+
+from core.confirmations import get_confirmation_store
+from core.executor import email_executor
+from core.outbox import enqueue
+from core.outbox import enqueue_many
+from core.sites import get_site
+from core.tasks import send_email
+from core.tasks import send_emails
+from core.tasks import send_gpg_email
+from core.tasks import set_email_progress
 
 
 def get_client_ip(request):
@@ -43,8 +59,84 @@ def confirm(request, user, purpose, payload=None, lang=None):
     path = reverse(urlname, kwargs={'key': key.key, })
     uri = request.build_absolute_uri(location=path)
 
+    # Only the domain of the site is passed on, so that tasks stay small
     return key, {
         'uri': uri,
-        'site': request.site,
+        'site': request.site['DOMAIN'],
         'lang': lang,
     }
+
+
+def send_confirmation(request, user, purpose, payload=None, lang=None):
+    """Create a confirmation key and send it to the user - via the outbox, Celery, a background
+    thread or directly.
+
+    With ``EMAIL_OUTBOX``, the email is added to the outbox in the same transaction that creates
+    the key.
+    """
+    if settings.EMAIL_OUTBOX:
+        with transaction.atomic():
+            key, kwargs = confirm(request, user, purpose=purpose, payload=payload, lang=lang)
+            enqueue(key, **kwargs)
+    else:
+        key, kwargs = confirm(request, user, purpose=purpose, payload=payload, lang=lang)
+        if settings.BROKER_URL is not None:
+            # GPG emails go straight to their own task (and queue, see EMAIL_QUEUES)
+            if key.should_use_gpg(json.loads(key.payload), get_site(kwargs['site'])):
+                send_gpg_email.delay(key=key.key, **kwargs)
+            else:
+                send_email.delay(key=key.key, **kwargs)
+        elif settings.EMAIL_WORKER_THREADS:
+            # The worker thread looks up the key, so it has to be committed first
+            transaction.on_commit(
+                lambda: email_executor.submit(send_email, key=key.key, **kwargs))
+        else:
+            key.send(uri=kwargs['uri'], site=get_site(kwargs['site']), lang=kwargs['lang'])
+    return key
+
+
+def send_confirmations(request, users, purpose, payload=None, lang=None):
+    """Send confirmations to many ``users`` at once, e.g. from an admin action.
+
+    All confirmations are created with one query and the emails are sent in chunks of
+    ``EMAIL_CHUNK_SIZE`` - as a group of Celery tasks, in background threads or directly. Returns a
+    token for :py:func:`~core.tasks.get_email_progress`, or ``None`` if the emails were added to
+    the outbox (``EMAIL_OUTBOX``) instead.
+    """
+    if lang is None:
+        lang = settings.LANGUAGE_CODE
+    if payload is None:
+        payload = {}
+
+    urlname = 'xmpp_accounts:%s_confirm' % purpose
+    with transaction.atomic():
+        keys = get_confirmation_store().create_many(users, purpose, json.dumps(payload))
+        emails = [{
+            'key': key.key,
+            'uri': request.build_absolute_uri(location=reverse(urlname, kwargs={'key': key.key})),
+            'site': request.site['DOMAIN'],
+            'lang': lang,
+        } for key in keys]
+
+        if settings.EMAIL_OUTBOX:
+            enqueue_many(emails)
+            return None
+
+    token = uuid.uuid4().hex
+    set_email_progress(token, len(emails))
+    chunks = [emails[i:i + settings.EMAIL_CHUNK_SIZE]
+              for i in range(0, len(emails), settings.EMAIL_CHUNK_SIZE)]
+
+    if settings.BROKER_URL is not None:
+        group(send_emails.s(chunk, token=token) for chunk in chunks).apply_async()
+    elif settings.EMAIL_WORKER_THREADS:
+        def submit():
+            for chunk in chunks:
+                email_executor.submit(send_emails, chunk, token=token)
+
+        # The worker threads look up the keys, so they have to be committed first
+        transaction.on_commit(submit)
+    else:
+        for chunk in chunks:
+            send_emails(chunk, token=token)
+    return token
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the persistent ejabberdctl backend against starting ejabberdctl for every command.
+
+Run it from the root of the project::
+
+    python files/benchmarks/ejabberdctl.py -n 100 --delay 0.3
+
+Both backends use files/ejabberdctl/fake-ejabberdctl instead of ejabberdctl, ``--delay`` is the
+time it takes to start, e.g. to simulate the startup time of an Erlang VM. Every run calls
+``user_exists`` ``-n`` times.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FAKE_EJABBERDCTL = os.path.join(ROOT, 'files', 'ejabberdctl', 'fake-ejabberdctl')
+sys.path.insert(0, ROOT)
+
+from xmpp_backends.ejabberdctl import EjabberdctlBackend  # NOQA
+
+from backends.ejabberdctl import PersistentEjabberdctlBackend  # NOQA
+
+
+def measure(backend, number):
+    start = time.time()
+    for i in range(number):
+        backend.user_exists('user%s' % (i % 10), 'example.com')
+    return (time.time() - start) / number
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=100, help='Calls per backend.')
+    parser.add_argument('--delay', type=float, default=0.3,
+                        help='Seconds it takes to start ejabberdctl (default: %(default)s).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes of the persistent backend.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['FAKE_EJABBERDCTL_STATE'] = os.path.join(tmpdir, 'state.json')
+    os.environ['FAKE_EJABBERDCTL_DELAY'] = str(args.delay)
+    try:
+
+        backend = EjabberdctlBackend(path=FAKE_EJABBERDCTL)
+        backend.create_user('user0', 'example.com', 'password')
+        elapsed = measure(backend, args.number)
+        print('%-28s %8.1f ms/call' % ('EjabberdctlBackend', elapsed * 1000))
+
+        backend = PersistentEjabberdctlBackend(worker=[FAKE_EJABBERDCTL, '--worker'],
+                                               workers=args.workers)
+        start = time.time()
+        backend.user_exists('user0', 'example.com')  # starts the worker
+        print('%-28s %8.1f ms' % ('worker startup', (time.time() - start) * 1000))
+        elapsed = measure(backend, args.number)
+        print('%-28s %8.1f ms/call' % ('PersistentEjabberdctlBackend', elapsed * 1000))
+        backend.close()
+    finally:
+        shutil.rmtree(tmpdir)
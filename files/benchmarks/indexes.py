@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark confirmation lookups and purges with and without the indexes of migration 0025.
+
+Run it from anywhere, it only needs the sqlite3 module::
+
+    python files/benchmarks/indexes.py --rows 100000 300000 1000000 3000000
+
+For every size, a table with the schema of ``core_confirmation`` is generated in a temporary
+SQLite database, once without and once with the indexes added by
+``core/migrations/0025_confirmation_indexes.py``. The benchmark then measures:
+
+* the lookup ``ConfirmedMixin.form_valid`` does (``valid().purpose(...).get(key=...)``), averaged
+  over ``--lookups`` random existing keys, and
+* the purge ``manage.py cleanup`` does (``expired().delete()``), deleting ``--expired`` expired
+  rows from a table where all other rows are still valid.
+
+Without indexes, both grow linearly with the size of the table. With indexes, they stay almost
+constant (a B-tree search is logarithmic in the size of the table). The query plans show which
+indexes SQLite uses.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from datetime import datetime
+from datetime import timedelta
+
+SCHEMA = '''CREATE TABLE core_confirmation (
+    id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+    key varchar(40) NOT NULL,
+    user_id integer NOT NULL,
+    created datetime NOT NULL,
+    purpose varchar(12) NOT NULL,
+    payload text NULL
+)'''
+
+# Indexes created by migration 0025
+INDEXES = [
+    'CREATE UNIQUE INDEX core_confirmation_key ON core_confirmation (key)',
+    'CREATE INDEX core_confirmation_created ON core_confirmation (created)',
+    'CREATE INDEX core_confirmation_purpose_created ON core_confirmation (purpose, created)',
+]
+
+PURPOSES = ['register', 'set_password', 'set_email', 'delete']
+
+LOOKUP = 'SELECT * FROM core_confirmation WHERE created > ? AND purpose = ? AND key = ?'
+PURGE = 'DELETE FROM core_confirmation WHERE created < ?'
+
+NOW = datetime(2016, 9, 1)
+TIMEOUT = timedelta(days=1)  # CONFIRMATION_TIMEOUT
+
+
+def generate(path, rows, expired, indexes):
+    """Generate a table with ``rows`` rows, ``expired`` of them older than ``TIMEOUT``."""
+
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+
+    def rows_iter():
+        for i in range(rows):
+            key = hashlib.sha1(str(i).encode('utf-8')).hexdigest()
+            if i < expired:
+                created = NOW - TIMEOUT - timedelta(seconds=i + 1)
+            else:
+                created = NOW - timedelta(seconds=(i * 7) % int(TIMEOUT.total_seconds()))
+            yield key, i, created.isoformat(' '), PURPOSES[i % len(PURPOSES)], '{}'
+
+    conn.executemany('INSERT INTO core_confirmation (key, user_id, created, purpose, payload) '
+                     'VALUES (?, ?, ?, ?, ?)', rows_iter())
+    if indexes:
+        for index in INDEXES:
+            conn.execute(index)
+    conn.commit()
+    return conn
+
+
+def measure_lookup(conn, rows, expired, number):
+    timestamp = (NOW - TIMEOUT).isoformat(' ')
+    indexes = [random.randrange(expired, rows) for i in range(number)]
+    params = [(timestamp, PURPOSES[i % len(PURPOSES)],
+               hashlib.sha1(str(i).encode('utf-8')).hexdigest()) for i in indexes]
+
+    start = time.time()
+    for args in params:
+        assert len(conn.execute(LOOKUP, args).fetchall()) == 1
+    return (time.time() - start) / number
+
+
+def measure_purge(conn, expired):
+    timestamp = (NOW - TIMEOUT).isoformat(' ')
+    start = time.time()
+    deleted = conn.execute(PURGE, (timestamp, )).rowcount
+    elapsed = time.time() - start
+    conn.rollback()
+    assert deleted == expired, deleted
+    return elapsed
+
+
+def plan(conn, query, args):
+    return '; '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN %s' % query, args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 300000, 1000000, 3000000],
+                        help='Table sizes to benchmark (default: %(default)s).')
+    parser.add_argument('--lookups', type=int, default=200, help='Lookups per table.')
+    parser.add_argument('--expired', type=int, default=1000, help='Expired rows per table.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%10s  %14s  %14s  %14s  %14s' % ('rows', 'lookup', 'lookup (idx)', 'purge',
+                                                'purge (idx)'))
+        plans = {}
+        for rows in args.rows:
+            results = []
+            for indexes in [False, True]:
+                path = os.path.join(tmpdir, '%s-%s.sqlite3' % (rows, indexes))
+                conn = generate(path, rows, args.expired, indexes)
+                results.append(measure_lookup(conn, rows, args.expired, args.lookups))
+                results.append(measure_purge(conn, args.expired))
+                timestamp = (NOW - TIMEOUT).isoformat(' ')
+                plans[indexes] = (plan(conn, LOOKUP, (timestamp, 'register', 'x')),
+                                  plan(conn, PURGE, (timestamp, )))
+                conn.close()
+                os.remove(path)
+
+            print('%10s  %12.3fms  %12.3fms  %12.3fms  %12.3fms' % (
+                rows, results[0] * 1000, results[2] * 1000, results[1] * 1000, results[3] * 1000))
+
+        for indexes, (lookup, purge) in sorted(plans.items()):
+            print('\nQuery plans %s indexes:' % ('with' if indexes else 'without'))
+            print('    lookup: %s' % lookup)
+            print('    purge:  %s' % purge)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the overhead of rate limiting in ``AntiSpamMixin.dispatch``.
+
+Run it from the root of the project, with your ``localsettings.py`` in place (limits are stored
+in your default cache)::
+
+    python files/benchmarks/ratelimit.py -n 10000
+
+It prints the time per request spent in ``dispatch()`` for every token bucket store, compared to
+a view without rate limiting. If django-brake is installed, the implementation that was used
+before (two brake decorators created on every request) is included as well.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xmppaccount.settings')
+
+import django  # NOQA
+django.setup()
+
+from django.http import HttpResponse  # NOQA
+from django.test import RequestFactory  # NOQA
+from django.test import override_settings  # NOQA
+from django.views.generic import View  # NOQA
+
+from core.ratelimit import CacheTokenBucketStore  # NOQA
+from core.ratelimit import LocMemTokenBucketStore  # NOQA
+from core.ratelimit import RedisTokenBucketStore  # NOQA
+from core.ratelimit import RequestRateLimiter  # NOQA
+from core.ratelimit import get_redis_client  # NOQA
+from core.views import AntiSpamMixin  # NOQA
+
+# High enough that no request is ever limited
+RATES = {'GET': '1000000/s', 'POST': '1000000/s'}
+
+
+class PlainView(View):
+    def get(self, request):
+        return HttpResponse()
+
+
+class LimitedView(AntiSpamMixin, PlainView):
+    pass
+
+
+def brake_view():
+    """The rate limiting used before, if django-brake is installed."""
+
+    try:
+        from brake.decorators import ratelimit
+    except ImportError:
+        return None
+
+    class BrakeView(PlainView):
+        def dispatch(self, request, *args, **kwargs):
+            def func(request):
+                pass
+            func.__name__ = str('%s_dispatch' % self.__class__.__name__)
+            func = ratelimit(method='POST', rate=RATES['POST'])(func)
+            ratelimit(method='GET', rate=RATES['GET'])(func)(request)
+            return super(BrakeView, self).dispatch(request, *args, **kwargs)
+    return BrakeView.as_view()
+
+
+def limited_view(store):
+    view = LimitedView.as_view()
+    LimitedView.rate_limiter = RequestRateLimiter('benchmark', RATES, store=store)
+    return view
+
+
+def measure(view, number):
+    request = RequestFactory().get('/', HTTP_USER_AGENT='benchmark', REMOTE_ADDR='192.0.2.1')
+    view(request)  # warm up
+    return timeit.timeit(lambda: view(request), number=number) / number
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=10000, help='Requests per view.')
+    args = parser.parse_args()
+
+    views = [
+        ('brake (before)', brake_view()),
+        ('locmem', limited_view(LocMemTokenBucketStore())),
+        ('cache', limited_view(CacheTokenBucketStore())),
+    ]
+    client = get_redis_client()
+    if client is not None:
+        views.append(('redis', limited_view(RedisTokenBucketStore(client))))
+
+    with override_settings(DEBUG=False, RATELIMIT_WHITELIST=set()):
+        baseline = measure(PlainView.as_view(), args.number)
+        print('%-16s %8.1f us/request' % ('no rate limits', baseline * 1000000))
+        for name, view in views:
+            if view is None:
+                print('%-16s not installed' % name)
+                continue
+            elapsed = measure(view, args.number)
+            print('%-16s %8.1f us/request (+%.1f us)' % (name, elapsed * 1000000,
+                                                         (elapsed - baseline) * 1000000))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark sending emails with ``msg.send()`` and with the SMTP connection pool.
+
+Run it from the root of the project, with your ``localsettings.py`` in place::
+
+    python files/benchmarks/smtp.py -n 1000 -t 1 4
+
+Emails are sent to a local SMTP sink that accepts and discards all messages. It is started on a
+random port, ``--delay`` adds a delay to every new connection, e.g. to simulate the latency of a
+TLS handshake and authentication with a remote server. Every run prints how many emails per
+second were sent with the given numbers of threads.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xmppaccount.settings')
+
+import django  # NOQA
+django.setup()
+
+from django.core.mail import EmailMessage  # NOQA
+from django.test import override_settings  # NOQA
+from django.utils.six.moves import socketserver  # NOQA
+
+from core.mail import ConnectionPool  # NOQA
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server that accepts and discards all messages."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.reply('220 localhost ESMTP sink')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.received += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+class Sink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, delay):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), SinkHandler)
+        self.delay = delay
+        self.received = 0
+
+
+def run(threads, number, send):
+    per_thread = number // threads
+
+    def target():
+        for i in range(per_thread):
+            msg = EmailMessage('Subject %s' % i, 'Body of the email.', 'from@example.com',
+                               ['user%s@example.net' % i])
+            send(msg)
+
+    workers = [threading.Thread(target=target) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=1000, help='Emails per run.')
+    parser.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 4],
+                        help='Numbers of threads to run with.')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds the sink waits before greeting a new connection.')
+    args = parser.parse_args()
+
+    sink = Sink(args.delay)
+    thread = threading.Thread(target=sink.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                           EMAIL_HOST='127.0.0.1', EMAIL_PORT=sink.server_address[1],
+                           EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False,
+                           EMAIL_USE_SSL=False):
+        for threads in args.threads:
+            rate = run(threads, args.number, lambda msg: msg.send())
+            print('%-18s %2s threads: %8.1f mails/s' % ('msg.send()', threads, rate))
+
+            pool = ConnectionPool(size=threads)
+            rate = run(threads, args.number, pool.send)
+            pool.close()
+            print('%-18s %2s threads: %8.1f mails/s' % ('smtp_pool.send()', threads, rate))
+
+    sink.shutdown()
+    print('%s mails received.' % sink.received)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the pooled XML-RPC transport against a local stand-in for ejabberd.
+
+Run it from the root of the project::
+
+    python files/benchmarks/transport.py -n 2000 -t 1 4
+
+A small threaded XML-RPC server answering ``user_exists`` (with an optional ``--delay`` to
+simulate a slower server) is started on a random local port. Every call is made once with a new
+connection (what ``xmlrpc_client.Transport`` does for a new ``ServerProxy``) and once with a
+shared :py:class:`~backends.transport.PooledTransport`, using the given numbers of threads.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from django.utils.six.moves import socketserver  # NOQA
+from django.utils.six.moves import xmlrpc_client  # NOQA
+from django.utils.six.moves import xmlrpc_server  # NOQA
+
+from backends.transport import PooledTransport  # NOQA
+
+
+class RequestHandler(xmlrpc_server.SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive, like ejabberd does
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, xmlrpc_server.SimpleXMLRPCServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_server(delay):
+    def user_exists(username, host):
+        if delay:
+            time.sleep(delay)
+        return {'res': 0}
+
+    server = Server(('127.0.0.1', 0), requestHandler=RequestHandler, logRequests=False)
+    server.register_function(user_exists)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run(threads, number, get_proxy):
+    per_thread = number // threads
+
+    def target():
+        for i in range(per_thread):
+            get_proxy().user_exists('user%s' % i, 'example.com')
+
+    workers = [threading.Thread(target=target) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=2000, help='Calls per run.')
+    parser.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 4],
+                        help='Numbers of threads to run with.')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds the server takes to answer a call.')
+    args = parser.parse_args()
+
+    server = start_server(args.delay)
+    uri = 'http://127.0.0.1:%s' % server.server_address[1]
+
+    for threads in args.threads:
+        rate = run(threads, args.number, lambda: xmlrpc_client.ServerProxy(uri))
+        print('%-24s %2s threads: %8.1f calls/s' % ('new connection', threads, rate))
+
+        transport = PooledTransport(pool_size=threads)
+        proxy = xmlrpc_client.ServerProxy(uri, transport=transport)
+        rate = run(threads, args.number, lambda: proxy)
+        print('%-24s %2s threads: %8.1f calls/s (%s connections, %s reused)' % (
+            'PooledTransport', threads, rate, transport.created, transport.reused))
+        transport.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, absolute_import
+
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.six.moves import queue
+
+from core.backend import backend
+from core.bloom import get_user_filter
+from core.singleflight import SingleFlight
+
+User = get_user_model()
+
+# How long the existence of a JID is cached
+CACHE_TIMEOUT = 30
+
+# Concurrent checks for the same JID share a single backend call
+user_exists_flight = SingleFlight('exists', lock_timeout=settings.USER_EXISTS_LOCK_TIMEOUT)
+
+
+def _user_exists(jid):
+    username, domain = jid.split('@', 1)
+    return user_exists_flight.do(jid, backend.user_exists, username, domain)
+
+
+def _users_exist(jids):
+    """Check ``jids`` in the XMPP backend, returns a dict mapping each JID to its existence.
+
+    The backend API has no bulk check, so up to ``USER_EXISTS_CONCURRENCY`` calls are made at the
+    same time. If any call fails, the first error is raised once all running calls are done.
+    """
+    workers = min(settings.USER_EXISTS_CONCURRENCY, len(jids))
+    if workers <= 1:
+        return {jid: _user_exists(jid) for jid in jids}
+
+    pending = queue.Queue()
+    for jid in jids:
+        pending.put(jid)
+    results = {}
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                jid = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results[jid] = _user_exists(jid)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def might_exist(jids):
+    """Get the subset of ``jids`` that might exist according to the ``USER_FILTER``.
+
+    If the filter is disabled, all JIDs are returned.
+    """
+    user_filter = get_user_filter()
+    if user_filter is None:
+        return set(jids)
+    return user_filter.might_exist(jids)
+
+
+def backend_exists(jid):
+    """Check if ``jid`` exists in the XMPP backend, unless the ``USER_FILTER`` rules it out.
+
+    If ``AUTHORITATIVE_DATABASE`` is set, the backend is never asked and this always returns
+    ``False``.
+    """
+    if settings.AUTHORITATIVE_DATABASE or not might_exist([jid]):
+        return False
+    return _user_exists(jid)
+
+
+def get_existing(jids):
+    """Get the subset of ``jids`` that already exist.
+
+    JIDs ruled out by the ``USER_FILTER`` are not looked up at all. The others are first checked
+    in the cache, then in the database and only then (unless ``AUTHORITATIVE_DATABASE`` is set)
+    in the XMPP backend. The cache and the database are each queried only once, no matter how many
+    JIDs are passed, the backend calls are made concurrently (see ``USER_EXISTS_CONCURRENCY``).
+    """
+    jids = might_exist(jids)
+    if not jids:
+        return set()
+
+    keys = {'exists_%s' % jid: jid for jid in jids}
+    cached = cache.get_many(list(keys))
+
+    existing = set(keys[key] for key, exists in cached.items() if exists is True)
+    unknown = [jid for key, jid in keys.items() if key not in cached]
+    if not unknown:
+        return existing
+
+    in_database = set(User.objects.filter(jid__in=unknown).values_list('jid', flat=True))
+    if settings.AUTHORITATIVE_DATABASE:
+        in_backend = {}
+    else:
+        in_backend = _users_exist([jid for jid in unknown if jid not in in_database])
+
+    results = {}
+    for jid in unknown:
+        exists = jid in in_database or in_backend.get(jid, False)
+        results['exists_%s' % jid] = exists
+        if exists:
+            existing.add(jid)
+
+    cache.set_many(results, CACHE_TIMEOUT)
+    return existing
+
+
+def exists(jid):
+    """Check if a single JID exists, see :py:func:`get_existing`."""
+
+    return jid in get_existing([jid])
@@ -23,8 +23,10 @@ from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext_lazy as _
 
 from captcha.fields import CaptchaField
-from django_xmpp_backends import backend
 
+from core.backend import backend
+
+from .availability import backend_exists
 from .formfields import XMPPAccountPasswordField
 from .formfields import XMPPAccountEmailField
 from .formfields import XMPPAccountFingerprintField
@@ -84,9 +86,8 @@ class RegistrationForm(GPGMixin, AntiSpamForm):
         data = super(RegistrationForm, self).clean()
 
         if data.get('username'):
-            node, domain = data['username'].split('@')
             if User.objects.filter(jid=data['username']).exists() \
-                    or backend.user_exists(username=node, domain=domain):
+                    or backend_exists(data['username']):
                 self.add_error('username', _("User already exists."))
         return data
 
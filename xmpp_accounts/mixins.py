@@ -17,6 +17,7 @@
 from __future__ import unicode_literals, absolute_import
 
 import json
+import uuid
 
 from django.conf import settings
 from django.http import HttpResponseRedirect
@@ -24,45 +25,22 @@ from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from django.contrib.auth import get_user_model
 
-from brake.decorators import ratelimit
 from xmpp_backends.base import UserExists
 from xmpp_backends.base import UserNotFound
 
-from core.exceptions import RateException
-from core.exceptions import SpamException
+from core.backend import backend
+from core.confirmations import get_confirmation_store
+from core.constants import BACKEND_STATUS_PENDING
 from core.models import Address
 from core.models import Confirmation
 from core.models import UserAddresses
-from core.tasks import send_email
-from core.utils import confirm
-from core.utils import get_client_ip
+from core.tasks import backend_operations
+from core.tasks import set_backend_status
+from core.utils import send_confirmation
 
 User = get_user_model()
 
 
-class AntiSpamMixin(object):
-    def dispatch(self, request, *args, **kwargs):
-        remote_ip = get_client_ip(request)
-
-        if settings.DEBUG is False and remote_ip not in settings.RATELIMIT_WHITELIST:
-            # create a dummy function and dynamically set its name. This way,
-            # the ratelimit decorator is specific to the method in each class.
-            def func(request):
-                pass
-            func.__name__ = str('%s_dispatch' % self.__class__.__name__)
-            func = ratelimit(method='POST', rate='15/m')(func)
-            ratelimit(method='GET', rate='40/m')(func)(request)
-
-            if getattr(request, 'limited', False):
-                raise RateException()
-
-        # We sometimes get requests *without* a user agent. We assume these are automated requests.
-        if not request.META.get('HTTP_USER_AGENT'):
-            raise SpamException("No user agent passed.")
-
-        return super(AntiSpamMixin, self).dispatch(request, *args, **kwargs)
-
-
 class ConfirmationMixin(object):
     # TODO: Very ugly here (should be part of the form or so)
     user_not_found_error = _("User not found (or false password provided)!")
@@ -108,17 +86,15 @@ class ConfirmationMixin(object):
         UserAddresses.objects.create(address=address, user=user, purpose=self.purpose)
 
         # Send confirmation email to the user
-        key, kwargs = confirm(self.request, user, purpose=self.purpose, payload=payload)
-        if settings.BROKER_URL is None:
-            key.send(**kwargs)
-        else:
-            send_email.delay(key_id=key.pk, **kwargs)
+        send_confirmation(self.request, user, purpose=self.purpose, payload=payload)
 
         return super(ConfirmationMixin, self).form_valid(form)
 
 
 class ConfirmedMixin(object):
     user = None
+    deferred = None
+    backend_status = None
 
     def get_template_names(self):
         return ['xmpp_accounts/%s/confirm.html' % self.purpose]
@@ -131,24 +107,52 @@ class ConfirmedMixin(object):
     def after_delete(self, user, form):
         pass
 
+    def backend_write(self, method, **kwargs):
+        """Call ``method`` of the XMPP backend, deferred to Celery if ``DEFER_BACKEND_WRITES`` is
+        set.
+
+        Deferred operations are only started once the key was handled successfully.
+        """
+        if settings.DEFER_BACKEND_WRITES and settings.BROKER_URL is not None:
+            self.deferred.append((method, kwargs))
+        else:
+            getattr(backend, method)(**kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(ConfirmedMixin, self).get_context_data(**kwargs)
         if self.user is not None:
             context['username'] = self.user.node
             context['domain'] = self.user.domain
             context['jid'] = self.user.jid
+        if self.backend_status is not None:
+            context['backend_status_url'] = reverse('xmpp_accounts:status',
+                                                    kwargs={'token': self.backend_status})
         return context
 
     def form_valid(self, form):
+        store = get_confirmation_store()
         try:
-            key = Confirmation.objects.valid().purpose(self.purpose).get(key=self.kwargs['key'])
+            key = store.valid().purpose(self.purpose).get(key=self.kwargs['key'])
         except Confirmation.DoesNotExist:
             form.add_error(None, _("Confirmation key expired or not found."))
             return self.form_invalid(form)
+
+        # Claim the key before doing anything, so that duplicate or concurrent requests with the
+        # same key fail right here.
+        if not store.claim(key):
+            form.add_error(None, _("Confirmation key expired or not found."))
+            return self.form_invalid(form)
+
         self.user = key.user
+        self.deferred = []
 
         try:
-            self.handle_key(key, self.user, form)
+            try:
+                self.handle_key(key, self.user, form)
+            except Exception:
+                store.release(key)  # e.g. a wrong password, the user may try again
+                raise
+
             key.delete()
             self.after_delete(self.user, form)
         except UserNotFound as e:
@@ -161,4 +165,9 @@ class ConfirmedMixin(object):
             form.add_error(None, _("User already exists!"))
             return self.form_invalid(form)
 
+        if self.deferred:
+            self.backend_status = uuid.uuid4().hex
+            set_backend_status(self.backend_status, BACKEND_STATUS_PENDING)
+            backend_operations.delay(operations=self.deferred, token=self.backend_status)
+
         return super(ConfirmedMixin, self).form_valid(form)
@@ -1,3 +1,378 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:hlsearch
+#
+# This file is part of django-xmpp-account (https://github.com/mathiasertl/django-xmpp-account/).
+#
+# django-xmpp-account is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# django-xmpp-account is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-xmpp-account.
+# If not, see <http://www.gnu.org/licenses/>.
 
-# Create your tests here.
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import caches
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from django.utils.timezone import now
+
+from core.confirmations import DatabaseStore
+from core.confirmations import TokenStore
+from core.constants import BACKEND_STATUS_PENDING
+from core.exceptions import BackendUnavailable
+from core.models import Confirmation
+from core.ratelimit import RequestRateLimiter
+from core.tasks import set_backend_status
+from core.testutils import DOMAIN
+from core.testutils import BackendTestCase
+from core.testutils import CacheCounter
+from core.testutils import captcha
+
+from .constants import PURPOSE_DELETE
+from .constants import PURPOSE_REGISTER
+from .constants import PURPOSE_SET_EMAIL
+from .constants import PURPOSE_SET_PASSWORD
+from .views import RegistrationView
+from .views import UsersAvailableView
+
+User = get_user_model()
+
+# Queries issued by django-simple-captcha: Rendering a form creates a new CAPTCHA, validating it
+# removes expired CAPTCHAs and then fetches and deletes the solved one.
+CAPTCHA_RENDER = 1 if settings.ENABLE_CAPTCHAS else 0
+CAPTCHA_CLEAN = 3 if settings.ENABLE_CAPTCHAS else 0
+
+
+class RegistrationRateTestCase(BackendTestCase):
+    def register(self, username):
+        return self.post('xmpp_accounts:register', {
+            'username_0': username, 'username_1': DOMAIN, 'email': '%s@example.net' % username,
+        })
+
+    @override_settings(DEBUG=False)
+    def test_rate_limits(self):
+        view = RegistrationView
+        limiter = view.rate_limiter
+        view.rate_limiter = RequestRateLimiter('test', {'GET': '1/m'})
+        try:
+            self.assertTemplateNotUsed(self.get('xmpp_accounts:register'), 'core/rate.html')
+            self.assertTemplateUsed(self.get('xmpp_accounts:register'), 'core/rate.html')
+        finally:
+            view.rate_limiter = limiter
+
+    def test_registration_rate(self):
+        self.assertTemplateNotUsed(self.register('first'), 'core/registration_rate.html')
+        self.assertTemplateUsed(self.register('second'), 'core/registration_rate.html')
+        self.assertFalse(User.objects.filter(jid='second@%s' % DOMAIN).exists())
+
+
+class AvailabilityTestCase(BackendTestCase):
+    def available(self, **data):
+        return self.submit('xmpp_accounts:api-users-available', data)
+
+    @override_settings(DEBUG=False)
+    def test_user_available(self):
+        response = self.submit('xmpp_accounts:api-user-available',
+                               {'username': 'New', 'domain': DOMAIN})
+        self.assertEqual(response.status_code, 200)
+        response = self.submit('xmpp_accounts:api-user-available',
+                               {'username': 'User', 'domain': DOMAIN})
+        self.assertEqual(response.status_code, 409)
+
+        # The widget calls this view on every keystroke, so it has no rate limit
+        for i in range(100):
+            response = self.client.post(reverse('xmpp_accounts:api-user-available'),
+                                        {'username': 'new%s' % i, 'domain': DOMAIN})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'')
+
+    def test_backend_unavailable(self):
+        def fail():
+            raise BackendUnavailable('down')
+        self.backend.hook = fail
+
+        # The username widget must not show the username as available
+        response = self.submit('xmpp_accounts:api-user-available',
+                               {'username': 'new', 'domain': DOMAIN})
+        self.assertEqual(response.status_code, 503)
+        self.assertTemplateUsed(response, 'core/temporary_error.html')
+
+    def test_users_available(self):
+        response = self.available(username=['user', 'New'], domain=DOMAIN,
+                                  jid=['other@%s' % DOMAIN])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'user@%s' % DOMAIN: False,
+            'new@%s' % DOMAIN: True,
+            'other@%s' % DOMAIN: True,
+        })
+
+    @override_settings(USER_EXISTS_CONCURRENCY=4)
+    def test_concurrent_backend_calls(self):
+        self.backend.existing.add('taken@%s' % DOMAIN)
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+        user_exists = self.backend.user_exists
+
+        def slow_user_exists(username, domain):
+            with lock:
+                running.append(username)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(username)
+            return user_exists(username, domain)
+        self.backend.user_exists = slow_user_exists
+
+        usernames = ['taken'] + ['new%s' % i for i in range(7)]
+        response = self.available(username=usernames, domain=DOMAIN)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data, {'%s@%s' % (u, DOMAIN): u != 'taken' for u in usernames})
+        self.assertEqual(len(self.backend.calls), 8)
+        self.assertEqual(max(concurrency), 4)
+
+    def test_invalid(self):
+        too_many = ['user%s' % i for i in range(UsersAvailableView.max_jids + 1)]
+        for data in [
+            {},  # no JIDs at all
+            {'username': too_many, 'domain': DOMAIN},
+            {'username': 'new', 'domain': 'example.net'},  # not managed by this site
+            {'jid': 'new@example.net'},
+            {'jid': ['new@%s' % DOMAIN, 'invalid']},
+            {'jid': '@%s' % DOMAIN},
+        ]:
+            self.assertEqual(self.available(**data).status_code, 400, data)
+        self.assertEqual(self.backend.calls, [])
+
+    def test_no_user_agent(self):
+        response = self.client.post(reverse('xmpp_accounts:api-users-available'),
+                                    {'username': 'new', 'domain': DOMAIN})
+        self.assertEqual(response.status_code, 403)
+        self.assertTemplateUsed(response, 'core/spambot.html')
+
+    @override_settings(DEBUG=False)
+    def test_rate_limit(self):
+        for i in range(3):
+            self.assertEqual(self.available(username='new%s' % i, domain=DOMAIN).status_code, 200)
+        response = self.available(username='new', domain=DOMAIN)
+        self.assertEqual(response.status_code, 429)
+        self.assertTemplateUsed(response, 'core/rate.html')
+
+
+class ConfirmationClaimTestCase(BackendTestCase):
+    data = {'password': 'foobar123', 'password2': 'foobar123'}
+
+    def setUp(self):
+        super(ConfirmationClaimTestCase, self).setUp()
+        self.store = DatabaseStore()
+
+    def confirm(self, key):
+        return self.post('xmpp_accounts:register_confirm', self.data, key=key.key)
+
+    def test_double_submit(self):
+        key = self.store.create(self.user, PURPOSE_REGISTER, '{}')
+        self.confirm(key)
+        self.confirm(key)
+        self.assertEqual(self.backend.calls, ['create_user'])
+        self.assertFalse(Confirmation.objects.filter(key=key.key).exists())
+
+    def test_concurrent_submit(self):
+        key = self.store.create(self.user, PURPOSE_REGISTER, '{}')
+        responses = []
+
+        # The second request is sent while the first one waits for the XMPP server.
+        self.backend.hook = lambda: responses.append(self.confirm(key))
+        self.confirm(key)
+
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(self.backend.calls, ['create_user'])
+        self.assertFalse(Confirmation.objects.filter(key=key.key).exists())
+
+    def test_release(self):
+        key = self.store.create(self.user, PURPOSE_DELETE, '{}')
+
+        # A wrong password does not use up the key
+        self.post('xmpp_accounts:delete_confirm', {'password': 'wrongpassword'}, key=key.key)
+        self.assertEqual(self.backend.calls, ['check_password'])
+        confirmation = Confirmation.objects.get(key=key.key)
+        self.assertEqual(confirmation.created, key.created)
+
+        self.post('xmpp_accounts:delete_confirm', {'password': 'foobar123'}, key=key.key)
+        self.assertEqual(self.backend.calls, ['check_password', 'check_password', 'remove_user'])
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+
+    def test_concurrent_claims(self):
+        store = TokenStore()
+        key = store.create(self.user, PURPOSE_REGISTER, '{"recipient": "user@example.net"}')
+        confirmations = [store.valid().get(key=key.key) for i in range(10)]
+
+        start = threading.Event()
+        results = []
+
+        def claim(confirmation):
+            start.wait()
+            results.append(store.claim(confirmation))
+
+        threads = [threading.Thread(target=claim, args=(c, )) for c in confirmations]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * 9 + [True])
+        with self.assertRaises(Confirmation.DoesNotExist):
+            store.valid().get(key=key.key)
+
+
+class BudgetTestCase(BackendTestCase):
+    """Make sure that no view issues more database queries or cache operations than necessary.
+
+    If any of these tests fails, you probably introduced an N+1 query or an unneeded lookup. Use
+    ``select_related()`` or batched cache operations instead and only raise a budget if the
+    additional query is really required.
+
+    Every request costs one cache operation for the ``SPAM_BLOCKS`` lookup in the middleware.
+    Views that send a confirmation log the IP address (up to five queries, including the
+    savepoint of ``get_or_create()``) and create the confirmation key (one query).
+    """
+
+    def setUp(self):
+        super(BudgetTestCase, self).setUp()
+        self.user.confirmed = now()
+        self.user.save()
+        self.store = DatabaseStore()
+
+    @contextmanager
+    def assertBudget(self, queries, cache_ops):
+        counter = CacheCounter()
+        with self.assertNumQueries(queries), counter:
+            yield
+        self.assertEqual(len(counter.calls), cache_ops, counter.calls)
+
+    def assertFormValid(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].errors)
+
+    def assertGet(self, urlname, **kwargs):
+        with self.assertBudget(CAPTCHA_RENDER, 1):
+            response = self.get(urlname, **kwargs)
+        self.assertEqual(response.status_code, 200)
+
+    def assertPost(self, urlname, data, queries, cache_ops=1, **kwargs):
+        data = dict(data, **captcha())
+        with self.assertBudget(CAPTCHA_CLEAN + queries, cache_ops):
+            response = self.submit(urlname, data, **kwargs)
+        self.assertFormValid(response)
+
+    def key(self, purpose, payload='{}'):
+        return self.store.create(self.user, purpose, payload)
+
+    def test_register(self):
+        self.assertGet('xmpp_accounts:register')
+
+        # check username, create user (in a savepoint), log address, create key. The
+        # REGISTRATION_RATE costs two more cache operations.
+        data = {'username_0': 'new', 'username_1': DOMAIN, 'email': 'new@example.net'}
+        self.assertPost('xmpp_accounts:register', data, 10, cache_ops=3)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_register_confirm(self):
+        key = self.key(PURPOSE_REGISTER)
+        self.assertGet('xmpp_accounts:register_confirm', key=key.key)
+
+        # get key and user, claim key, update user
+        data = {'password': 'foobar123', 'password2': 'foobar123'}
+        self.assertPost('xmpp_accounts:register_confirm', data, 3, key=key.key)
+        self.assertEqual(self.backend.calls, ['create_user'])
+
+    def test_password(self):
+        self.assertGet('xmpp_accounts:password')
+
+        # get user, log address, create key
+        data = {'username_0': 'user', 'username_1': DOMAIN}
+        self.assertPost('xmpp_accounts:password', data, 7)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_password_confirm(self):
+        key = self.key(PURPOSE_SET_PASSWORD)
+        self.assertGet('xmpp_accounts:password_confirm', key=key.key)
+
+        # get key and user, claim key, update user
+        data = {'password': 'foobar456', 'password2': 'foobar456'}
+        self.assertPost('xmpp_accounts:password_confirm', data, 3, key=key.key)
+        self.assertEqual(self.backend.calls, ['set_password'])
+
+    def test_email(self):
+        self.assertGet('xmpp_accounts:email')
+
+        # get user, log address, create key
+        data = {'username_0': 'user', 'username_1': DOMAIN, 'email': 'new@example.net',
+                'password': 'foobar123'}
+        self.assertPost('xmpp_accounts:email', data, 7)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_email_confirm(self):
+        key = self.key(PURPOSE_SET_EMAIL, '{"recipient": "new@example.net"}')
+        self.assertGet('xmpp_accounts:email_confirm', key=key.key)
+
+        # get key and user, claim key, update user
+        self.assertPost('xmpp_accounts:email_confirm', {'password': 'foobar123'}, 3, key=key.key)
+        self.assertEqual(self.backend.calls, ['check_password', 'set_email'])
+
+    def test_delete(self):
+        self.assertGet('xmpp_accounts:delete')
+
+        # get user, log address, create key
+        data = {'username_0': 'user', 'username_1': DOMAIN, 'password': 'foobar123'}
+        self.assertPost('xmpp_accounts:delete', data, 7)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_delete_confirm(self):
+        key = self.key(PURPOSE_DELETE)
+        self.assertGet('xmpp_accounts:delete_confirm', key=key.key)
+
+        # get key and user, claim key, delete user and related rows
+        self.assertPost('xmpp_accounts:delete_confirm', {'password': 'foobar123'}, 6,
+                        key=key.key)
+        self.assertEqual(self.backend.calls, ['check_password', 'remove_user'])
+
+    def test_user_available(self):
+        # spam blocks, get cached JIDs, cache result
+        with self.assertBudget(1, 3):
+            response = self.client.post(reverse('xmpp_accounts:api-user-available'),
+                                        {'username': 'new', 'domain': DOMAIN},
+                                        HTTP_USER_AGENT='test')
+        self.assertEqual(response.status_code, 200)
+
+    def test_users_available(self):
+        # The budget does not depend on the number of JIDs
+        for count in [1, 10]:
+            caches['default'].clear()
+            usernames = ['user'] + ['new%s' % i for i in range(count)]
+            with self.assertBudget(1, 3):
+                response = self.client.post(reverse('xmpp_accounts:api-users-available'),
+                                            {'username': usernames, 'domain': DOMAIN},
+                                            HTTP_USER_AGENT='test')
+            self.assertEqual(response.status_code, 200)
+
+    def test_status(self):
+        set_backend_status('abc', BACKEND_STATUS_PENDING)
+        with self.assertBudget(0, 2):
+            response = self.get('xmpp_accounts:status', token='abc')
+        self.assertEqual(response.status_code, 200)
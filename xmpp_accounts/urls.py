@@ -37,5 +37,8 @@ urlpatterns = [
     url(r'^delete/confirm/(?P<key>\w+)/$', views.DeleteConfirmationView.as_view(),
         name='delete_confirm'),
     url(r'^api/user-available/$', views.UserAvailableView.as_view(), name='api-user-available'),
+    url(r'^api/users-available/$', views.UsersAvailableView.as_view(),
+        name='api-users-available'),
+    url(r'^status/(?P<token>\w+)/$', views.BackendStatusView.as_view(), name='status'),
 
 ]
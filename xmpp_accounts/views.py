@@ -24,20 +24,27 @@ import pytz
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db import transaction
+from django.http import Http404
 from django.http import HttpResponse
+from django.shortcuts import render
 from django.utils.six.moves.urllib.parse import urlsplit
 from django.utils.timezone import now
 from django.utils.translation import ugettext as _
 from django.views.generic import FormView
 from django.views.generic import View
 
+from core.backend import backend
+from core.constants import BACKEND_STATUS_DONE
+from core.constants import BACKEND_STATUS_PENDING
 from core.exceptions import RegistrationRateException
-from core.views import ConfirmationView
-from core.views import ConfirmedView
+from core.ratelimit import get_sliding_window_limiter
+from core.tasks import get_backend_status
+from core.views import AntiSpamMixin
 
+from .availability import exists
+from .availability import get_existing
 from .constants import PURPOSE_DELETE
 from .constants import PURPOSE_REGISTER
 from .constants import PURPOSE_SET_EMAIL
@@ -51,11 +58,9 @@ from .forms import ResetEmailConfirmationForm
 from .forms import ResetEmailForm
 from .forms import ResetPasswordConfirmationForm
 from .forms import ResetPasswordForm
-from .mixins import AntiSpamMixin
 from .mixins import ConfirmationMixin
 from .mixins import ConfirmedMixin
 
-from django_xmpp_backends import backend
 from xmpp_backends.base import UserNotFound
 
 User = get_user_model()
@@ -122,17 +127,12 @@ class RegistrationView(ConfirmationMixin, XMPPAccountView):
     form_class = RegistrationForm
     purpose = PURPOSE_REGISTER
 
+    registration_limiter = get_sliding_window_limiter(settings.REGISTRATION_RATE)
+
     def registration_rate(self):
         # Check for a registration rate
-        cache_key = 'registration-%s' % self.request.get_host()
-        registrations = cache.get(cache_key, set())
-        _now = datetime.utcnow()
-
-        for key, value in settings.REGISTRATION_RATE.items():
-            if len([s for s in registrations if s > _now - key]) >= value:
-                raise RegistrationRateException()
-        registrations.add(_now)
-        cache.set(cache_key, registrations)
+        if not self.registration_limiter.hit('registration-%s' % self.request.get_host()):
+            raise RegistrationRateException()
 
     def get_user(self, data):
         last_login = tzinfo.localize(datetime.now())
@@ -171,8 +171,8 @@ class RegistrationConfirmationView(ConfirmedMixin, XMPPAccountView):
         user.confirmed = now()
         user.save()
 
-        backend.create_user(username=user.node, domain=user.domain, email=user.email,
-                            password=form.cleaned_data['password'])
+        self.backend_write('create_user', username=user.node, domain=user.domain,
+                           email=user.email, password=form.cleaned_data['password'])
         if settings.WELCOME_MESSAGE is not None:
             reset_pass_path = reverse('xmpp_accounts:password')
             reset_mail_path = reverse('xmpp_accounts:reset_email')
@@ -189,8 +189,8 @@ class RegistrationConfirmationView(ConfirmedMixin, XMPPAccountView):
             }
             subject = settings.WELCOME_MESSAGE['subject'].format(**context)
             message = settings.WELCOME_MESSAGE['message'].format(**context)
-            backend.message_user(username=user.node, domain=user.domain, subject=subject,
-                                 message=message)
+            self.backend_write('message_user', username=user.node, domain=user.domain,
+                               subject=subject, message=message)
 
 
 class ResetPasswordView(ConfirmationMixin, XMPPAccountView):
@@ -212,7 +212,8 @@ class ResetPasswordConfirmationView(ConfirmedMixin, XMPPAccountView):
 
     def handle_key(self, key, user, form):
         node, domain = user.get_username().split('@', 1)
-        backend.set_password(username=node, domain=domain, password=form.cleaned_data['password'])
+        self.backend_write('set_password', username=node, domain=domain,
+                           password=form.cleaned_data['password'])
         user.confirmed = now()
         user.save()
 
@@ -249,7 +250,7 @@ class ResetEmailConfirmationView(ConfirmedMixin, XMPPAccountView):
             user.email = data['email']
 
         user.save()
-        backend.set_email(username=user.node, domain=user.domain, email=user.email)
+        self.backend_write('set_email', username=user.node, domain=user.domain, email=user.email)
 
 
 class DeleteView(ConfirmationMixin, XMPPAccountView):
@@ -288,7 +289,7 @@ class DeleteConfirmationView(ConfirmedMixin, XMPPAccountView):
 
     def after_delete(self, user, data):
         # actually delete user from the database
-        backend.remove_user(username=user.node, domain=user.domain)
+        self.backend_write('remove_user', username=user.node, domain=user.domain)
         self.user.delete()
 
 
@@ -299,24 +300,56 @@ class UserAvailableView(View):
         domain = request.POST.get('domain', '').strip().lower()
         jid = '%s@%s' % (username, domain)
 
-        cache_key = 'exists_%s' % jid
-        exists = cache.get(cache_key)
-        if exists is True:
+        if exists(jid):
             return HttpResponse('', status=409)
-        elif exists is False:
+        else:
             return HttpResponse('')
 
-        # Check if the user exists in the database
-        if User.objects.filter(jid=jid).exists():
-            cache.set(cache_key, True, 30)
-            return HttpResponse('', status=409)
 
-        # TODO: Add a setting to rely on the contents of the database and not ask the backend.
+class UsersAvailableView(AntiSpamMixin, View):
+    """Check the availability of multiple JIDs at once.
 
-        # Check if the user exists in the backend
-        if backend.user_exists(username, domain):
-            cache.set(cache_key, True, 30)
-            return HttpResponse('', status=409)
-        else:
-            cache.set(cache_key, False, 30)
-            return HttpResponse('')
+    Pass either full JIDs as ``jid`` or usernames as ``username`` together with a single
+    ``domain``. Both parameters may be given multiple times. The response is a JSON object mapping
+    each JID to ``true`` if it is still available. All domains must be managed by this site.
+
+    Every request may check up to ``max_jids`` JIDs.
+    """
+
+    max_jids = 20
+    rate_limits = {
+        'POST': '3/m',
+    }
+
+    def post(self, request):
+        # Note: XMPP usernames are case insensitive
+        domain = request.POST.get('domain', '').strip().lower()
+        jids = set(j.strip().lower() for j in request.POST.getlist('jid'))
+        if domain:
+            jids |= set('%s@%s' % (u.strip().lower(), domain)
+                        for u in request.POST.getlist('username'))
+
+        if not jids or len(jids) > self.max_jids:
+            return HttpResponse('', status=400)
+        for jid in jids:
+            username, _sep, jid_domain = jid.partition('@')
+            if not username or jid_domain not in settings.MANAGED_HOSTS:
+                return HttpResponse('', status=400)
+
+        existing = get_existing(jids)
+        data = {jid: jid not in existing for jid in jids}
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+class BackendStatusView(View):
+    """Show if changes deferred by ``DEFER_BACKEND_WRITES`` were applied by the XMPP server."""
+
+    def get(self, request, token):
+        status = get_backend_status(token)
+        if status is None:
+            raise Http404
+
+        return render(request, 'xmpp_accounts/status.html', {
+            'pending': status == BACKEND_STATUS_PENDING,
+            'done': status == BACKEND_STATUS_DONE,
+        })
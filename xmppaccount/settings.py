@@ -182,9 +182,15 @@ MAX_USERNAME_LENGTH = 32
 
 CLEARTEXT_PASSWORDS = True
 CONFIRMATION_TIMEOUT = timedelta(hours=24)
+CONFIRMATION_STORE = 'core.confirmations.DatabaseStore'
 FORM_TIMEOUT = 60 * 60  # 1 hour
 
 SPAM_BLOCK_TIME = 60 * 60 * 24  # one day!
+SPAM_BLOCK_SYNC_INTERVAL = 5  # seconds
+SPAM_BLOCK_IPV4_PREFIX = 32
+SPAM_BLOCK_IPV6_PREFIX = 128
+SPAM_BLOCK_NETWORKS = set()
+SPAM_BLOCK_FILE = None
 REGISTRATION_RATE = {
     timedelta(minutes=2): 1,
     timedelta(hours=1): 2,
@@ -192,6 +198,49 @@ REGISTRATION_RATE = {
 }
 BLOCKED_EMAIL_TLDS = set()
 
+# Bloom filters of existing users
+USER_FILTER = False
+USER_FILTER_CAPACITY = 1000000
+USER_FILTER_ERROR_RATE = 0.001
+USER_EXISTS_LOCK_TIMEOUT = None
+USER_EXISTS_CONCURRENCY = 4
+
+# Bloom filter of valid confirmation keys
+KEY_FILTER = False
+KEY_FILTER_CAPACITY = 100000
+KEY_FILTER_ERROR_RATE = 0.01
+
+# Only use the database to check if users exist
+AUTHORITATIVE_DATABASE = False
+RECONCILE_USERS_INTERVAL = timedelta(hours=1)
+
+# Guards around calls to the XMPP backend
+XMPP_BACKEND_TIMEOUT = 5  # seconds
+XMPP_BACKEND_TIMEOUTS = {}
+XMPP_BACKEND_FAILURE_THRESHOLD = 5
+XMPP_BACKEND_RESET_TIMEOUT = 30  # seconds
+
+# Reuse SMTP connections
+SMTP_POOL_SIZE = 4
+SMTP_IDLE_TIMEOUT = 60  # seconds
+
+# Send emails in background threads if Celery is not used
+EMAIL_WORKER_THREADS = 0
+EMAIL_QUEUE_SIZE = 100
+
+# Queue confirmation emails in the database, sent by a dispatcher
+EMAIL_OUTBOX = False
+OUTBOX_INTERVAL = timedelta(seconds=5)
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_LEASE = 300  # seconds
+
+# Route emails to per-domain Celery queues, see core.routers
+EMAIL_QUEUES = 0
+
+# Number of emails sent by one task when resending emails from the admin
+EMAIL_CHUNK_SIZE = 100
+
 BRAND = ""
 CONTACT_URL = ""
 WELCOME_MESSAGE = None
@@ -200,6 +249,7 @@ WELCOME_MESSAGE = None
 LOGDIR = os.path.join(BASE_DIR, 'logs')
 LOG_LEVEL = 'WARNING'
 RATELIMIT_WHITELIST = set()
+RATELIMIT_STORE = None
 
 # Captchas
 ENABLE_CAPTCHAS = True
@@ -220,6 +270,10 @@ BROKER_URL = None
 CELERY_RESULT_BACKEND = None
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERYBEAT_SCHEDULE = {}
+CELERY_ROUTES = ()
+DEFER_BACKEND_WRITES = False
+BACKEND_STATUS_TIMEOUT = 60 * 60 * 24  # one day
 EXTRA_URL_INCLUDES = {}
 
 try:
@@ -236,11 +290,26 @@ REGISTRATION_HOSTS = [k for k, v in XMPP_HOSTS.items()
 NO_EMAIL_HOSTS = [k for k, v in XMPP_HOSTS.items() if not v.get('EMAIL')]
 BLOCKED_EMAIL_TLDS.update(NO_EMAIL_HOSTS)
 
+if AUTHORITATIVE_DATABASE:
+    CELERYBEAT_SCHEDULE.setdefault('reconcile-users', {
+        'task': 'core.tasks.reconcile_users',
+        'schedule': RECONCILE_USERS_INTERVAL,
+    })
+
+if EMAIL_OUTBOX:
+    CELERYBEAT_SCHEDULE.setdefault('dispatch-outbox', {
+        'task': 'core.tasks.dispatch_outbox',
+        'schedule': OUTBOX_INTERVAL,
+    })
+
+if EMAIL_QUEUES:
+    CELERY_ROUTES = ('core.routers.EmailRouter', ) + tuple(CELERY_ROUTES)
+
 if MAX_USERNAME_LENGTH > 255:
     MAX_USERNAME_LENGTH = 255
 
 if DEFAULT_XMPP_HOST is None:
-    DEFAULT_XMPP_HOST = list(XMPP_HOSTS.values())[0]
+    DEFAULT_XMPP_HOST = list(XMPP_HOSTS.keys())[0]
 
 GPG = None
 if GNUPG is not None: